@@ -0,0 +1,56 @@
+from iptools import IP_endpoint
+from ipaddress import ip_address, ip_network
+
+MAX_BUCKETS = 100_000
+
+
+class AdmissionControl:
+    # Limits how fast new connections are accepted with token buckets, one per source address and one per network (/24 for ipv4, /64 for ipv6)
+    # Rates are in connections per second, bursts are the number of connections that can be accepted at once
+    # Times are in units_per_second, the server uses nanoseconds
+    def __init__(self, address_rate: float, address_burst: int, network_rate: float, network_burst: int, units_per_second: int = 1_000_000_000, max_buckets: int = MAX_BUCKETS):
+        self.address_rate: float = address_rate
+        self.address_burst: int = address_burst
+        self.network_rate: float = network_rate
+        self.network_burst: int = network_burst
+        self.units_per_second: int = units_per_second
+        self.max_buckets: int = max_buckets # full buckets are forgotten once there are this many, they hold nothing a new bucket wouldn't
+        self.prune_size: int = max_buckets # the number of buckets at which to look for full ones again
+        self.buckets: dict[str, tuple[float, int]] = {} # address or network -> tokens and the time they were counted
+
+    def admit(self, endpoint: IP_endpoint, time: int) -> int | None:
+        # takes a token from the endpoint's address and network buckets, returns None if admitted, otherwise the time to wait until a token is available
+        address = ip_address(endpoint[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped # dual stack sockets see ipv4 clients as mapped addresses
+        network = str(ip_network(f"{address}/{24 if address.version == 4 else 64}", strict=False))
+        address_tokens = self._get_tokens(str(address), self.address_rate, self.address_burst, time)
+        network_tokens = self._get_tokens(network, self.network_rate, self.network_burst, time)
+        if address_tokens < 1 or network_tokens < 1:
+            return max(self._get_wait(address_tokens, self.address_rate), self._get_wait(network_tokens, self.network_rate))
+        if len(self.buckets) >= self.prune_size:
+            self._forget_full_buckets(time)
+            self.prune_size = max(self.max_buckets, 2 * len(self.buckets))
+        self.buckets[str(address)] = (address_tokens - 1, time)
+        self.buckets[network] = (network_tokens - 1, time)
+        return None
+
+    def _get_tokens(self, key: str, rate: float, burst: int, time: int) -> float:
+        if key not in self.buckets:
+            return burst
+        tokens, last_time = self.buckets[key]
+        return min(tokens + rate * (time - last_time) / self.units_per_second, burst)
+
+    def _get_wait(self, tokens: float, rate: float) -> int:
+        if tokens >= 1:
+            return 0
+        if rate <= 0:
+            return self.units_per_second * 60
+        return int((1 - tokens) / rate * self.units_per_second) + 1
+
+    def _forget_full_buckets(self, time: int):
+        # a full bucket is the same as no bucket, the burst is used for both
+        for key, (tokens, last_time) in list(self.buckets.items()):
+            rate, burst = (self.network_rate, self.network_burst) if '/' in key else (self.address_rate, self.address_burst)
+            if tokens + rate * (time - last_time) / self.units_per_second >= burst:
+                self.buckets.pop(key)
@@ -0,0 +1,81 @@
+from admission import AdmissionControl
+
+def test_limits():
+    print("-testing admission limits")
+    print('testing an address is admitted up to its burst')
+    admission = AdmissionControl(1, 2, 100, 100)
+    assert admission.admit(('10.0.0.1', 1), 0) is None
+    assert admission.admit(('10.0.0.1', 2), 0) is None # the port doesn't matter
+    assert admission.admit(('10.0.0.1', 1), 0) == 1_000_000_001
+    print('testing other addresses have their own bucket')
+    assert admission.admit(('10.0.0.2', 1), 0) is None
+    print('testing a network is limited across its addresses')
+    admission = AdmissionControl(100, 100, 1, 3)
+    for index in range(3):
+        assert admission.admit((f'10.0.0.{index}', 1), 0) is None
+    assert admission.admit(('10.0.0.200', 1), 0) == 1_000_000_001
+    assert admission.admit(('10.0.1.1', 1), 0) is None # another /24
+    print('testing ipv6 networks are /64')
+    assert admission.admit(('2001:db8::1', 1), 0) is None
+    assert admission.admit(('2001:db8::2', 1), 0) is None
+    assert admission.admit(('2001:db8::3', 1), 0) is None
+    assert admission.admit(('2001:db8::4', 1), 0) is not None
+    assert admission.admit(('2001:db8:0:1::1', 1), 0) is None
+    print('testing mapped ipv4 addresses share the ipv4 buckets')
+    admission = AdmissionControl(1, 1, 100, 100)
+    assert admission.admit(('10.0.0.1', 1), 0) is None
+    assert admission.admit(('::ffff:10.0.0.1', 1), 0) is not None
+    print('testing a rate of zero waits for a minute')
+    admission = AdmissionControl(0, 1, 100, 100)
+    assert admission.admit(('10.0.0.1', 1), 0) is None
+    assert admission.admit(('10.0.0.1', 1), 10**12) == 60_000_000_000
+    print("-completed testing admission limits")
+
+def test_refill():
+    print("-testing admission refill")
+    print('testing tokens come back at the rate')
+    admission = AdmissionControl(2, 1, 100, 100)
+    assert admission.admit(('10.0.0.1', 1), 0) is None
+    assert admission.admit(('10.0.0.1', 1), 250_000_000) == 250_000_001 # half a token, at 2 per second
+    assert admission.admit(('10.0.0.1', 1), 500_000_000) is None
+    print('testing a refused connection doesn\'t use a token')
+    assert admission.admit(('10.0.0.1', 1), 600_000_000) is not None
+    assert admission.admit(('10.0.0.1', 1), 1_000_000_000) is None
+    print('testing tokens are limited to the burst')
+    admission = AdmissionControl(10, 2, 100, 100)
+    assert admission.admit(('10.0.0.1', 1), 0) is None
+    assert admission.admit(('10.0.0.1', 1), 60_000_000_000) is None
+    assert admission.admit(('10.0.0.1', 1), 60_000_000_000) is None
+    assert admission.admit(('10.0.0.1', 1), 60_000_000_000) is not None
+    print('testing times in other units')
+    admission = AdmissionControl(1, 1, 100, 100, units_per_second=1_000)
+    assert admission.admit(('10.0.0.1', 1), 0) is None
+    assert admission.admit(('10.0.0.1', 1), 500) == 501
+    assert admission.admit(('10.0.0.1', 1), 1_000) is None
+    print("-completed testing admission refill")
+
+def test_pruning():
+    print("-testing admission pruning")
+    print('testing full buckets are forgotten')
+    admission = AdmissionControl(1, 1, 1, 1, max_buckets=4)
+    assert admission.admit(('10.0.0.1', 1), 0) is None
+    assert admission.admit(('10.0.1.1', 1), 0) is None
+    assert len(admission.buckets) == 4
+    assert admission.admit(('10.0.2.1', 1), 1_000_000_000) is None
+    assert len(admission.buckets) == 2
+    print('testing buckets that are not full are kept')
+    assert admission.admit(('10.0.3.1', 1), 1_000_000_000) is None
+    assert admission.admit(('10.0.4.1', 1), 1_000_000_000) is None
+    assert len(admission.buckets) == 6
+    assert admission.admit(('10.0.2.1', 1), 1_000_000_000) is not None
+    print("-completed testing admission pruning")
+
+def main():
+    print("---------testing admission control")
+    test_limits()
+    test_refill()
+    test_pruning()
+    print("---------completed testing admission control")
+
+if __name__ == "__main__":
+    main()
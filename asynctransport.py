@@ -0,0 +1,507 @@
+from clientconnector import ClientConnector
+from connection import Connection
+from congestion import CongestionController
+from holepuncher import HolePuncher
+from parallelstun import ParallelStun
+from packet import CLOSE_TYPE, decode_packet, create_accept_packet, create_close_packet, create_close_ack_packet
+from admission import AdmissionControl
+from psychicserver import Handshake
+from socket import socket, AddressFamily, AF_INET
+from socketcommon import create_ordinary_udp_socket
+from iptools import IP_endpoint, get_canonical_endpoint, get_canonical_local_endpoint
+from asyncio import AbstractEventLoop, DatagramProtocol, DatagramTransport, Queue, TimerHandle, get_running_loop
+from collections.abc import AsyncIterator, Callable
+from typing import Any
+from abc import ABC, abstractmethod
+
+STUN_KEY = 'stun'
+HOLE_PUNCHER_KEY = 'hole_puncher'
+CONNECTOR_KEY = 'connector'
+CONNECTION_KEY = 'connection'
+CLOSING_KEY = 'closing'
+
+
+class _EndpointProtocol(DatagramProtocol):
+    # passes datagrams from the event loop to the endpoint that owns the socket
+    def __init__(self, receiver: Callable[[bytes, Any], None]):
+        self.receiver = receiver
+
+    def datagram_received(self, data: bytes, addr: Any):
+        self.receiver(data, addr)
+
+    def error_received(self, exc: Exception):
+        pass # icmp port unreachable from an earlier send
+
+
+class _AsyncEndpoint(ABC):
+    # The event loop parts shared by the async server and client
+    # Datagrams are handled as they arrive, and each component has a timer set with call_at for its next deadline
+    # Times are in nanoseconds of the loop's clock
+    def __init__(self, port: int, family: AddressFamily, receive_buffer_size: int | None, send_buffer_size: int | None):
+        self.loop: AbstractEventLoop = get_running_loop()
+        self.socket: socket = create_ordinary_udp_socket(port, family, receive_buffer_size, send_buffer_size)
+        self.transport: DatagramTransport | None = None
+        self.timers: dict[Any, TimerHandle] = {} # component key -> timer
+        self.stun: ParallelStun | None = None
+        self.stun_reported: bool = False # true once the current stun's result has been queued as an event
+        self.messages: Queue[Any] = Queue() # None is queued when closed
+        self.events: Queue[tuple[Any, ...] | None] = Queue()
+        self.closed = False
+
+    async def _open(self):
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: _EndpointProtocol(self._receive_datagram), sock=self.socket)
+
+    @abstractmethod
+    def _receive_datagram(self, data: bytes, address: Any):
+        pass
+
+    @abstractmethod
+    def _tick_component(self, key: Any, time: int):
+        pass
+
+    def _get_time(self) -> int:
+        return int(self.loop.time() * 1_000_000_000)
+
+    def _send_all(self, send_data: list[tuple[bytes, IP_endpoint]]):
+        if self.transport is None or self.closed:
+            return
+        for data, address in send_data:
+            self.transport.sendto(data, address)
+
+    def _schedule(self, key: Any, deadline: int | None):
+        # a timer that fires early just reschedules, so it is only replaced when the deadline moves earlier
+        timer = self.timers.get(key)
+        if deadline is None:
+            if timer is not None:
+                timer.cancel()
+                self.timers.pop(key)
+            return
+        when = deadline / 1_000_000_000
+        if timer is not None:
+            if timer.when() <= when:
+                return
+            timer.cancel()
+        self.timers[key] = self.loop.call_at(when, self._run_timer, key)
+
+    def _run_timer(self, key: Any):
+        self.timers.pop(key, None)
+        if not self.closed:
+            self._tick_component(key, self._get_time())
+
+    def _report_stun_receive(self, data: bytes):
+        if self.stun is None:
+            return
+        self.stun.report_receive(data)
+        self._check_stun()
+        self._schedule(STUN_KEY, self.stun.next_deadline())
+
+    def _tick_stun(self, time: int):
+        if self.stun is None:
+            return
+        stun_data = self.stun.tick(time)
+        server = self.stun.get_current_stun_server()
+        if server is not None:
+            self._send_all([(data, server) for data in stun_data])
+        self._check_stun()
+        self._schedule(STUN_KEY, self.stun.next_deadline())
+
+    def _check_stun(self):
+        if self.stun is not None and not self.stun.stun_in_progress() and not self.stun_reported:
+            self.stun_reported = True
+            self.events.put_nowait(('stun_result', self.stun.get_stun_result()))
+
+    def start_stun(self, servers: list[IP_endpoint]):
+        if self.closed:
+            return
+        self.stun = ParallelStun(1_000_000_000, 3, servers)
+        self.stun_reported = False
+        self._schedule(STUN_KEY, self._get_time())
+
+    def stun_in_progress(self) -> bool:
+        if self.closed or self.stun is None:
+            return False
+        return self.stun.stun_in_progress()
+
+    def get_stun_result(self) -> IP_endpoint | None:
+        if self.stun is None:
+            return None
+        return self.stun.get_stun_result()
+
+    def get_local_endpoint(self) -> IP_endpoint | None:
+        if self.closed:
+            return None
+        return get_canonical_local_endpoint(self.socket)
+
+    def get_family(self) -> AddressFamily | None:
+        if self.closed:
+            return None
+        return self.socket.family
+
+    async def _get(self, queue: Queue[Any]) -> Any:
+        item = await queue.get()
+        if item is None:
+            queue.put_nowait(None) # for any other waiters
+        return item
+
+    async def next_event(self) -> tuple[Any, ...] | None:
+        # waits for the next event, a tuple of the event's name and endpoint, None once closed
+        return await self._get(self.events)
+
+    async def iterate_events(self) -> AsyncIterator[tuple[Any, ...]]:
+        while (event := await self.next_event()) is not None:
+            yield event
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        # messages and events received before closing can still be read
+        if self.closed:
+            return
+        self.closed = True
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self.socket.close()
+        self.stun = None
+        self.messages.put_nowait(None)
+        self.events.put_nowait(None)
+
+
+class AsyncPsychicServer(_AsyncEndpoint):
+    # PsychicServer for asyncio, driven by the event loop instead of tick
+    # Created with 'await AsyncPsychicServer.create(...)'
+    # Events are ('connect', client), ('disconnect', client), ('hole_punch_failed', target) and ('stun_result', endpoint or None)
+    def __init__(self, port: int = 0, family: AddressFamily = AF_INET, hole_punch_timeout: int = 3_000_000_000, ack_delay_ns: int = 500_000_000, selective_acks: bool = False, congestion_controller: Callable[[], CongestionController] | None = None, max_packet_size: int | None = None, receive_buffer_size: int | None = None, send_buffer_size: int | None = None, cookie_handshake: bool = False, max_connections: int | None = None, admission_control: AdmissionControl | None = None):
+        super().__init__(port, family, receive_buffer_size, send_buffer_size)
+        self.connections: dict[IP_endpoint, Connection] = {} # canonical client endpoint -> connection
+        self.closing_connections: dict[IP_endpoint, Connection] = {} # disconnected by the server, waiting for the client to acknowledge the close
+        self.hole_puncher: HolePuncher = HolePuncher(hole_punch_timeout, 5)
+        self.ack_delay_ns: int = ack_delay_ns
+        self.selective_acks: bool = selective_acks
+        self.congestion_controller: Callable[[], CongestionController] | None = congestion_controller # creates a controller for each connection
+        self.max_packet_size: int | None = max_packet_size
+        self.handshake: Handshake = Handshake(cookie_handshake, max_connections, admission_control)
+
+    @classmethod
+    async def create(cls, *args: Any, **kwargs: Any) -> 'AsyncPsychicServer':
+        server = cls(*args, **kwargs)
+        await server._open()
+        return server
+
+    def get_clients(self) -> list[IP_endpoint]:
+        if self.closed:
+            return []
+        return list(self.connections)
+
+    def get_rtt(self, client: IP_endpoint) -> float | None:
+        connection = self._get_connection(client)
+        if connection is None:
+            return None
+        return connection.get_rtt()
+
+    def hole_punch(self, target: IP_endpoint):
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(target, self.socket.family)
+        if endpoint is None or endpoint in self.connections:
+            return
+        self.hole_puncher.hole_punch(endpoint)
+        self._schedule(HOLE_PUNCHER_KEY, self.hole_puncher.next_deadline())
+
+    def stop_hole_punch(self, target: IP_endpoint):
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(target, self.socket.family)
+        if endpoint is None:
+            return
+        self.hole_puncher.stop_hole_punch(endpoint)
+
+    def disconnect(self, client: IP_endpoint):
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(client, self.socket.family)
+        if endpoint is None or endpoint not in self.connections:
+            return
+        # the client is told to release the connection, which is kept until it acknowledges
+        connection = self.connections[endpoint]
+        connection.set_time(self._get_time())
+        connection.close()
+        self._disconnect(endpoint)
+        self.closing_connections[endpoint] = connection
+        self._schedule(endpoint, connection.next_deadline())
+
+    def send(self, message: bytes, destination: IP_endpoint):
+        # sent from a timer on the next pass of the loop, so that sends in the same pass share packets
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(destination, self.socket.family)
+        if endpoint is None or endpoint not in self.connections:
+            return
+        connection = self.connections[endpoint]
+        connection.set_time(self._get_time())
+        connection.send(message)
+        self._schedule(endpoint, connection.next_deadline())
+
+    async def recv(self) -> tuple[IP_endpoint, int, bytes | memoryview] | None:
+        # waits for the next message from any client as (client, message number, message), None once closed
+        return await self._get(self.messages)
+
+    async def iterate_messages(self) -> AsyncIterator[tuple[IP_endpoint, int, bytes | memoryview]]:
+        while (message := await self.recv()) is not None:
+            yield message
+
+    def _get_connection(self, client: IP_endpoint) -> Connection | None:
+        endpoint = get_canonical_endpoint(client, self.socket.family)
+        if endpoint is None:
+            return None
+        return self.connections.get(endpoint)
+
+    def _configure_connection(self, connection: Connection):
+        connection.set_selective_acks(self.selective_acks)
+        connection.set_max_packet_size(self.max_packet_size)
+        if self.congestion_controller is not None:
+            connection.set_congestion_controller(self.congestion_controller())
+
+    def _disconnect(self, client: IP_endpoint):
+        self.connections.pop(client)
+        self._schedule(client, None)
+        self.events.put_nowait(('disconnect', client))
+
+    def _receive_datagram(self, data: bytes, address: Any):
+        address = get_canonical_endpoint(address, self.socket.family)
+        if address is None or self.closed:
+            return
+        if self.stun is not None and address == self.stun.get_current_stun_server():
+            self._report_stun_receive(data)
+            return
+        time = self._get_time()
+        connection = self.connections.get(address)
+        if connection is not None:
+            connection.set_time(time)
+            connection.report_receive(data)
+            while (received := connection.receive()) is not None:
+                self.messages.put_nowait((address, received[0], received[1]))
+            self._schedule(address, connection.next_deadline())
+            return
+        connection = self.closing_connections.get(address)
+        if connection is not None:
+            connection.report_receive(data)
+            if not connection.is_connected():
+                self._schedule(address, time) # to send any close ack and be removed
+                return
+        # packet from somewhere else -> check if new connection
+        self._manage_new_client(data, address, time)
+
+    def _manage_new_client(self, data: bytes, address: IP_endpoint, time: int):
+        convid, reply = self.handshake.respond(data, address, time, len(self.connections))
+        if reply is not None:
+            self._send_all([(reply, address)])
+        if convid is None:
+            return
+        connection = Connection(convid, time, 1_000_000_000, self.ack_delay_ns)
+        self._configure_connection(connection)
+        self.closing_connections.pop(address, None) # the client has moved on
+        self.connections[address] = connection
+        self.hole_puncher.stop_hole_punch(address)
+        self._send_all([(create_accept_packet(convid), address)])
+        self.events.put_nowait(('connect', address))
+        self._schedule(address, connection.next_deadline())
+
+    def _tick_component(self, key: Any, time: int):
+        if key == STUN_KEY:
+            self._tick_stun(time)
+        elif key == HOLE_PUNCHER_KEY:
+            self._send_all(self.hole_puncher.tick(time))
+            for target in self.hole_puncher.get_fails():
+                self.events.put_nowait(('hole_punch_failed', target))
+            self._schedule(HOLE_PUNCHER_KEY, self.hole_puncher.next_deadline())
+        else:
+            connection = self.connections.get(key, self.closing_connections.get(key))
+            if connection is None:
+                return
+            self._send_all([(data, key) for data in connection.tick(time)])
+            if connection.is_connected():
+                self._schedule(key, connection.next_deadline())
+            elif key in self.connections:
+                self._disconnect(key)
+            else:
+                self.closing_connections.pop(key)
+                self._schedule(key, None)
+
+    def close(self):
+        # best effort, so that clients don't wait for the connection to time out
+        self._send_all([(create_close_packet(connection.convid), client) for client, connection in self.connections.items()])
+        super().close()
+        self.connections.clear()
+        self.closing_connections.clear()
+
+
+class AsyncPsychicClient(_AsyncEndpoint):
+    # PsychicClient for asyncio, driven by the event loop instead of tick
+    # Created with 'await AsyncPsychicClient.create(...)'
+    # Events are ('connect', server), ('connect_failed', server), ('disconnect', server) and ('stun_result', endpoint or None)
+    def __init__(self, port: int = 0, family: AddressFamily = AF_INET, ack_delay_ns: int = 500_000_000, selective_acks: bool = False, congestion_controller: Callable[[], CongestionController] | None = None, max_packet_size: int | None = None, receive_buffer_size: int | None = None, send_buffer_size: int | None = None):
+        super().__init__(port, family, receive_buffer_size, send_buffer_size)
+        self.connector: tuple[ClientConnector, IP_endpoint] | None = None
+        self.connection: tuple[Connection, IP_endpoint] | None = None
+        self.closing_connection: tuple[Connection, IP_endpoint] | None = None # disconnected, waiting for the server to acknowledge the close
+        self.ack_delay_ns: int = ack_delay_ns
+        self.selective_acks: bool = selective_acks
+        self.congestion_controller: Callable[[], CongestionController] | None = congestion_controller # creates a controller for each connection
+        self.max_packet_size: int | None = max_packet_size
+
+    @classmethod
+    async def create(cls, *args: Any, **kwargs: Any) -> 'AsyncPsychicClient':
+        client = cls(*args, **kwargs)
+        await client._open()
+        return client
+
+    def get_server(self) -> IP_endpoint | None:
+        if self.closed or self.connection is None:
+            return None
+        return self.connection[1]
+
+    def get_rtt(self) -> float | None:
+        if self.closed or self.connection is None:
+            return None
+        return self.connection[0].get_rtt()
+
+    def connecting(self) -> bool:
+        return self.connector is not None
+
+    def is_connected(self) -> bool:
+        if self.connection is None:
+            return False
+        return self.connection[0].is_connected()
+
+    def connect(self, server: IP_endpoint) -> bool:
+        # returns true if it is attempting to connect, the result is a 'connect' or 'connect_failed' event
+        if self.is_connected() or self.closed:
+            return False
+        server_endpoint = get_canonical_endpoint(server, self.socket.family)
+        if server_endpoint is None:
+            return False
+        time = self._get_time()
+        connector = ClientConnector((time // 1_000_000) % (2**32), time, 5, 500_000_000, 1_000_000_000, self.ack_delay_ns, 1_000_000)
+        self.connector = (connector, server_endpoint)
+        self._schedule(CONNECTOR_KEY, connector.next_deadline())
+        return True
+
+    def disconnect(self):
+        # the server is told to release the connection straight away, instead of waiting for it to time out
+        if self.connection is not None and self.connection[0].is_connected() and not self.closed:
+            self.connection[0].set_time(self._get_time())
+            self.connection[0].close()
+            self.closing_connection = self.connection
+            self._schedule(CLOSING_KEY, self.connection[0].next_deadline())
+        self.connector = None
+        self.connection = None
+        self._schedule(CONNECTOR_KEY, None)
+        self._schedule(CONNECTION_KEY, None)
+
+    def send(self, message: bytes):
+        if self.connection is None or self.closed:
+            return
+        self.connection[0].set_time(self._get_time())
+        self.connection[0].send(message)
+        self._schedule(CONNECTION_KEY, self.connection[0].next_deadline())
+
+    async def recv(self) -> tuple[int, bytes | memoryview] | None:
+        # waits for the next message from the server as (message number, message), None once closed
+        return await self._get(self.messages)
+
+    async def iterate_messages(self) -> AsyncIterator[tuple[int, bytes | memoryview]]:
+        while (message := await self.recv()) is not None:
+            yield message
+
+    def _configure_connection(self, connection: Connection):
+        connection.set_selective_acks(self.selective_acks)
+        connection.set_max_packet_size(self.max_packet_size)
+        if self.congestion_controller is not None:
+            connection.set_congestion_controller(self.congestion_controller())
+
+    def _check_connector(self):
+        if self.connector is None:
+            return
+        connector, server = self.connector
+        connection = connector.get_connection_info()
+        if connection is not None:
+            self.connector = None
+            self._configure_connection(connection)
+            self.connection = (connection, server)
+            self.events.put_nowait(('connect', server))
+            self._schedule(CONNECTOR_KEY, None)
+            self._schedule(CONNECTION_KEY, self._get_time()) # ack the accept
+        elif connector.connect_failed():
+            self.connector = None
+            self.events.put_nowait(('connect_failed', server))
+            self._schedule(CONNECTOR_KEY, None)
+        else:
+            self._schedule(CONNECTOR_KEY, connector.next_deadline())
+
+    def _receive_datagram(self, data: bytes, address: Any):
+        address = get_canonical_endpoint(address, self.socket.family)
+        if address is None or self.closed:
+            return
+        if self.closing_connection is not None and address == self.closing_connection[1]:
+            # first, in case a new connection is being made to the same server
+            self.closing_connection[0].report_receive(data)
+            if not self.closing_connection[0].is_connected():
+                # ticked once more to acknowledge a close from the server before it is dropped, as a PsychicClient does
+                self._schedule(CLOSING_KEY, None)
+                self._tick_component(CLOSING_KEY, self._get_time())
+                return
+        if self.connector is not None and address == self.connector[1]:
+            self.connector[0].report_receive(data)
+            self._check_connector()
+            return
+        if self.stun is not None and address == self.stun.get_current_stun_server():
+            self._report_stun_receive(data)
+            return
+        if self.connection is not None and address == self.connection[1]:
+            connection = self.connection[0]
+            connection.set_time(self._get_time())
+            connection.report_receive(data)
+            while (received := connection.receive()) is not None:
+                self.messages.put_nowait(received)
+            self._schedule(CONNECTION_KEY, connection.next_deadline())
+            return
+        result = decode_packet(data)
+        if result is not None and result[0] == CLOSE_TYPE:
+            self._send_all([(create_close_ack_packet(result[1]), address)]) # for a server closing a connection that is already gone
+
+    def _tick_component(self, key: Any, time: int):
+        if key == STUN_KEY:
+            self._tick_stun(time)
+        elif key == CONNECTOR_KEY and self.connector is not None:
+            connector, server = self.connector
+            self._send_all([(data, server) for data in connector.tick(time)])
+            self._check_connector()
+        elif key == CONNECTION_KEY and self.connection is not None:
+            connection, server = self.connection
+            self._send_all([(data, server) for data in connection.tick(time)])
+            if not connection.is_connected():
+                self.connection = None
+                self.events.put_nowait(('disconnect', server))
+            else:
+                self._schedule(CONNECTION_KEY, connection.next_deadline())
+        elif key == CLOSING_KEY and self.closing_connection is not None:
+            connection, server = self.closing_connection
+            self._send_all([(data, server) for data in connection.tick(time)])
+            if not connection.is_connected():
+                self.closing_connection = None
+            else:
+                self._schedule(CLOSING_KEY, connection.next_deadline())
+
+    def close(self):
+        if self.connection is not None:
+            # best effort, so that the server doesn't wait for the connection to time out
+            self._send_all([(create_close_packet(self.connection[0].convid), self.connection[1])])
+        super().close()
+        self.connector = None
+        self.connection = None
+        self.closing_connection = None
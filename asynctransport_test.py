@@ -0,0 +1,139 @@
+from asynctransport import AsyncPsychicServer, AsyncPsychicClient, _AsyncEndpoint
+from packet import REQUEST_TYPE, CLOSE_TYPE, CLOSE_ACK_TYPE, decode_packet, create_accept_packet, create_close_packet
+from socketcommon import create_ordinary_udp_socket, receive_datagrams
+from socket import socket, AF_INET
+from asyncio import run, wait_for, sleep
+from typing import Any
+
+async def next_event(endpoint: AsyncPsychicServer | AsyncPsychicClient) -> tuple[Any, ...] | None:
+    return await wait_for(endpoint.next_event(), 5)
+
+async def connect(server: AsyncPsychicServer, client: AsyncPsychicClient) -> tuple[Any, ...]:
+    # returns the client as the server sees it
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    assert client.connect(('127.0.0.1', local_endpoint[1]))
+    assert await next_event(client) == ('connect', ('127.0.0.1', local_endpoint[1]))
+    event = await next_event(server)
+    assert event is not None and event[0] == 'connect'
+    return event[1]
+
+async def check_messages():
+    print("-testing async messages")
+    server = await AsyncPsychicServer.create(0, ack_delay_ns=0)
+    client = await AsyncPsychicClient.create(0, ack_delay_ns=0)
+    print('testing connecting')
+    endpoint = await connect(server, client)
+    server_endpoint = client.get_server()
+    assert server.get_clients() == [endpoint] and client.is_connected()
+    print('testing messages in both directions')
+    for index in range(100):
+        client.send(b'from client %d' % index)
+        server.send(b'from server %d' % index, endpoint)
+    server_received = [await wait_for(server.recv(), 5) for _ in range(100)]
+    client_received = [await wait_for(client.recv(), 5) for _ in range(100)]
+    assert sorted(server_received) == sorted((endpoint, index, b'from client %d' % index) for index in range(100)) # type: ignore
+    assert sorted(client_received) == sorted((index, b'from server %d' % index) for index in range(100)) # type: ignore
+    print('testing disconnecting')
+    server.disconnect(endpoint)
+    assert await next_event(server) == ('disconnect', endpoint)
+    assert await next_event(client) == ('disconnect', server_endpoint)
+    assert not client.is_connected() and server.get_clients() == []
+    print('testing closing ends the queues')
+    server.close()
+    client.close()
+    assert await server.recv() is None and await server.next_event() is None
+    assert await client.recv() is None and await client.next_event() is None
+    print("-completed testing async messages")
+
+async def check_handshake():
+    print("-testing the async handshake")
+    server = await AsyncPsychicServer.create(0, ack_delay_ns=0, cookie_handshake=True, max_connections=1)
+    first = await AsyncPsychicClient.create(0, ack_delay_ns=0)
+    second = await AsyncPsychicClient.create(0, ack_delay_ns=0)
+    print('testing clients connect with a cookie')
+    first_endpoint = await connect(server, first)
+    print('testing a full server makes new clients wait')
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    assert second.connect(('127.0.0.1', local_endpoint[1]))
+    try:
+        await wait_for(second.next_event(), 0.5)
+        assert False
+    except TimeoutError:
+        pass
+    assert second.connecting() and server.get_clients() == [first_endpoint]
+    print('testing a waiting client connects once there is space')
+    first.disconnect()
+    assert await next_event(server) == ('disconnect', first_endpoint)
+    assert await next_event(second) == ('connect', ('127.0.0.1', local_endpoint[1]))
+    event = await next_event(server)
+    assert event is not None and event[0] == 'connect' and server.get_clients() == [event[1]]
+    server.close()
+    first.close()
+    second.close()
+    print("-completed testing the async handshake")
+
+async def receive_packet(udp_socket: socket, type: int) -> tuple[tuple[int, int, Any], Any]:
+    # skips other packets until one of the type arrives, returns it decoded with its source
+    for _ in range(500):
+        for data, address in receive_datagrams(udp_socket, None):
+            result = decode_packet(data)
+            if result is not None and result[0] == type:
+                return (result, address)
+        await sleep(0.01)
+    assert False
+
+async def check_close_ack():
+    print("-testing closes while closing")
+    server = create_ordinary_udp_socket(0, AF_INET) # the server's side is played by this test
+    client = await AsyncPsychicClient.create(0, ack_delay_ns=0)
+    server_endpoint = ('127.0.0.1', server.getsockname()[1])
+    assert client.connect(server_endpoint)
+    request, address = await receive_packet(server, REQUEST_TYPE)
+    convid = request[1]
+    server.sendto(create_accept_packet(convid), address)
+    assert await next_event(client) == ('connect', server_endpoint)
+    print('testing a close from the server is acknowledged while the client is closing')
+    client.disconnect()
+    close, _ = await receive_packet(server, CLOSE_TYPE)
+    assert close[1] == convid
+    server.sendto(create_close_packet(convid), address)
+    close_ack, _ = await receive_packet(server, CLOSE_ACK_TYPE)
+    assert close_ack[1] == convid
+    assert client.closing_connection is None
+    client.close()
+    server.close()
+    print("-completed testing closes while closing")
+
+def test_messages():
+    run(check_messages())
+
+def test_handshake():
+    run(check_handshake())
+
+def test_close_ack():
+    run(check_close_ack())
+
+def test_abstract_endpoint():
+    print("-testing the abstract endpoint")
+    class IncompleteEndpoint(_AsyncEndpoint):
+        def _tick_component(self, key: Any, time: int):
+            pass
+    try:
+        IncompleteEndpoint(0, 0, None, None) # type: ignore
+        assert False
+    except TypeError:
+        pass
+    print("-completed testing the abstract endpoint")
+
+def main():
+    print("---------testing async transport")
+    test_messages()
+    test_handshake()
+    test_close_ack()
+    test_abstract_endpoint()
+    print("---------completed testing async transport")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,16 @@
 from socket import socket, AF_INET
 from socketcommon import *
 from iptools import IP_endpoint
-from select import select
 from threading import Lock
 from broadcastpacket import create_request_packet, interpret_answer_packet
 
 
 class BroadcastClient:
-    def __init__(self, multicast_endpoint: IP_endpoint, port: int = 0):
+    def __init__(self, multicast_endpoint: IP_endpoint, port: int = 0, max_datagrams_per_tick: int | None = MAX_DATAGRAMS_PER_TICK):
         self.socket: socket = create_broadcast_sending_socket(port, AF_INET)
         self.multicast_endpoint: IP_endpoint = multicast_endpoint
+        self.max_datagrams_per_tick: int | None = max_datagrams_per_tick
+        self.wakeup_reader, self.wakeup_writer = create_wakeup_sockets() # interrupts a blocking tick on close
         self.lock : Lock = Lock()
         self.closed: bool = False
     
@@ -28,22 +29,32 @@ class BroadcastClient:
                 return None
             return get_canonical_local_endpoint(self.socket)
 
-    def tick(self) -> list[tuple[IP_endpoint, bytes]]:
+    def next_deadline(self) -> int | None:
+        # nothing is timed, tick only needs to be called when a datagram arrives
+        return None
+
+    def _wait(self, timeout: float | None):
+        with self.lock:
+            if self.closed:
+                return
+        wait_for_readable([self.socket], self.wakeup_reader, timeout)
+
+    def tick(self, timeout: float | None = 0) -> list[tuple[IP_endpoint, bytes]]:
+        # waits up to timeout seconds for a datagram before ticking, None waits until one arrives
+        if timeout != 0:
+            self._wait(timeout)
         with self.lock:
             if self.closed:
                 return []
             answers: list[tuple[IP_endpoint, bytes]] = []
-            rl, _, _ = select([self.socket], [], [], 0)
-            while len(rl) > 0:
+            for data, address in receive_datagrams(self.socket, self.max_datagrams_per_tick):
                 try:
-                    data, address = self.socket.recvfrom(BUFSIZE)
                     address = get_canonical_endpoint(address, self.socket.family)
                     answer = interpret_answer_packet(data)
                     if answer is not None and address is not None:
                         answers.append(answer)
                 except:
                     pass
-                rl, _, _ = select([self.socket], [], [], 0)
             return answers
     
     def send_request(self):
@@ -58,4 +69,7 @@ class BroadcastClient:
             if self.closed:
                 return
             self.closed = True
-            self.socket.close()
\ No newline at end of file
+            self.socket.close()
+            wake(self.wakeup_writer)
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
\ No newline at end of file
@@ -30,7 +30,7 @@ def main():
 
     def tick():
         while not client.is_closed():
-            new_servers = client.tick()
+            new_servers = client.tick(None)
             if len(new_servers) > 0:
                 print('new servers')
             for endpoint, data in new_servers:
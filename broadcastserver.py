@@ -1,18 +1,19 @@
 from socket import socket, AF_INET
 from socketcommon import *
 from iptools import IP_endpoint
-from select import select
 from threading import Lock
 from broadcastpacket import is_request_packet, create_answer_packet
 
 
 class BroadcastServer:
-    def __init__(self, multicast_group: str, port: int, server_endpoint: IP_endpoint, server_data: bytes):
+    def __init__(self, multicast_group: str, port: int, server_endpoint: IP_endpoint, server_data: bytes, max_datagrams_per_tick: int | None = MAX_DATAGRAMS_PER_TICK):
         self.socket: socket = create_broadcast_receiving_socket(port, multicast_group, AF_INET)
+        self.wakeup_reader, self.wakeup_writer = create_wakeup_sockets() # interrupts a blocking tick on close
         self.lock : Lock = Lock()
         self.closed: bool = False
         self.server_endpoint = server_endpoint
         self.server_data = server_data
+        self.max_datagrams_per_tick: int | None = max_datagrams_per_tick
     
     def is_closed(self) -> bool:
         return self.closed
@@ -44,21 +45,31 @@ class BroadcastServer:
             self.server_endpoint = endpoint
             self.server_data = data
 
-    def tick(self):
+    def next_deadline(self) -> int | None:
+        # nothing is timed, tick only needs to be called when a datagram arrives
+        return None
+
+    def _wait(self, timeout: float | None):
+        with self.lock:
+            if self.closed:
+                return
+        wait_for_readable([self.socket], self.wakeup_reader, timeout)
+
+    def tick(self, timeout: float | None = 0):
+        # waits up to timeout seconds for a datagram before ticking, None waits until one arrives
+        if timeout != 0:
+            self._wait(timeout)
         with self.lock:
             if self.closed:
                 return
-            rl, _, _ = select([self.socket], [], [], 0)
-            while len(rl) > 0:
+            for data, address in receive_datagrams(self.socket, self.max_datagrams_per_tick):
                 try:
-                    data, address = self.socket.recvfrom(BUFSIZE)
                     
                     address = get_canonical_endpoint(address, self.socket.family)
                     if is_request_packet(data) and address is not None:
                         self._send_answer_to(address)
                 except:
                     pass
-                rl, _, _ = select([self.socket], [], [], 0)
     
     def _send_answer_to(self, endpoint: IP_endpoint):
         answer = create_answer_packet(self.server_endpoint, self.server_data)
@@ -69,4 +80,7 @@ class BroadcastServer:
             if self.closed:
                 return
             self.closed = True
-            self.socket.close()
\ No newline at end of file
+            self.socket.close()
+            wake(self.wakeup_writer)
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
\ No newline at end of file
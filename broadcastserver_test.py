@@ -32,7 +32,7 @@ def main():
 
     def tick():
         while not server.is_closed():
-            server.tick()
+            server.tick(None)
 
     
     tick_thread = Thread(target=tick)
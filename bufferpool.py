@@ -0,0 +1,94 @@
+from socket import socket
+from socketcommon import BUFSIZE, SOL_UDP, UDP_GRO, GRO_CONTROL_SIZE, SO_RXQ_OVFL
+from socket import SOL_SOCKET
+from struct import unpack
+from typing import Any
+from collections.abc import Iterator
+from threading import Lock
+
+MAX_FREE_BUFFERS = 64
+
+
+class BufferPool:
+    # Recycles the bytearrays that datagrams are received into
+    # A buffer is in use while anything holds a reference to it, views into it stay valid until the last reference is released
+    # Views can be released from any thread, the references are only changed under the lock
+    def __init__(self, buffer_size: int = BUFSIZE, max_free_buffers: int = MAX_FREE_BUFFERS):
+        self.buffer_size: int = buffer_size
+        self.max_free_buffers: int = max_free_buffers
+        self.free_buffers: list[bytearray] = []
+        self.references: dict[int, int] = {} # id of buffer in use -> number of references
+        self.kernel_drops: int = 0 # the latest count of datagrams dropped by the socket, when receiving with count_drops
+        self.lock: Lock = Lock()
+
+    def get_free_buffer_count(self) -> int:
+        return len(self.free_buffers)
+
+    def get_buffers_in_use(self) -> int:
+        return len(self.references)
+
+    def acquire(self) -> bytearray:
+        # returns a buffer holding one reference
+        with self.lock:
+            buffer = self.free_buffers.pop() if len(self.free_buffers) > 0 else bytearray(self.buffer_size)
+            self.references[id(buffer)] = 1
+        return buffer
+
+    def retain(self, view: memoryview):
+        # keeps the buffer behind the view from being reused until a matching release
+        buffer = view.obj
+        with self.lock:
+            if id(buffer) in self.references:
+                self.references[id(buffer)] += 1
+
+    def release(self, view: memoryview):
+        self._release_buffer(view.obj) # type: ignore
+
+    def receive_datagrams(self, udp_socket: socket, max_datagrams: int | None, gro: bool = False, count_drops: bool = False) -> Iterator[tuple[memoryview, Any]]:
+        # reads from a non blocking socket until it is drained or max_datagrams have been read
+        # each view is released once the next datagram is requested, retain it to keep it longer
+        # with gro, datagrams coalesced by the kernel are split up again (the buffers must be large enough to hold them)
+        # with count_drops, kernel_drops is updated from the drop count sent with each datagram
+        received = 0
+        while max_datagrams is None or received < max_datagrams:
+            buffer = self.acquire()
+            segment_size = 0
+            try:
+                if gro or count_drops:
+                    size, ancillary_data, _, address = udp_socket.recvmsg_into([buffer], GRO_CONTROL_SIZE)
+                    for level, type, data in ancillary_data:
+                        if level == SOL_UDP and type == UDP_GRO:
+                            segment_size = unpack('=i', data[:4])[0]
+                        elif level == SOL_SOCKET and type == SO_RXQ_OVFL:
+                            self.kernel_drops = unpack('=I', data[:4])[0]
+                else:
+                    size, address = udp_socket.recvfrom_into(buffer)
+            except BlockingIOError:
+                self._release_buffer(buffer)
+                break
+            except ConnectionResetError:
+                self._release_buffer(buffer)
+                continue # icmp port unreachable from an earlier send on windows
+            except OSError:
+                self._release_buffer(buffer)
+                break
+            received += 1
+            if segment_size <= 0:
+                segment_size = max(size, 1)
+            try:
+                for start in range(0, max(size, 1), segment_size):
+                    yield (memoryview(buffer)[start:min(start + segment_size, size)], address)
+            finally:
+                self._release_buffer(buffer)
+
+    def _release_buffer(self, buffer: bytearray):
+        with self.lock:
+            references = self.references.get(id(buffer))
+            if references is None:
+                return
+            if references > 1:
+                self.references[id(buffer)] = references - 1
+                return
+            self.references.pop(id(buffer))
+            if len(self.free_buffers) < self.max_free_buffers:
+                self.free_buffers.append(buffer)
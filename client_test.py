@@ -33,10 +33,10 @@ def main():
         connecting = client.connecting()
         stun_in_progress = client.stun_in_progress()
         while not client.closed:
-            client.tick()
+            client.tick(None)
             while recv:= client.receive():
                 seg, message = recv
-                print(f"{seg}: {message.decode()}")
+                print(f"{seg}: {bytes(message).decode()}")
             if client.is_connected() and not connected:
                 connected = True
                 print("connected!")
@@ -1,9 +1,11 @@
 from connection import Connection
-from packet import interpret_packet, PacketType, create_request_packet
+from packet import decode_packet, ACCEPT_TYPE, COOKIE_TYPE, BUSY_TYPE, create_request_packet
+
+MAX_BUSY_RETRIES = 30 # the connect fails if the server is still busy after this many retries
 
 
 class ClientConnector:
-    def __init__(self, convid: int, time_ms: int, max_timeouts: int, request_timeout_ms: int, init_rtt: int, wait_before_acking: int):
+    def __init__(self, convid: int, time_ms: int, max_timeouts: int, request_timeout_ms: int, init_rtt: int, wait_before_acking: int, ticks_per_ms: int = 1, max_busy_retries: int = MAX_BUSY_RETRIES):
         self.connection_info:  Connection | None= None
         self.convid = convid
 
@@ -16,6 +18,11 @@ class ClientConnector:
         self.wait_before_acking = wait_before_acking
 
         self.last_tick_time: int = time_ms
+        self.cookie: bytes | None = None # echoed in requests once the server has sent one
+        self.ticks_per_ms: int = ticks_per_ms # converts the retry delay of a busy packet to the units of time used here
+        self.retry_time: int | None = None # when to retry after the server said it was busy
+        self.max_busy_retries: int = max_busy_retries
+        self.num_busy_retries: int = 0
 
         self.failed = False
 
@@ -31,20 +38,41 @@ class ClientConnector:
     def get_connection_info(self) -> Connection | None:
         return self.connection_info
 
-    def report_receive(self, packet: bytes) -> None:
+    def report_receive(self, packet: bytes | memoryview) -> None:
         if self.is_connected() or self.connect_failed():
             return
-        result = interpret_packet(packet)
-        if result is not None and result[0] == PacketType.ACCEPT:
+        result = decode_packet(packet)
+        if result is not None and result[0] == ACCEPT_TYPE:
             self._manage_accept_packet(result[1])
+        elif result is not None and result[0] == COOKIE_TYPE:
+            self._manage_cookie_packet(result[1], result[2])
+        elif result is not None and result[0] == BUSY_TYPE:
+            self._manage_busy_packet(result[1], result[2])
         # otherwise, ignore packet
 
+    def next_deadline(self) -> int | None:
+        # the earliest time that tick needs to be called, None if connected or failed
+        if self.connection_info is not None or self.failed:
+            return None
+        if self.retry_time is not None:
+            return self.retry_time
+        if self.time_request_sent is None:
+            return self.last_tick_time
+        return self.time_request_sent + self.request_timeout_ms
+
     def tick(self, time_ms: int) -> list[bytes]:
         self.last_tick_time = time_ms
         # Ticks the client forward, returns data to be sent
         if self.connection_info is not None or self.failed:
             return []
 
+        # the server was busy, waiting to retry is not a timeout
+        if self.retry_time is not None:
+            if time_ms < self.retry_time:
+                return []
+            self.retry_time = None
+            return [self._send_request_to_server(time_ms)]
+
         # currently waiting for server response
         # check timeout
         
@@ -68,7 +96,25 @@ class ClientConnector:
             self.failed = True
             return
         self.connection_info = Connection(self.convid, self.last_tick_time, self.init_rtt, self.wait_before_acking)
+
+    def _manage_cookie_packet(self, convid: int, cookie: bytes):
+        # the server wants its cookie echoed before it connects, so the request is sent again on the next tick
+        if convid != self.convid or cookie == self.cookie:
+            return
+        if self.cookie is None:
+            self.num_timeouts -= 1 # the first round trip for a cookie doesn't count as a timeout
+        self.cookie = cookie
+        self.time_request_sent = None
     
+    def _manage_busy_packet(self, convid: int, retry_after_ms: int):
+        if convid != self.convid or self.time_request_sent is None or self.retry_time is not None:
+            return
+        if self.num_busy_retries >= self.max_busy_retries:
+            self.failed = True
+            return
+        self.num_busy_retries += 1
+        self.retry_time = self.last_tick_time + retry_after_ms * self.ticks_per_ms
+
     def _send_request_to_server(self, time: int) -> bytes:
         self.time_request_sent = time
-        return create_request_packet(self.convid)
\ No newline at end of file
+        return create_request_packet(self.convid, self.cookie)
\ No newline at end of file
@@ -59,11 +59,11 @@ def test_client_connection(convid: int, max_timeouts: int, request_timeout_ms: i
                 print('request sent after failing')
                 return False
 
-            result = interpret_packet(packet)
+            result = decode_packet(packet)
             if result is None:
                 print("invalid packet made")
                 return False
-            if result[0] != PacketType.REQUEST:
+            if result[0] != REQUEST_TYPE:
                 print("should be a request packet")
                 return False
             if result[1] != convid:
@@ -162,11 +162,74 @@ def test_receiving_accept_wrong_version():
         assert test_client_connection(version, attempts, timeout, [create_incorrect_version_accept_response(attempts, timeout, version)])
     print('passed')
 
+def test_next_deadline():
+    print('checking the next deadline of the connector')
+    client = ClientConnector(5, 0, 3, 100, 50, 50)
+    assert client.next_deadline() == 100
+    assert client.tick(100) != []
+    assert client.next_deadline() == 200
+    assert client.tick(150) == []
+    assert client.next_deadline() == 200
+    client.report_receive(create_accept_packet(5))
+    assert client.is_connected()
+    assert client.next_deadline() is None
+
+    client = ClientConnector(5, 0, 1, 100, 50, 50)
+    client.tick(100)
+    assert client.next_deadline() == 200
+    client.tick(200)
+    assert client.connect_failed()
+    assert client.next_deadline() is None
+    print('passed')
+
+def test_cookie():
+    print('connecting to server that asks for a cookie')
+    client = ClientConnector(5, 0, 2, 100, 50, 50)
+    assert client.tick(100) == [create_request_packet(5)]
+    client.report_receive(create_cookie_packet(6, b'12345678'))
+    assert client.next_deadline() == 200 # ignored, the convid doesn't match
+    client.report_receive(create_cookie_packet(5, b'12345678'))
+    assert client.next_deadline() == 100 # the request is sent again straight away
+    assert client.tick(120) == [create_request_packet(5, b'12345678')]
+    assert client.tick(220) == [create_request_packet(5, b'12345678')] # the round trip for the cookie didn't use up an attempt
+    client.report_receive(create_accept_packet(5))
+    assert client.is_connected()
+    print('passed')
+
+def test_busy():
+    print('connecting to server that is busy')
+    client = ClientConnector(5, 0, 2, 100, 50, 50, 10)
+    assert client.tick(100) == [create_request_packet(5)]
+    client.report_receive(create_busy_packet(5, 30))
+    assert client.next_deadline() == 400 # 30 ms at 10 ticks per ms
+    assert client.tick(250) == [] # waiting to retry instead of timing out
+    assert client.tick(400) == [create_request_packet(5)]
+    assert client.tick(500) == [create_request_packet(5)] # the wait didn't use up an attempt
+    client.report_receive(create_accept_packet(5))
+    assert client.is_connected()
+
+    print('giving up on a server that stays busy')
+    client = ClientConnector(5, 0, 2, 100, 50, 50, 10, 2)
+    assert client.tick(100) == [create_request_packet(5)]
+    client.report_receive(create_busy_packet(5, 30))
+    client.report_receive(create_busy_packet(5, 60))
+    assert client.next_deadline() == 400 # a duplicate busy packet doesn't change the wait
+    assert client.tick(400) == [create_request_packet(5)]
+    client.report_receive(create_busy_packet(5, 30))
+    assert client.tick(700) == [create_request_packet(5)]
+    client.report_receive(create_busy_packet(5, 30))
+    assert client.connect_failed()
+    assert client.next_deadline() is None and client.tick(1000) == []
+    print('passed')
+
 def main():
     print("----------Starting Client Connection Tests----------")
     test_connecting_to_nothing()
     test_receiving_accept()
     test_receiving_accept_wrong_version()
+    test_next_deadline()
+    test_cookie()
+    test_busy()
     print("----------Finished Client Connection Tests----------")
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+INIT_MAX_SEGMENT_SIZE = 1200
+INIT_WINDOW_SEGMENTS = 10
+MIN_WINDOW_SEGMENTS = 2
+PACING_GAIN = 1.25
+
+# delay based thresholds, in segments queued in the network
+DELAY_ALPHA = 2
+DELAY_BETA = 4
+DELAY_DECREASE_FACTOR = 0.75
+
+
+class CongestionController:
+    # Interface used by Connection to limit the bytes in flight
+    # All times and rtts are in the same units as the connection's tick time
+    def __init__(self, max_segment_size: int = INIT_MAX_SEGMENT_SIZE, initial_window_segments: int = INIT_WINDOW_SEGMENTS):
+        self.max_segment_size: int = max_segment_size
+        self.window: float = max_segment_size * initial_window_segments
+
+    def get_window(self) -> int:
+        # the number of bytes allowed in flight
+        return int(self.window)
+
+    def get_pacing_rate(self, rtt: float) -> float:
+        # the number of bytes that can be sent per unit of time
+        return PACING_GAIN * self.window / max(rtt, 1)
+
+    def report_ack(self, acked_bytes: int, rtt: float | None, time: int):
+        # acked_bytes have left the network, rtt is the round trip time measured by this ack
+        # rtt is None when the ack only covers retransmitted messages, which can't be timed
+        pass
+
+    def report_loss(self, time: int, rtt: float):
+        # a message was detected as lost by duplicate or selective acks
+        pass
+
+    def report_timeout(self, time: int, rtt: float):
+        # a message timed out and is being retransmitted
+        pass
+
+    def _min_window(self) -> int:
+        return self.max_segment_size * MIN_WINDOW_SEGMENTS
+
+
+class NewRenoController(CongestionController):
+    # slow start, then additive increase and multiplicative decrease
+    def __init__(self, max_segment_size: int = INIT_MAX_SEGMENT_SIZE, initial_window_segments: int = INIT_WINDOW_SEGMENTS):
+        super().__init__(max_segment_size, initial_window_segments)
+        self.slow_start_threshold: float | None = None
+        self.recovery_end_time: float | None = None
+
+    def report_ack(self, acked_bytes: int, rtt: float | None, time: int):
+        if self.slow_start_threshold is None or self.window < self.slow_start_threshold:
+            self.window += acked_bytes
+        else:
+            self.window += self.max_segment_size * acked_bytes / self.window
+
+    def report_loss(self, time: int, rtt: float):
+        # only reduce the window once per round trip
+        if self.recovery_end_time is not None and time < self.recovery_end_time:
+            return
+        self.recovery_end_time = time + rtt
+        self.slow_start_threshold = max(self.window / 2, self._min_window())
+        self.window = self.slow_start_threshold
+
+    def report_timeout(self, time: int, rtt: float):
+        if self.recovery_end_time is not None and time < self.recovery_end_time:
+            return
+        self.recovery_end_time = time + rtt
+        self.slow_start_threshold = max(self.window / 2, self._min_window())
+        self.window = self.max_segment_size
+
+
+class DelayBasedController(CongestionController):
+    # compares the expected and actual throughput (as in TCP Vegas) to keep a few segments queued in the network
+    def __init__(self, max_segment_size: int = INIT_MAX_SEGMENT_SIZE, initial_window_segments: int = INIT_WINDOW_SEGMENTS):
+        super().__init__(max_segment_size, initial_window_segments)
+        self.base_rtt: float | None = None
+        self.recovery_end_time: float | None = None
+
+    def report_ack(self, acked_bytes: int, rtt: float | None, time: int):
+        if rtt is None or rtt <= 0:
+            return
+        if self.base_rtt is None or rtt < self.base_rtt:
+            self.base_rtt = rtt
+        # estimate of the number of bytes queued in the network
+        queued = self.window * (rtt - self.base_rtt) / rtt
+        step = self.max_segment_size * acked_bytes / self.window
+        if queued < DELAY_ALPHA * self.max_segment_size:
+            self.window += step
+        elif queued > DELAY_BETA * self.max_segment_size:
+            self.window = max(self.window - step, self._min_window())
+
+    def report_loss(self, time: int, rtt: float):
+        if self.recovery_end_time is not None and time < self.recovery_end_time:
+            return
+        self.recovery_end_time = time + rtt
+        self.window = max(self.window * DELAY_DECREASE_FACTOR, self._min_window())
+
+    def report_timeout(self, time: int, rtt: float):
+        if self.recovery_end_time is not None and time < self.recovery_end_time:
+            return
+        self.recovery_end_time = time + rtt
+        self.window = self._min_window()
@@ -1,16 +1,30 @@
-from packet import interpret_packet, PacketType, create_data_packet, create_accept_packet
+from packet import decode_packet, REQUEST_TYPE, DATA_TYPE, SACK_TYPE, MULTI_TYPE, FRAGMENT_TYPE, CLOSE_TYPE, CLOSE_ACK_TYPE, create_accept_packet, create_close_packet, create_close_ack_packet, create_encoded_data_packet, create_encoded_sack_packet, create_multi_packet, create_encoded_fragment_packet, encode_message, encode_fragment, MAX_SACK_BYTES, MAX_RECORD_SIZE, MULTI_HEADER_SIZE, RECORD_HEADER_SIZE, FRAGMENT_HEADER_SIZE, MAX_FRAGMENTS
+from congestion import CongestionController
+from bufferpool import BufferPool
+from socketcommon import BUFSIZE
+from collections import deque
+from heapq import heappush, heappop
+from typing import Any
 
 INIT_MAX_QUEUE = 200
 INIT_MAX_TIMEOUTS = 5
 INIT_RTT_TEMPERATURE = 0.2
 INIT_DEV_RTT_TEMPERATURE = 0.2
 INIT_DUPLICATE_ACKS_BEFORE_RETRANSMISSION = 3
+INIT_SEND_WINDOW_CAPACITY = 1024
+INIT_MAX_FRAGMENT_SIZE = BUFSIZE - FRAGMENT_HEADER_SIZE - MAX_SACK_BYTES # largest message that is sent without fragmentation
+INIT_MAX_REASSEMBLY_SIZE = 4 * 2 ** 20
+REASSEMBLY_SLOT_OVERHEAD = 48 # bytes held for each fragment slot of a message being reassembled, besides the fragment itself
+MAX_RTO_BACKOFF = 16 # as far as one message can back off before INIT_MAX_TIMEOUTS drops the connection
 
 FIRST_SEND_TIME = 0
 TIME_SENT = 1
 ACK_TIMEOUT = 2
 TIMEOUTS = 3
 MESSAGE = 4
+SACKED = 5
+FRAGMENT = 6
+ENCODED = 7 # the message encoded once for every packet it is sent in (MESSAGE is a view into it)
 
 class Connection:
     def __init__(self, convid: int, time_ms: int, rtt_ms: int, wait_before_acking: int):
@@ -19,24 +33,53 @@ class Connection:
         self.rtt_temperature = INIT_RTT_TEMPERATURE
         self.dev_rtt: float = rtt_ms // 2
         self.dev_rtt_temperature = INIT_DEV_RTT_TEMPERATURE
+        self.rto_backoff: int = 1 # multiplies the retransmission timeout, doubled by timeouts until an rtt sample arrives (RFC 6298)
+        self.rto_backoff_time: int | None = None # when the backoff was last doubled, messages sent before then don't double it again
         self.average_receive_delay = self.rtt / 2
         self.max_receive_queue = INIT_MAX_QUEUE
         self.max_timeouts = INIT_MAX_TIMEOUTS
 
         self.lowest_unreceived_message_number: int = 0
-        self.received_messages: list[bool] = []
-        self.received_data_for_user: list[tuple[int, bytes]] = []
+        self.received_messages: int = 0 # bitset, bit n is set if message (lowest unreceived message number + n) has been received
+        self.received_data_for_user: deque[tuple[int, bytes | memoryview]] = deque()
+        self.buffer_pool: BufferPool | None = None # if set, received messages are views into the pool's buffers instead of copies
+        self.received_view: memoryview | None = None # the last view returned by receive, released on the next receive
+        self.reassembly_buffers: dict[int, list[bytes | None]] = {} # first message number -> fragments received so far
+        self.reassembly_fragments_received: dict[int, int] = {}
+        self.reassembly_reserved: dict[int, int] = {} # first message number -> bytes reserved for the whole message
+        self.reassembly_size: int = 0 # bytes reserved by the reassembly buffers
+        self.max_reassembly_size: int = INIT_MAX_REASSEMBLY_SIZE
         
         self.wait_before_acking: int = wait_before_acking
         self.ack_time: int | None = None
 
         self.lowest_unacked_message_number: int = 0
-        self.unacked_messages: list[tuple[int, int, int, int, bytes]] = [] # (first send time, time sent, ack timeout, timeouts, message)
+        self.next_unsent_message_number: int = 0 # messages from here to the next message number have never been sent
+        self.next_message_number: int = 0
+        self.send_window_capacity: int = INIT_SEND_WINDOW_CAPACITY
+        # ring buffer indexed by message number % capacity, each slot is [first send time, time sent, ack timeout, timeouts, message, sacked, fragment]
+        self.send_window: list[list[Any] | None] = [None] * self.send_window_capacity
+        self.send_backlog: deque[tuple[bytes, tuple[int, int] | None]] = deque() # messages (and fragment index and count) waiting for a free slot in the send window
+        self.max_fragment_size: int = INIT_MAX_FRAGMENT_SIZE
+        self.retransmit_timers: list[tuple[int, int]] = [] # min heap of (ack timeout, message number), entries no longer matching their slot are skipped
         self.duplicate_acks: int | None = None
         self.duplicate_acks_before_retransmission = INIT_DUPLICATE_ACKS_BEFORE_RETRANSMISSION
+        self.selective_acks: bool = False
+        self.max_packet_size: int | None = None
+
+        self.congestion_controller: CongestionController | None = None
+        self.bytes_in_flight: int = 0 # bytes of messages sent at least once, and not yet acknowledged
+        self.pacing_budget: float = 0 # bytes that can be sent before pacing delays new messages
+        self.pacing_time: int = time_ms
 
         self.send_accept: bool = False
 
+        # after close, only a close packet is sent (retransmitted until it is acknowledged or max timeouts is reached)
+        self.closing: bool = False
+        self.close_time: int | None = None # when the close packet is next sent
+        self.close_timeouts: int = 0
+        self.send_close_ack: bool = False # closed by the other endpoint, the acknowledgement is sent on the next tick
+
         self.last_tick_time: int = time_ms
 
         self.connected = True
@@ -59,6 +102,62 @@ class Connection:
     def set_duplicate_acks_before_retransmission(self, duplicate_acks_before_retransmission: int):
         self.duplicate_acks_before_retransmission = duplicate_acks_before_retransmission
 
+    def set_selective_acks(self, selective_acks: bool):
+        # if enabled, acks carry a bitmap of messages received above the cumulative ack
+        self.selective_acks = selective_acks
+
+    def set_max_packet_size(self, max_packet_size: int | None):
+        # if set, messages due in the same tick are coalesced into packets of up to this size
+        self.max_packet_size = max_packet_size
+
+    def set_max_fragment_size(self, max_fragment_size: int):
+        # messages larger than this are split into fragments that are reassembled by the other endpoint
+        self.max_fragment_size = max(max_fragment_size, 1)
+
+    def set_max_reassembly_size(self, max_reassembly_size: int):
+        # limits the bytes held while waiting for the rest of a fragmented message
+        # both endpoints should use the same max fragment size and max reassembly size, larger messages are refused by send
+        self.max_reassembly_size = max_reassembly_size
+
+    def set_buffer_pool(self, buffer_pool: BufferPool | None):
+        # received messages that arrive in views of the pool's buffers are delivered as views, without copying
+        self.buffer_pool = buffer_pool
+
+    def set_congestion_controller(self, congestion_controller: CongestionController | None):
+        # if set, new messages are only sent while the bytes in flight fit in the congestion window, and are paced across ticks
+        self.congestion_controller = congestion_controller
+        if congestion_controller is not None:
+            self.pacing_budget = congestion_controller.get_window()
+            self.pacing_time = self.last_tick_time
+
+    def get_bytes_in_flight(self) -> int:
+        return self.bytes_in_flight
+
+    def set_send_window_capacity(self, capacity: int):
+        # the window can never shrink below the messages currently in flight
+        capacity = max(capacity, self.get_send_window_occupancy(), 1)
+        send_window: list[list[Any] | None] = [None] * capacity
+        for message_number in range(self.lowest_unacked_message_number, self.next_message_number):
+            send_window[message_number % capacity] = self.send_window[message_number % self.send_window_capacity]
+        self.send_window = send_window
+        self.send_window_capacity = capacity
+        self._fill_send_window_from_backlog()
+
+    def get_send_window_capacity(self) -> int:
+        return self.send_window_capacity
+
+    def get_send_window_occupancy(self) -> int:
+        # number of messages sent (or due to be sent) that have not been acknowledged
+        return self.next_message_number - self.lowest_unacked_message_number
+
+    def get_send_backlog_size(self) -> int:
+        # number of messages waiting for space in the send window
+        return len(self.send_backlog)
+
+    def has_received_data(self) -> bool:
+        # true if receive would return a message
+        return len(self.received_data_for_user) > 0
+
     def get_rtt(self) -> float:
         return self.rtt
     
@@ -68,39 +167,103 @@ class Connection:
     def is_connected(self) -> bool:
         return self.connected
 
-    def report_receive(self, packet: bytes):
+    def is_closing(self) -> bool:
+        # true from close until the other endpoint acknowledges it or it times out
+        return self.closing and self.connected
+
+    def close(self):
+        # stops sending data and tells the other endpoint to release the connection, which is disconnected once it acknowledges
+        if not self.connected or self.closing:
+            return
+        self.closing = True
+        self.close_time = self.last_tick_time
+
+    def set_time(self, time_ms: int):
+        # updates the time without ticking, for connections that are only ticked when they have something to send
+        self.last_tick_time = max(self.last_tick_time, time_ms)
+
+    def next_deadline(self) -> int | None:
+        # the earliest time that tick needs to be called to send something, None if nothing is waiting to be sent
+        if not self.connected:
+            return self.last_tick_time if self.send_close_ack else None
+        if self.closing:
+            return self.close_time
+        deadline: int | None = None
+        if self.send_accept:
+            deadline = self.last_tick_time
+        if self.ack_time is not None and (deadline is None or self.ack_time < deadline):
+            deadline = self.ack_time
+        timer = self._peek_retransmit_timer()
+        if timer is not None and (deadline is None or timer < deadline):
+            deadline = timer
+        new_message = self._get_new_message_deadline()
+        if new_message is not None and (deadline is None or new_message < deadline):
+            deadline = new_message
+        return deadline
+
+    def report_receive(self, packet: bytes | memoryview):
         if not self.connected:
             return
         
-        result = interpret_packet(packet)
+        result = decode_packet(packet)
         if result is None:
             return
         type = result[0]
-        match type:
-            case PacketType.REQUEST:
-                # respond to all request packets with an accept, only if the convid matches
-                convid = result[1]
-                if convid == self.convid:
-                    self.send_accept = True
-                else:
-                    # disconnect if it doesn't match
-                    self.connected = False
-                return
-            case PacketType.ACCEPT:
-                # ignore any further request packets
-                return
-            case PacketType.DATA:
-                ack = result[1]
-                message = result[2]
-                self._report_ack_received(ack)
-                if message is not None and not isinstance(message, int):
-                    self._report_message_received(message[0], message[1])
+        if type == CLOSE_TYPE or type == CLOSE_ACK_TYPE:
+            if result[1] == self.convid:
+                # a close is acknowledged even while closing, in case both endpoints closed at once
+                self.send_close_ack = type == CLOSE_TYPE
+                self.connected = False
+            return
+        if self.closing:
+            return # nothing else matters once closed
+        if type == DATA_TYPE:
+            ack = result[1]
+            message = result[2]
+            self._report_ack_received(ack)
+            if message is not None:
+                self._report_message_received(message[0], message[1])
+        elif type == SACK_TYPE:
+            ack = result[1]
+            sack, message = result[2]
+            self._report_ack_received(ack)
+            self._report_selective_ack_received(ack, sack)
+            if message is not None:
+                self._report_message_received(message[0], message[1])
+        elif type == MULTI_TYPE:
+            ack = result[1]
+            sack, messages = result[2]
+            self._report_ack_received(ack)
+            self._report_selective_ack_received(ack, sack)
+            for message_number, message in messages:
+                self._report_message_received(message_number, message)
+        elif type == FRAGMENT_TYPE:
+            ack = result[1]
+            sack, (message_number, fragment_index, fragment_count, fragment) = result[2]
+            self._report_ack_received(ack)
+            self._report_selective_ack_received(ack, sack)
+            self._report_message_received(message_number, fragment, (fragment_index, fragment_count))
+        elif type == REQUEST_TYPE:
+            # respond to all request packets with an accept, only if the convid matches
+            convid = result[1]
+            if convid == self.convid:
+                self.send_accept = True
+            else:
+                # disconnect if it doesn't match
+                self.connected = False
+        # ignore any further accept packets
 
     def tick(self, time_ms: int) -> list[bytes]:
         if not self.connected:
+            if self.send_close_ack:
+                self.send_close_ack = False
+                return [create_close_ack_packet(self.convid)]
             return []
 
         self.last_tick_time = time_ms
+        if self.closing:
+            return self._get_close_packets()
+        self._refill_pacing_budget()
         packets_to_send: list[bytes] = []
         # if an accept needs to be sent, do that
         if self.send_accept:
@@ -115,41 +278,124 @@ class Connection:
         # if no data to send, but an ack needs to be sent anyway -> send an ack
         elif self.ack_time is not None and time_ms >= self.ack_time:
             self.ack_time = None # reset ack time
-            packets_to_send.append(create_data_packet(self.lowest_unreceived_message_number, None))
+            packets_to_send.append(self._create_data_packet(None))
         
         return packets_to_send
 
-    def receive(self) -> tuple[int, bytes] | None:
+    def receive(self) -> tuple[int, bytes | memoryview] | None:
         # Receives new data from the other endpoint
-        if len(self.received_data_for_user) == 0:
+        # with a buffer pool, the returned message may be a view that is only valid until the next call
+        if self.received_view is not None and self.buffer_pool is not None:
+            self.buffer_pool.release(self.received_view)
+        self.received_view = None
+        try:
+            received = self.received_data_for_user.popleft() # the deque may be drained by another thread at the same time
+        except IndexError:
             return None
-        data = self.received_data_for_user[0]
-        self.received_data_for_user.pop(0)
-        return data
+        if isinstance(received[1], memoryview):
+            self.received_view = received[1]
+        return received
     
+    def check_message_size(self, size: int):
+        # raises ValueError if a message of this size can't be sent, so that a send can be checked before it is queued
+        fragment_count = (size + self.max_fragment_size - 1) // self.max_fragment_size
+        if fragment_count <= 1:
+            return
+        if fragment_count > MAX_FRAGMENTS:
+            raise ValueError(f"message of {size} bytes needs more than {MAX_FRAGMENTS} fragments")
+        if self._get_reassembly_reservation(fragment_count) > self.max_reassembly_size:
+            raise ValueError(f"message of {size} bytes does not fit in the reassembly buffers of {self.max_reassembly_size} bytes")
+
     def send(self, message: bytes):
         # Prepares to send data to the other endpoint
-        timeout = self.last_tick_time # send immediately on next tick
-        self.unacked_messages.append((self.last_tick_time, self.last_tick_time, timeout, -1, message))
+        fragment_size = self.max_fragment_size
+        if len(message) <= fragment_size:
+            self._queue_message(message, None)
+            return
+        # too large for one packet -> split into fragments, each with its own message number
+        self.check_message_size(len(message))
+        fragment_count = (len(message) + fragment_size - 1) // fragment_size
+        for fragment_index in range(fragment_count):
+            start = fragment_index * fragment_size
+            self._queue_message(message[start:start + fragment_size], (fragment_index, fragment_count))
+
+    def _queue_message(self, message: bytes, fragment: tuple[int, int] | None):
+        if len(self.send_backlog) > 0 or self.get_send_window_occupancy() >= self.send_window_capacity:
+            self.send_backlog.append((message, fragment))
+            return
+        self._add_to_send_window(message, fragment)
+
+    def _add_to_send_window(self, message: bytes, fragment: tuple[int, int] | None):
+        # sent on the next tick (or once congestion control allows), the ack timeout is set when it is sent
+        if fragment is None:
+            encoded = encode_message(self.next_message_number, message)
+        else:
+            encoded = encode_fragment(self.next_message_number, fragment[0], fragment[1], message)
+        message_view = memoryview(encoded)[len(encoded) - len(message):]
+        self.send_window[self.next_message_number % self.send_window_capacity] = [self.last_tick_time, self.last_tick_time, self.last_tick_time, -1, message_view, False, fragment, encoded]
+        self.next_message_number += 1
+
+    def _fill_send_window_from_backlog(self):
+        while len(self.send_backlog) > 0 and self.get_send_window_occupancy() < self.send_window_capacity:
+            self._add_to_send_window(*self.send_backlog.popleft())
+
+    def _get_send_slot(self, message_number: int) -> list[Any]:
+        return self.send_window[message_number % self.send_window_capacity] # type: ignore
+
+    def _set_ack_timeout(self, message_number: int, slot: list[Any], ack_timeout: int):
+        slot[ACK_TIMEOUT] = ack_timeout
+        heappush(self.retransmit_timers, (ack_timeout, message_number))
+
+    def _is_timer_valid(self, ack_timeout: int, message_number: int) -> bool:
+        if message_number < self.lowest_unacked_message_number or message_number >= self.next_unsent_message_number:
+            return False # already acknowledged
+        slot = self._get_send_slot(message_number)
+        return slot[ACK_TIMEOUT] == ack_timeout and not slot[SACKED]
+
+    def _peek_retransmit_timer(self) -> int | None:
+        # discard timers that are no longer valid
+        while len(self.retransmit_timers) > 0 and not self._is_timer_valid(*self.retransmit_timers[0]):
+            heappop(self.retransmit_timers)
+        return self.retransmit_timers[0][0] if len(self.retransmit_timers) > 0 else None
+
+    def _get_new_message_deadline(self) -> int | None:
+        if self.next_unsent_message_number >= self.next_message_number:
+            return None
+        if self.congestion_controller is None:
+            return self.last_tick_time
+        message = self._get_send_slot(self.next_unsent_message_number)[MESSAGE]
+        if self.bytes_in_flight > 0 and self.bytes_in_flight + len(message) > self.congestion_controller.get_window():
+            return None # waiting for an ack
+        if self.pacing_budget > 0:
+            return self.last_tick_time
+        # wait until the pacing budget is refilled
+        rate = self.congestion_controller.get_pacing_rate(self.rtt)
+        return self.pacing_time + int(-self.pacing_budget / rate) + 1
 
     def _report_rtt_estimate(self, rtt: int):
         self.rtt = rtt * self.rtt_temperature + (1 - self.rtt_temperature) * self.rtt
         self.dev_rtt = abs(rtt - self.rtt) * self.dev_rtt_temperature + (1 - self.dev_rtt_temperature) * self.dev_rtt
+        self.rto_backoff = 1 # the estimate is valid again
+        self.rto_backoff_time = None
 
     def _manage_duplicate_ack(self):
-        if len(self.unacked_messages) == 0: # if no messages are being sent -> ignore
+        if self.get_send_window_occupancy() == 0: # if no messages are being sent -> ignore
             return
-        if self.last_tick_time >= self.unacked_messages[0][TIME_SENT] + self.rtt: # if it's been at least 1 rtt since it was sent -> duplicate
+        slot = self._get_send_slot(self.lowest_unacked_message_number)
+        if self.last_tick_time >= slot[TIME_SENT] + self.rtt: # if it's been at least 1 rtt since it was sent -> duplicate
             # increment number of duplicate acks
             if self.duplicate_acks is None:
                 self.duplicate_acks = 1
             else:
                 self.duplicate_acks += 1
             # check if reached threshold (fast retransmit)
-            if self.duplicate_acks >= self.duplicate_acks_before_retransmission:
+            if self.duplicate_acks >= self.duplicate_acks_before_retransmission and slot[TIMEOUTS] >= 0:
                 # reset duplicate acks and make the message retransmit immediately (fast retransmit)
                 self.duplicate_acks = None
-                self.unacked_messages[0] = (self.unacked_messages[0][FIRST_SEND_TIME], self.last_tick_time, self.last_tick_time, self.unacked_messages[0][TIMEOUTS], self.unacked_messages[0][MESSAGE])
+                slot[TIME_SENT] = self.last_tick_time
+                self._set_ack_timeout(self.lowest_unacked_message_number, slot, self.last_tick_time)
+                if self.congestion_controller is not None:
+                    self.congestion_controller.report_loss(self.last_tick_time, self.rtt)
 
     def _report_ack_received(self, ack: int):
         if ack == self.lowest_unacked_message_number:
@@ -157,24 +403,158 @@ class Connection:
         if ack <= self.lowest_unacked_message_number:
             return # already received ack
         
-        num_to_ack = ack - self.lowest_unacked_message_number
-        highest_time_sent: int | None = None
+        # cannot acknowledge messages that have not been sent
+        num_to_ack = min(ack, self.next_message_number) - self.lowest_unacked_message_number
+        if num_to_ack <= 0:
+            return
+        sample_time: int | None = None
+        acked_bytes = 0
         for _ in range(num_to_ack):
-            if len(self.unacked_messages) == 0:
-                break
-            # remove from unacked messages, and increment the lowest unacked message number
+            # release the slot, and increment the lowest unacked message number
+            index = self.lowest_unacked_message_number % self.send_window_capacity
+            slot: list[Any] = self.send_window[index] # type: ignore
+            sample_time = self._get_rtt_sample_time(slot, sample_time)
+            acked_bytes += self._get_bytes_in_flight_of(slot)
+            self.send_window[index] = None
             self.lowest_unacked_message_number += 1
-            time, _, _, _, _ = self.unacked_messages.pop(0)
-            # find the lowest time a packet was sent (to estimate rtt)
-            if highest_time_sent is None or time < highest_time_sent:
-                highest_time_sent = time
-        if highest_time_sent is None:
-            return
+            self.next_unsent_message_number = max(self.next_unsent_message_number, self.lowest_unacked_message_number)
+        self.bytes_in_flight -= acked_bytes
+        # freed slots can be used by messages waiting in the backlog
+        self._fill_send_window_from_backlog()
         # reset duplicate acks
         self.duplicate_acks = None
         # report the rtt found
-        self._report_rtt_estimate(self.last_tick_time - highest_time_sent)
+        rtt: int | None = None
+        if sample_time is not None:
+            rtt = self.last_tick_time - sample_time
+            self._report_rtt_estimate(rtt)
+        if self.congestion_controller is not None and acked_bytes > 0:
+            self.congestion_controller.report_ack(acked_bytes, rtt, self.last_tick_time)
+
+    def _get_rtt_sample_time(self, slot: list[Any], sample_time: int | None) -> int | None:
+        # the lowest time an acked message was sent, only counting messages that were sent once (Karn's rule)
+        # an ack for a retransmitted message can't tell which transmission it acknowledges, so it can't give an rtt
+        if slot[TIMEOUTS] != 0 or slot[SACKED]:
+            return sample_time
+        if sample_time is None or slot[FIRST_SEND_TIME] < sample_time:
+            return slot[FIRST_SEND_TIME]
+        return sample_time
+
+
+    def _report_selective_ack_received(self, ack: int, sack: int):
+        if sack == 0:
+            return
+        # mark all selectively acknowledged messages, so that they are not retransmitted
+        remaining = sack
+        acked_bytes = 0
+        sample_time: int | None = None
+        while remaining != 0:
+            lowest_bit = remaining & -remaining
+            remaining ^= lowest_bit
+            message_number = ack + lowest_bit.bit_length()
+            if self.lowest_unacked_message_number <= message_number < self.next_message_number:
+                slot = self._get_send_slot(message_number)
+                sample_time = self._get_rtt_sample_time(slot, sample_time)
+                acked_bytes += self._get_bytes_in_flight_of(slot)
+                slot[SACKED] = True
+        self.bytes_in_flight -= acked_bytes
+        if self.congestion_controller is not None and acked_bytes > 0:
+            rtt = self.last_tick_time - sample_time if sample_time is not None else None
+            self.congestion_controller.report_ack(acked_bytes, rtt, self.last_tick_time)
+        # a hole with enough messages received above it is considered lost -> retransmit it immediately (at most once per rtt)
+        highest_sacked_message_number = min(ack + sack.bit_length(), self.next_message_number - 1)
+        sacked_above = 0
+        lost = False
+        for message_number in range(highest_sacked_message_number, self.lowest_unacked_message_number - 1, -1):
+            slot = self._get_send_slot(message_number)
+            if slot[SACKED]:
+                sacked_above += 1
+            elif sacked_above >= self.duplicate_acks_before_retransmission and slot[TIMEOUTS] >= 0 and self.last_tick_time >= slot[TIME_SENT] + self.rtt:
+                slot[TIME_SENT] = self.last_tick_time
+                self._set_ack_timeout(message_number, slot, self.last_tick_time)
+                lost = True
+        if lost and self.congestion_controller is not None:
+            self.congestion_controller.report_loss(self.last_tick_time, self.rtt)
+
+    def _get_bytes_in_flight_of(self, slot: list[Any]) -> int:
+        # messages only count as in flight once they have been sent, until they are acknowledged
+        if slot[TIMEOUTS] < 0 or slot[SACKED]:
+            return 0
+        return len(slot[MESSAGE])
+
+    def _refill_pacing_budget(self):
+        if self.congestion_controller is None:
+            return
+        elapsed = self.last_tick_time - self.pacing_time
+        self.pacing_time = self.last_tick_time
+        rate = self.congestion_controller.get_pacing_rate(self.rtt)
+        self.pacing_budget = min(self.pacing_budget + elapsed * rate, self.congestion_controller.get_window())
+
+    def _can_send_new_message(self, message: bytes) -> bool:
+        if self.congestion_controller is None:
+            return True
+        if self.pacing_budget <= 0:
+            return False
+        # always allow one message in flight, so that messages larger than the window can still be sent
+        return self.bytes_in_flight == 0 or self.bytes_in_flight + len(message) <= self.congestion_controller.get_window()
+
+    def _get_sack(self) -> int:
+        # bit 0 of the receive window is always the lowest unreceived message, so the sack starts at bit 1
+        if not self.selective_acks:
+            return 0
+        return (self.received_messages >> 1) & ((1 << (8 * MAX_SACK_BYTES)) - 1)
+
+    def _create_data_packet(self, encoded_message: bytes | None) -> bytes:
+        # encoded_message is None for a packet that only acknowledges
+        encoded_message = encoded_message if encoded_message is not None else b''
+        sack = self._get_sack()
+        if sack != 0:
+            return create_encoded_sack_packet(self.lowest_unreceived_message_number, sack, encoded_message)
+        return create_encoded_data_packet(self.lowest_unreceived_message_number, encoded_message)
+
+    def _create_fragment_packet(self, encoded_fragment: bytes) -> bytes:
+        return create_encoded_fragment_packet(self.lowest_unreceived_message_number, self._get_sack(), encoded_fragment)
+
+    def _create_single_packet(self, slot: list[Any]) -> bytes:
+        if slot[FRAGMENT] is not None:
+            return self._create_fragment_packet(slot[ENCODED])
+        return self._create_data_packet(slot[ENCODED])
+
+    def _create_data_packets(self, messages: list[tuple[int, list[Any]]]) -> list[bytes]:
+        # messages are (message number, send slot) in message number order, the packets keep that order
+        if self.max_packet_size is None:
+            return [self._create_single_packet(slot) for _, slot in messages]
+        # pack as many messages as possible into each packet
+        sack = self._get_sack()
+        header_size = MULTI_HEADER_SIZE + (sack.bit_length() + 7) // 8
+        packets: list[bytes] = []
+        records: list[tuple[int, list[Any]]] = []
+        size = header_size
+        for message in messages:
+            slot = message[1]
+            record_size = RECORD_HEADER_SIZE + len(slot[MESSAGE])
+            if slot[FRAGMENT] is not None or header_size + record_size > self.max_packet_size or len(slot[MESSAGE]) > MAX_RECORD_SIZE:
+                # a fragment or a message that does not fit in a multi packet -> send on its own, after the messages before it
+                if len(records) > 0:
+                    packets.append(self._create_coalesced_packet(sack, records))
+                    records = []
+                    size = header_size
+                packets.append(self._create_single_packet(slot))
+                continue
+            if size + record_size > self.max_packet_size:
+                packets.append(self._create_coalesced_packet(sack, records))
+                records = []
+                size = header_size
+            records.append(message)
+            size += record_size
+        if len(records) > 0:
+            packets.append(self._create_coalesced_packet(sack, records))
+        return packets
 
+    def _create_coalesced_packet(self, sack: int, records: list[tuple[int, list[Any]]]) -> bytes:
+        if len(records) == 1:
+            return self._create_data_packet(records[0][1][ENCODED])
+        return create_multi_packet(self.lowest_unreceived_message_number, sack, [(message_number, slot[MESSAGE]) for message_number, slot in records])
 
     def _report_must_send_ack(self):
         # set ack time if there is no expected ack
@@ -182,57 +562,172 @@ class Connection:
             self.ack_time = self.last_tick_time + self.wait_before_acking
         # otherwise, the ack time is already set -> do not need to change
 
-    def _report_message_received(self, message_number: int, message: bytes):
+    def _report_message_received(self, message_number: int, message: bytes | memoryview, fragment: tuple[int, int] | None = None):
         if message_number < self.lowest_unreceived_message_number:
             self._report_must_send_ack()
             return # already received -> ignore
         relative_message_number = message_number - self.lowest_unreceived_message_number
         if relative_message_number >= self.max_receive_queue:
             return # too far ahead
-        # extend list of unreceived message records if needed
-        if relative_message_number >= len(self.received_messages):
-            self.received_messages.extend([False] * (relative_message_number - len(self.received_messages) + 1))
         # check if the message has been received
-        if self.received_messages[relative_message_number]:
+        message_bit = 1 << relative_message_number
+        if self.received_messages & message_bit:
             self._report_must_send_ack()
             return # already received -> ignore
         # it is a new message -> mark it as such and add it to the received data
-        self.received_messages[relative_message_number] = True
-        self.received_data_for_user.append((message_number, message))
+        if fragment is None:
+            self.received_data_for_user.append((message_number, self._keep_message(message)))
+        elif not self._report_fragment_received(message_number, message, fragment):
+            return # no space to reassemble it -> ignore, the other endpoint will retransmit it
+        self.received_messages |= message_bit
         if relative_message_number != 0:
             self._report_must_send_ack()
             return
         # the next required message has been received
-        # remove all sequentially received messages from the list
+        # shift out all sequentially received messages (the run of set low bits)
         self._report_must_send_ack()
-        while len(self.received_messages) > 0 and self.received_messages[0]:
-            self.received_messages.pop(0)
-            self.lowest_unreceived_message_number += 1
+        num_received = (~self.received_messages & (self.received_messages + 1)).bit_length() - 1
+        self.received_messages >>= num_received
+        self.lowest_unreceived_message_number += num_received
+        if len(self.reassembly_buffers) > 0:
+            self._evict_stale_reassembly_buffers(message_number)
     
+    def _keep_message(self, message: bytes | memoryview) -> bytes | memoryview:
+        # a view into a pooled receive buffer holds on to the buffer until it is received, otherwise it is copied out
+        if not isinstance(message, memoryview):
+            return message
+        if self.buffer_pool is None:
+            return bytes(message)
+        self.buffer_pool.retain(message)
+        return message
+
+    def _get_reassembly_reservation(self, fragment_count: int) -> int:
+        # the most a message of this many fragments can hold while it is reassembled
+        return fragment_count * (self.max_fragment_size + REASSEMBLY_SLOT_OVERHEAD)
+
+    def _report_fragment_received(self, message_number: int, fragment: bytes | memoryview, fragment_info: tuple[int, int]) -> bool:
+        # returns false if the fragment could not be accepted
+        fragment_index, fragment_count = fragment_info
+        if len(fragment) > self.max_fragment_size:
+            return False # larger than any fragment the other endpoint sends
+        first_message_number = message_number - fragment_index
+        fragments: list[bytes | None] | None = self.reassembly_buffers.get(first_message_number)
+        if fragments is not None and len(fragments) != fragment_count:
+            # does not match the other fragments -> the message they belong to can never be completed
+            self._remove_reassembly_buffer(first_message_number)
+            fragments = None
+        if fragments is None:
+            if first_message_number < self.lowest_unreceived_message_number:
+                return False # the first fragment was received as another message (or is gone) -> can never be completed
+            if fragment_count > 1:
+                # the whole message is reserved up front, so its other fragments are always accepted
+                # only accept if there is space, unless it is the next required message (which must always be able to complete)
+                reserved = self._get_reassembly_reservation(fragment_count)
+                if reserved > self.max_reassembly_size:
+                    return False # can never fit
+                if self.reassembly_size + reserved > self.max_reassembly_size and first_message_number != self.lowest_unreceived_message_number:
+                    return False
+                fragments = [None for _ in range(fragment_count)]
+                self.reassembly_buffers[first_message_number] = fragments
+                self.reassembly_fragments_received[first_message_number] = 0
+                self.reassembly_reserved[first_message_number] = reserved
+                self.reassembly_size += reserved
+            else:
+                fragments = [None]
+        fragments_received = self.reassembly_fragments_received.get(first_message_number, 0) + 1
+        if fragments_received < fragment_count:
+            fragments[fragment_index] = bytes(fragment) # copied out of the receive buffer while waiting for the rest
+            self.reassembly_fragments_received[first_message_number] = fragments_received
+            return True
+        # all fragments received -> reassemble the message
+        if first_message_number in self.reassembly_buffers:
+            self._remove_reassembly_buffer(first_message_number)
+        parts = [fragment if index == fragment_index else part for index, part in enumerate(fragments)]
+        received_parts = [part for part in parts if part is not None]
+        if len(received_parts) != fragment_count:
+            return False # every other fragment was received, so this can't happen
+        self.received_data_for_user.append((first_message_number, b''.join(received_parts)))
+        return True
+
+    def _remove_reassembly_buffer(self, first_message_number: int):
+        self.reassembly_buffers.pop(first_message_number)
+        self.reassembly_fragments_received.pop(first_message_number)
+        self.reassembly_size -= self.reassembly_reserved.pop(first_message_number)
+
+    def _evict_stale_reassembly_buffers(self, start: int):
+        # the message numbers from start to the lowest unreceived message number have just been received
+        # a message that is missing a fragment among them had it taken by another message -> it can never be completed
+        for first_message_number, fragments in list(self.reassembly_buffers.items()):
+            first_index = max(start - first_message_number, 0)
+            end_index = min(self.lowest_unreceived_message_number - first_message_number, len(fragments))
+            if first_index < end_index and None in fragments[first_index:end_index]:
+                self._remove_reassembly_buffer(first_message_number)
+
+    def _get_close_packets(self) -> list[bytes]:
+        if self.close_time is None or self.last_tick_time < self.close_time:
+            return []
+        if self.close_timeouts >= self.max_timeouts:
+            # never acknowledged -> give up
+            self.connected = False
+            return []
+        self.close_timeouts += 1
+        self.close_time = self._calculate_ack_timeout()
+        return [create_close_packet(self.convid)]
+
+    def _back_off(self, slot: list[Any]):
+        # the rtt may have grown beyond the timeout, then every message would time out and none would be left to give an rtt sample
+        # only a message sent with the current backoff doubles it, like the single retransmission timer of RFC 6298
+        if self.rto_backoff_time is not None and slot[TIME_SENT] < self.rto_backoff_time:
+            return
+        self.rto_backoff = min(2 * self.rto_backoff, MAX_RTO_BACKOFF)
+        self.rto_backoff_time = self.last_tick_time
+
     def _calculate_ack_timeout(self) -> int:
-        return int(self.last_tick_time + (self.rtt + 4 * self.dev_rtt))
+        return int(self.last_tick_time + (self.rtt + 4 * self.dev_rtt) * self.rto_backoff)
     
     def _manage_and_get_timeout_packets(self) -> list[bytes]:
-        packets_to_send: list[bytes] = []
-        timeout_messages: list[int] = []
-
-        # go through all messages and check for timeouts -> if so, prepare to retransmit
-        for i, message_info in enumerate(self.unacked_messages):
-            if self.last_tick_time >= message_info[ACK_TIMEOUT]:
-                timeout_messages.append(i)
-                message_number = i + self.lowest_unacked_message_number
-                message = message_info[MESSAGE]
-                data = create_data_packet(self.lowest_unreceived_message_number, (message_number, message))
-                packets_to_send.append(data)
-        
-        # go through all timeout messages, reset timeout, and incremenet number of timeouts
-        for i in timeout_messages:
-            first_send_time, _, _, timeouts, message = self.unacked_messages[i]
-            timeouts += 1
-            if timeouts >= self.max_timeouts:
+        due_message_numbers: list[int] = []
+        timed_out = False
+
+        # go through all messages whose ack timeout has passed -> increment number of timeouts and prepare to retransmit
+        while len(self.retransmit_timers) > 0 and self.retransmit_timers[0][0] <= self.last_tick_time:
+            ack_timeout, message_number = heappop(self.retransmit_timers)
+            if not self._is_timer_valid(ack_timeout, message_number):
+                continue
+            slot = self._get_send_slot(message_number)
+            slot[ACK_TIMEOUT] = None # invalidate any duplicate timers until the new timeout is set
+            slot[TIMEOUTS] += 1
+            if slot[TIME_SENT] < ack_timeout:
+                timed_out = True # not a fast retransmit
+                self._back_off(slot)
+            if slot[TIMEOUTS] >= self.max_timeouts:
                 # too many timeouts -> close connection
                 self.connected = False
                 return []
-            self.unacked_messages[i] = (first_send_time, self.last_tick_time, self._calculate_ack_timeout(), timeouts, message)
+            due_message_numbers.append(message_number)
+
+        # send new messages, limited by congestion control (retransmissions are not limited, they are already in flight)
+        while self.next_unsent_message_number < self.next_message_number:
+            slot = self._get_send_slot(self.next_unsent_message_number)
+            if not self._can_send_new_message(slot[MESSAGE]):
+                break
+            self.bytes_in_flight += len(slot[MESSAGE])
+            self.pacing_budget -= len(slot[MESSAGE])
+            slot[FIRST_SEND_TIME] = self.last_tick_time
+            slot[TIMEOUTS] = 0
+            due_message_numbers.append(self.next_unsent_message_number)
+            self.next_unsent_message_number += 1
+
+        # reset timeouts (after all due timers have been taken, in case the new timeout has already passed)
+        messages_to_send: list[tuple[int, list[Any]]] = []
+        ack_timeout = self._calculate_ack_timeout()
+        due_message_numbers.sort()
+        for message_number in due_message_numbers:
+            slot = self._get_send_slot(message_number)
+            slot[TIME_SENT] = self.last_tick_time
+            self._set_ack_timeout(message_number, slot, ack_timeout)
+            messages_to_send.append((message_number, slot))
         
-        return packets_to_send
\ No newline at end of file
+        if timed_out and self.congestion_controller is not None:
+            self.congestion_controller.report_timeout(self.last_tick_time, self.rtt)
+        return self._create_data_packets(messages_to_send)
\ No newline at end of file
@@ -1,6 +1,9 @@
-from connection import Connection
-from packet import create_accept_packet, create_request_packet, create_data_packet
+from connection import Connection, MAX_RTO_BACKOFF
+from packet import create_accept_packet, create_request_packet, create_data_packet, create_sack_packet, create_multi_packet, create_fragment_packet, create_close_packet, create_close_ack_packet
+from congestion import NewRenoController, DelayBasedController
+from bufferpool import BufferPool
 from random import randint
+from heapq import heappush, heappop
 
 alphabet = 'abcdefghijklmnopqrstuvwxyz'
 
@@ -236,6 +239,9 @@ def test_receive_valid_messages():
     test_data_messages([[(201, b'201', False)],[(1,b'1',True)],[(201, b'201', False)]], 200)
     test_data_messages([[(1, b'1', False)],[(0,b'0',True)],[(1, b'1', True)]], 1)
     test_data_messages([[(1, b'1', True)],[(0,b'0',True)],[(1, b'1', False)]], 2)
+    print('testing a large receive queue')
+    test_data_messages([[(n, str(n).encode(), True) for n in reversed(range(1000))], [(n, str(n).encode(), False) for n in range(1000)]], 1000)
+    test_data_messages([[(n, str(n).encode(), n < 1000) for n in range(1, 2000, 2)], [(n, str(n).encode(), True) for n in range(0, 2000, 2)]], 1000)
     print("-completed testing receiving valid messages")
 
 def test_ack_waiting():
@@ -273,18 +279,41 @@ def test_ack_waiting():
 def calculate_ack_time(rtt: int, dev_rtt: int) -> int:
         return rtt + 4 * dev_rtt
 
+def calculate_backoff_time(rtt: int, dev_rtt: int, timeouts: int) -> int:
+    # the time from the first send of a message to its timeouts-th timeout, the timeout doubles after each one
+    return calculate_ack_time(rtt, dev_rtt) * (2 ** timeouts - 1)
+
 def create_retransmission_test_without_acks(times: list[int], rtt: int, max_timeouts: int, test_time: int):
+    # without acks there is no rtt sample, so the timeout of every message sent after a timeout is backed off
+    # a timeout doubles the backoff if the message was sent with the current backoff
     times.sort()
     send_events = [(time, generate_random_data()) for time in times]
     ack_time = calculate_ack_time(rtt, rtt // 2)
     expect_events: list[tuple[int, bytes]] = []
     fail_time: int | None = None
-    for message_number, (time, message) in enumerate(send_events):
-        this_fail_time = time + ack_time * max_timeouts
-        if fail_time is None or this_fail_time < fail_time:
-            fail_time = this_fail_time
-        for n in range(max_timeouts):
-            expect_events.append((time + n * ack_time, create_data_packet(0, (message_number, message))))
+    backoff = 1
+    backoff_time = 0
+    timers: list[tuple[int, int, int, int]] = [] # heap of (timeout, message number, time sent, timeouts)
+    next_message_number = 0
+    time = 0
+    while fail_time is None and (next_message_number < len(send_events) or len(timers) > 0):
+        due: list[tuple[int, int]] = []
+        while fail_time is None and len(timers) > 0 and timers[0][0] <= time:
+            _, message_number, time_sent, timeouts = heappop(timers)
+            if time_sent >= backoff_time:
+                backoff = min(2 * backoff, MAX_RTO_BACKOFF)
+                backoff_time = time
+            if timeouts + 1 >= max_timeouts:
+                fail_time = time
+            due.append((message_number, timeouts + 1))
+        while next_message_number < len(send_events) and send_events[next_message_number][0] <= time:
+            due.append((next_message_number, 0))
+            next_message_number += 1
+        if fail_time is None:
+            for message_number, timeouts in due:
+                expect_events.append((time, create_data_packet(0, (message_number, send_events[message_number][1]))))
+                heappush(timers, (time + ack_time * backoff, message_number, time, timeouts))
+        time += 1
     test_unacknowledged_retransmissions(send_events, expect_events, test_time, rtt, max_timeouts, fail_time)
 
 
@@ -297,17 +326,19 @@ def test_retransmissions_without_acks():
     print ('testing one message sent')
     test_unacknowledged_retransmissions([(0, b'0')], [(0, create_data_packet(0, (0, b'0')))], 50, 10, 1, calculate_ack_time(10, 5))
     test_unacknowledged_retransmissions([(10, b'10')], [(10, create_data_packet(0, (0, b'10')))], 100, 30, 1, 10 + calculate_ack_time(30, 15))
-    test_unacknowledged_retransmissions([(0, b'0')], [(0, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 2, 2 * calculate_ack_time(10, 5))
+    test_unacknowledged_retransmissions([(0, b'0')], [(0, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 2, calculate_backoff_time(10, 5, 2))
     test_unacknowledged_retransmissions([(0, b'0')], [(0, create_data_packet(0, (0, b'0'))),
-                                                      (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0'))),
-                                                      (2 * calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 200, 10, 3, 3 * calculate_ack_time(10, 5))
+                                                      (calculate_backoff_time(10, 5, 1), create_data_packet(0, (0, b'0'))),
+                                                      (calculate_backoff_time(10, 5, 2), create_data_packet(0, (0, b'0')))], 250, 10, 3, calculate_backoff_time(10, 5, 3))
     create_retransmission_test_without_acks([0], 10, 5, 500)
     create_retransmission_test_without_acks([10], 30, 10, 1000)
     print ('testing multiple message sent')
     test_unacknowledged_retransmissions([(0, b'0'), (1, b'1')], [(0, create_data_packet(0, (0, b'0'))), (1, create_data_packet(0, (1, b'1')))], 50, 10, 1, calculate_ack_time(10, 5))
-    test_unacknowledged_retransmissions([(0, b'0'), (1, b'1')], [(0, create_data_packet(0, (0, b'0'))), (1, create_data_packet(0, (1, b'1'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0'))), (1 + calculate_ack_time(10, 5), create_data_packet(0, (1, b'1')))], 50, 10, 2, 2 * calculate_ack_time(10, 5))
+    test_unacknowledged_retransmissions([(0, b'0'), (1, b'1')], [(0, create_data_packet(0, (0, b'0'))), (1, create_data_packet(0, (1, b'1'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0'))), (1 + calculate_ack_time(10, 5), create_data_packet(0, (1, b'1')))], 100, 10, 2, calculate_backoff_time(10, 5, 2))
     create_retransmission_test_without_acks([0, 10, 20], 10, 5, 500)
     create_retransmission_test_without_acks([0, 1, 2, 30, 100, 500], 30, 10, 1000)
+    print('testing messages sent after a timeout use the backed off timeout')
+    create_retransmission_test_without_acks([0, 40, 41, 200], 10, 5, 1000)
     print("-completed testing retransmissions without acks")
 
 def test_acknowledgements():
@@ -319,20 +350,84 @@ def test_acknowledgements():
     test_acknowledged_messages([(10, create_request_packet(100))], [], [(10, create_accept_packet(100))], 100, 10, 5, None, 0.2, 10, 3, 100)
     test_acknowledged_messages([(10, create_request_packet(100))], [], [], 100, 10, 5, 10, 0.2, 10, 3, 50)
     print('testing a message sent that is retransmitted and then acknowledged')
-    test_acknowledged_messages([(10 + calculate_ack_time(10, 5) + 1, create_data_packet(1, None))], [(0, b'0')], [(0, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 5, None, 0.5, 25)
+    # the ack can be for either transmission, so it gives no rtt sample and the initial rtt is kept (Karn's rule)
+    test_acknowledged_messages([(10 + calculate_ack_time(10, 5) + 1, create_data_packet(1, None))], [(0, b'0')], [(0, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 5, None, 0.5, 10)
     print('testing two messages which are cumulatively acknowledged')
     test_acknowledged_messages([(5 + 1, create_data_packet(2, None))], [(0, b'0'), (0, b'1')], [(0, create_data_packet(0, (0, b'0'))), (0, create_data_packet(0, (1, b'1')))], 100, 10, 5, None, 0.5, 7.5)
     test_acknowledged_messages([(10 + 1, create_data_packet(2, None))], [(0, b'0'), (5, b'1')], [(0, create_data_packet(0, (0, b'0'))), (5, create_data_packet(0, (1, b'1')))], 100, 10, 5, None, 0.5, 10)
     print('testing two messages, which are cumulatively acknowledged after the first is retransmitted')
-    test_acknowledged_messages([(5 + calculate_ack_time(10, 5) + 1, create_data_packet(2, None))], [(0, b'0'), (10, b'1')], [(0, create_data_packet(0, (0, b'0'))), (10, create_data_packet(0, (1, b'1'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 5, None, 0.5, 22.5)
+    # only the second message was sent once, it was sent at 10 and acknowledged at 5 + ack time
+    test_acknowledged_messages([(5 + calculate_ack_time(10, 5) + 1, create_data_packet(2, None))], [(0, b'0'), (10, b'1')], [(0, create_data_packet(0, (0, b'0'))), (10, create_data_packet(0, (1, b'1'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 5, None, 0.5, 0.5 * (5 + calculate_ack_time(10, 5) - 10) + 0.5 * 10)
     print('testing a message which is not acknowledged at first but then is')
-    test_acknowledged_messages([(10 + 1, create_data_packet(0, None)), (10 + calculate_ack_time(10, 5) + 1, create_data_packet(1, None))], [(0, b'0')], [(0, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 5, None, 0.5, 25)
+    # acknowledged after its retransmission, so there is no rtt sample
+    test_acknowledged_messages([(10 + 1, create_data_packet(0, None)), (10 + calculate_ack_time(10, 5) + 1, create_data_packet(1, None))], [(0, b'0')], [(0, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (0, b'0')))], 100, 10, 5, None, 0.5, 10)
     print('testing receiving an ack without anything sent')
     test_acknowledged_messages([(10, create_data_packet(1, None))], [], [], 100, 10, 5, None, 0.5, 10)
     print('testing receiving two separate acks for two messages')
     test_acknowledged_messages([(6 + 1, create_data_packet(1, None)), (9 + 1, create_data_packet(2, None))], [(0, b'0'), (3, b'1')], [(0, create_data_packet(0, (0, b'0'))), (3, create_data_packet(0, (1, b'1')))], 100, 10, 5, None, 0.5, 7.5)
     print("-completed testing acknowledgements")
 
+def test_retransmission_backoff():
+    print("-testing retransmission backoff")
+    ack_time = calculate_ack_time(10, 5)
+    print('testing the timeout doubles after each timeout')
+    client = Connection(0, 0, 10, 50)
+    client.send(b'0')
+    client.tick(0)
+    assert client.tick(ack_time) == [create_data_packet(0, (0, b'0'))]
+    assert client.next_deadline() == ack_time + 2 * ack_time
+    assert client.tick(3 * ack_time) == [create_data_packet(0, (0, b'0'))]
+    assert client.next_deadline() == 3 * ack_time + 4 * ack_time
+    print('testing the backoff is kept until a message sent once is acknowledged')
+    client.set_time(3 * ack_time + 1)
+    client.report_receive(create_data_packet(1, None))
+    assert client.get_rtt() == 10
+    client.send(b'1')
+    client.tick(100)
+    assert client.next_deadline() == 100 + 4 * ack_time # new messages are sent with the backed off timeout
+    client.set_time(104)
+    client.report_receive(create_data_packet(2, None))
+    assert client.get_rtt() < 10
+    client.send(b'2')
+    client.tick(110)
+    assert client.next_deadline() == int(110 + client.get_rtt() + 4 * client.get_dev_rtt())
+    print('testing fast retransmits do not back off')
+    client = Connection(0, 0, 10, 50)
+    client.send(b'0')
+    client.tick(0)
+    for _ in range(3):
+        client.report_receive(create_data_packet(0, None))
+    client.set_time(10)
+    for _ in range(3):
+        client.report_receive(create_data_packet(0, None))
+    assert client.tick(10) == [create_data_packet(0, (0, b'0'))]
+    assert client.next_deadline() == 10 + ack_time
+    print('testing the rtt follows a growing delay')
+    # two connections over a link whose delay grows from 1 to 5 ticks each way after the rtt has settled
+    client = Connection(0, 0, 2, 0)
+    server = Connection(0, 0, 2, 0)
+    in_flight: list[tuple[int, Connection, bytes]] = []
+    packets_sent = 0
+    for time in range(4000):
+        delay = 1 if time < 1000 else 5
+        if time % 5 == 0 and time < 3000:
+            client.send(b'%d' % time)
+        for packet in client.tick(time):
+            packets_sent += 1
+            in_flight.append((time + delay, server, packet))
+        for packet in server.tick(time):
+            in_flight.append((time + delay, client, packet))
+        for arrival, connection, packet in [event for event in in_flight if event[0] <= time + 1]:
+            in_flight.remove((arrival, connection, packet))
+            connection.set_time(time + 1)
+            connection.report_receive(packet)
+        while server.receive() is not None:
+            pass
+    assert client.is_connected()
+    assert abs(client.get_rtt() - 10) <= 1, client.get_rtt()
+    assert packets_sent < 700, packets_sent # 600 messages
+    print("-completed testing retransmission backoff")
+
 def test_fast_retransmit():
     print("-testing fast retransmit")
     print('testing sending retransmission after 1 ack')
@@ -343,6 +438,425 @@ def test_fast_retransmit():
     test_acknowledged_messages([(10 + 1, create_data_packet(0, None)), (15 + 1, create_data_packet(2, None)), (25 + 1, create_data_packet(2, None)), (30, create_data_packet(4, None))], [(0, b'0'), (5, b'1'), (15, b'2'), (20, b'3')], [(0, create_data_packet(0, (0, b'0'))), (5, create_data_packet(0, (1, b'1'))), (15, create_data_packet(0, (2, b'2'))), (20, create_data_packet(0, (3, b'3')))], 100, 10, 5, None, 0.5, 13.75, 2)
     print("-completed fast retransmit")
 
+def test_send_window():
+    print("-testing send window")
+    print('testing occupancy of the send window')
+    client = Connection(0, 0, 10, 50)
+    assert client.get_send_window_occupancy() == 0
+    client.send(b'0')
+    client.send(b'1')
+    assert client.get_send_window_occupancy() == 2
+    assert client.tick(0) == [create_data_packet(0, (0, b'0')), create_data_packet(0, (1, b'1'))]
+    client.report_receive(create_data_packet(1, None))
+    assert client.get_send_window_occupancy() == 1
+    client.report_receive(create_data_packet(2, None))
+    assert client.get_send_window_occupancy() == 0
+    print('testing messages waiting for a full send window')
+    client = Connection(0, 0, 10, 50)
+    client.set_send_window_capacity(2)
+    for i in range(5):
+        client.send(str(i).encode())
+    assert client.get_send_window_occupancy() == 2
+    assert client.get_send_backlog_size() == 3
+    assert client.tick(0) == [create_data_packet(0, (0, b'0')), create_data_packet(0, (1, b'1'))]
+    client.report_receive(create_data_packet(2, None))
+    assert client.get_send_window_occupancy() == 2
+    assert client.get_send_backlog_size() == 1
+    assert client.tick(1) == [create_data_packet(0, (2, b'2')), create_data_packet(0, (3, b'3'))]
+    print('testing resizing the send window')
+    client.set_send_window_capacity(1)
+    assert client.get_send_window_capacity() == 2
+    client.set_send_window_capacity(5)
+    assert client.get_send_window_occupancy() == 3
+    assert client.get_send_backlog_size() == 0
+    assert client.tick(2) == [create_data_packet(0, (4, b'4'))]
+    client.report_receive(create_data_packet(5, None))
+    assert client.get_send_window_occupancy() == 0
+    print("-completed testing send window")
+
+def test_selective_acks():
+    print("-testing selective acks")
+    print('testing sending selective acks')
+    client = Connection(0, 0, 10, 0)
+    client.set_selective_acks(True)
+    client.report_receive(create_data_packet(0, (1, b'1')))
+    client.report_receive(create_data_packet(0, (3, b'3')))
+    assert client.tick(0) == [create_sack_packet(0, 0b101, None)]
+    client.send(b'hi')
+    assert client.tick(1) == [create_sack_packet(0, 0b101, (0, b'hi'))]
+    client.report_receive(create_data_packet(0, (0, b'0')))
+    assert client.tick(2) == [create_sack_packet(2, 0b1, None)]
+    client.report_receive(create_data_packet(0, (2, b'2')))
+    assert client.tick(3) == [create_data_packet(4, None)]
+    print('testing not sending selective acks unless enabled')
+    client = Connection(0, 0, 10, 0)
+    client.report_receive(create_data_packet(0, (1, b'1')))
+    assert client.tick(0) == [create_data_packet(0, None)]
+    print('testing only retransmitting holes')
+    sent = [(0, create_data_packet(0, (n, str(n).encode()))) for n in range(5)]
+    test_acknowledged_messages([(10 + 1, create_sack_packet(0, 0b111, None))], [(0, str(n).encode()) for n in range(5)], sent + [(11, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (4, b'4')))], 40, 10, 5, None, 0.5, 10)
+    test_acknowledged_messages([(10 + 1, create_sack_packet(0, 0b1011, None)), (20 + 1, create_data_packet(1, None))], [(0, str(n).encode()) for n in range(5)], sent + [(11, create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (3, b'3')))], 40, 10, 5, None, 0.5, 10) # the hole was retransmitted, so its ack is not timed
+    print('testing no early retransmission with too few selective acks')
+    test_acknowledged_messages([(10 + 1, create_sack_packet(0, 0b11, None))], [(0, str(n).encode()) for n in range(5)], sent + [(calculate_ack_time(10, 5), create_data_packet(0, (0, b'0'))), (calculate_ack_time(10, 5), create_data_packet(0, (3, b'3'))), (calculate_ack_time(10, 5), create_data_packet(0, (4, b'4')))], 40, 10, 5, None, 0.5, 10)
+    print("-completed testing selective acks")
+
+class RecordingController(NewRenoController):
+    # records the rtt given with each ack
+    def __init__(self, max_segment_size: int, initial_window_segments: int):
+        super().__init__(max_segment_size, initial_window_segments)
+        self.samples: list[float | None] = []
+
+    def report_ack(self, acked_bytes: int, rtt: float | None, time: int):
+        self.samples.append(rtt)
+        super().report_ack(acked_bytes, rtt, time)
+
+def test_congestion_control():
+    print("-testing congestion control")
+    print('testing new messages are limited by the congestion window')
+    client = Connection(0, 0, 10, 50)
+    client.set_congestion_controller(NewRenoController(10, 2))
+    for i in range(5):
+        client.send(str(i).encode() * 10)
+    assert client.tick(0) == [create_data_packet(0, (0, b'0' * 10)), create_data_packet(0, (1, b'1' * 10))]
+    assert client.get_bytes_in_flight() == 20
+    assert client.tick(1) == []
+    client.report_receive(create_data_packet(1, None))
+    assert client.get_bytes_in_flight() == 10
+    assert client.tick(10) == [create_data_packet(0, (2, b'2' * 10)), create_data_packet(0, (3, b'3' * 10))]
+    client.report_receive(create_data_packet(4, None))
+    assert client.get_bytes_in_flight() == 0
+    assert client.tick(20) == [create_data_packet(0, (4, b'4' * 10))]
+    print('testing sends are paced across ticks')
+    client = Connection(0, 0, 100, 50)
+    controller = NewRenoController(10, 100)
+    client.set_congestion_controller(controller)
+    for i in range(100):
+        client.send(b'x' * 10)
+    assert len(client.tick(0)) == 100 # the first window goes out at once and uses up the pacing budget
+    client.set_time(1)
+    client.report_receive(create_data_packet(100, None))
+    rate = controller.get_pacing_rate(client.get_rtt())
+    for i in range(100):
+        client.send(b'x' * 10)
+    sent = 0
+    for time in range(1, 31):
+        sent += len(client.tick(time))
+        assert sent <= 1 + time * rate / 10
+    assert sent >= 30 * rate / 10 - 1
+    print('testing retransmitted messages give no rtt sample')
+    client = Connection(0, 0, 10, 50)
+    controller = RecordingController(10, 2)
+    client.set_congestion_controller(controller)
+    client.send(b'0')
+    client.tick(0)
+    assert len(client.tick(calculate_ack_time(10, 5))) == 1
+    client.set_time(35)
+    client.report_receive(create_data_packet(1, None))
+    assert controller.samples == [None] and client.get_rtt() == 10
+    client.send(b'1')
+    client.tick(40)
+    client.set_time(44)
+    client.report_receive(create_data_packet(2, None))
+    assert controller.samples == [None, 4] # the raw sample, not the smoothed rtt
+    print('testing congestion control has no effect on retransmissions')
+    client = Connection(0, 0, 10, 50)
+    client.set_congestion_controller(NewRenoController(10, 2))
+    client.send(b'0' * 10)
+    client.send(b'1' * 10)
+    assert len(client.tick(0)) == 2
+    assert len(client.tick(calculate_ack_time(10, 5))) == 2
+    print('testing new reno window')
+    controller = NewRenoController(10, 2)
+    controller.report_ack(20, 10, 0)
+    assert controller.get_window() == 40
+    controller.report_loss(10, 10)
+    assert controller.get_window() == 20
+    controller.report_loss(15, 10)
+    assert controller.get_window() == 20
+    controller.report_ack(20, 10, 30)
+    assert controller.get_window() == 30
+    controller.report_timeout(40, 10)
+    assert controller.get_window() == 10
+    print('testing delay based window')
+    controller = DelayBasedController(10, 10)
+    controller.report_ack(100, 10, 0)
+    assert controller.get_window() == 110
+    for time in range(10):
+        controller.report_ack(10, 100, time)
+    assert controller.get_window() < 110
+    controller.report_loss(20, 10)
+    controller.report_loss(25, 10)
+    assert controller.get_window() < 110 * 0.75
+    controller.report_timeout(40, 10)
+    assert controller.get_window() == 20
+    print("-completed testing congestion control")
+
+def test_coalescing():
+    print("-testing coalescing messages")
+    print('testing sending coalesced messages')
+    client = Connection(0, 0, 10, 50)
+    client.set_max_packet_size(35)
+    for i in range(5):
+        client.send(str(i).encode() * 10)
+    assert client.tick(0) == [create_multi_packet(0, 0, [(0, b'0' * 10), (1, b'1' * 10)]), create_multi_packet(0, 0, [(2, b'2' * 10), (3, b'3' * 10)]), create_data_packet(0, (4, b'4' * 10))]
+    assert client.tick(calculate_ack_time(10, 5)) == [create_multi_packet(0, 0, [(0, b'0' * 10), (1, b'1' * 10)]), create_multi_packet(0, 0, [(2, b'2' * 10), (3, b'3' * 10)]), create_data_packet(0, (4, b'4' * 10))]
+    client.report_receive(create_data_packet(2, None))
+    assert client.tick(2 * calculate_ack_time(10, 5)) == [] # the timeout has backed off
+    client.send(b'big' * 20)
+    client.send(b'small')
+    assert client.tick(calculate_backoff_time(10, 5, 2)) == [create_multi_packet(0, 0, [(2, b'2' * 10), (3, b'3' * 10)]), create_data_packet(0, (4, b'4' * 10)), create_data_packet(0, (5, b'big' * 20)), create_data_packet(0, (6, b'small'))]
+    print('testing coalesced messages carry selective acks')
+    client = Connection(0, 0, 10, 50)
+    client.set_max_packet_size(100)
+    client.set_selective_acks(True)
+    client.report_receive(create_data_packet(0, (2, b'2')))
+    client.send(b'a')
+    client.send(b'b')
+    assert client.tick(0) == [create_multi_packet(0, 0b10, [(0, b'a'), (1, b'b')])]
+    print('testing receiving coalesced messages')
+    test_messages([[create_multi_packet(0, 0, [(1, b'1'), (0, b'0'), (3, b'3')])], [create_multi_packet(0, 0, [(1, b'1'), (2, b'2')])], [create_multi_packet(0, 0, [])]],
+                  [[(1, b'1'), (0, b'0'), (3, b'3')],                             [(2, b'2')],                                          []])
+    test_acknowledged_messages([(10 + 1, create_multi_packet(1, 0b1, []))], [(0, b'0'), (0, b'1'), (0, b'2')], [(0, create_data_packet(0, (0, b'0'))), (0, create_data_packet(0, (1, b'1'))), (0, create_data_packet(0, (2, b'2'))), (calculate_ack_time(10, 5), create_data_packet(0, (1, b'1')))], 40, 10, 5, None, 0.5, 10)
+    print("-completed testing coalescing messages")
+
+def test_fragmentation():
+    print("-testing fragmentation")
+    print('testing sending fragments')
+    client = Connection(0, 0, 10, 50)
+    client.set_max_fragment_size(4)
+    client.send(b'abcdefghij')
+    client.send(b'klmn')
+    assert client.get_send_window_occupancy() == 4
+    assert client.tick(0) == [create_fragment_packet(0, 0, 0, 0, 3, b'abcd'), create_fragment_packet(0, 0, 1, 1, 3, b'efgh'), create_fragment_packet(0, 0, 2, 2, 3, b'ij'), create_data_packet(0, (3, b'klmn'))]
+    client.report_receive(create_data_packet(2, None))
+    assert client.tick(calculate_ack_time(10, 5)) == [create_fragment_packet(0, 0, 2, 2, 3, b'ij'), create_data_packet(0, (3, b'klmn'))]
+    print('testing fragments stay in order with coalesced messages')
+    client = Connection(0, 0, 10, 50)
+    client.set_max_packet_size(100)
+    client.set_max_fragment_size(4)
+    for message in [b'a', b'b', b'abcdefgh', b'c', b'd']:
+        client.send(message)
+    assert client.tick(0) == [create_multi_packet(0, 0, [(0, b'a'), (1, b'b')]), create_fragment_packet(0, 0, 2, 0, 2, b'abcd'), create_fragment_packet(0, 0, 3, 1, 2, b'efgh'), create_multi_packet(0, 0, [(4, b'c'), (5, b'd')])]
+    print('testing receiving fragments')
+    test_messages([[create_fragment_packet(0, 0, 1, 1, 3, b'efgh'), create_data_packet(0, (3, b'klmn'))], [create_fragment_packet(0, 0, 0, 0, 3, b'abcd'), create_fragment_packet(0, 0, 1, 1, 3, b'efgh')], [create_fragment_packet(0, 0, 2, 2, 3, b'ij')]],
+                  [[(3, b'klmn')],                                                                                 [],                                                                                            [(0, b'abcdefghij')]])
+    test_messages([[create_fragment_packet(0, 0, 3, 1, 2, b'2'), create_fragment_packet(0, 0, 0, 0, 2, b'a'), create_fragment_packet(0, 0, 2, 0, 2, b'1'), create_fragment_packet(0, 0, 1, 1, 2, b'b')]],
+                  [[(2, b'12'), (0, b'ab')]])
+    print('testing invalid fragments')
+    test_messages([[create_fragment_packet(0, 0, 0, 1, 2, b'a'), create_fragment_packet(0, 0, 1, 0, 3, b'b'), create_fragment_packet(0, 0, 1, 1, 3, b'b')]],
+                  [[]])
+    print('testing sending large messages between connections')
+    sender = Connection(0, 0, 10, 50)
+    receiver = Connection(0, 0, 10, 50)
+    message = bytes(randint(0, 255) for _ in range(10_000))
+    sender.send(message)
+    sender.send(b'after')
+    packets = sender.tick(0)
+    assert len(packets) == 7 and all(len(packet) <= 2000 for packet in packets)
+    assert packets[-1] == create_data_packet(0, (6, b'after'))
+    for packet in reversed(packets[:-1]):
+        receiver.report_receive(packet)
+    receiver.report_receive(packets[-1])
+    assert receiver.receive() == (0, message)
+    assert receiver.receive() == (6, b'after')
+    assert receiver.receive() is None
+    print('testing the reassembly buffer is bounded')
+    # each message of two 4 byte fragments reserves 2 * (4 + REASSEMBLY_SLOT_OVERHEAD) = 104 bytes
+    client = Connection(0, 0, 10, 0)
+    client.set_max_fragment_size(4)
+    client.set_max_reassembly_size(208)
+    client.report_receive(create_fragment_packet(0, 0, 0, 0, 5, b'abcd'))
+    assert client.tick(0) == []
+    assert client.reassembly_size == 0
+    client.report_receive(create_fragment_packet(0, 0, 0, 0, 2, b'abcde'))
+    assert client.tick(0) == []
+    assert client.reassembly_size == 0
+    client.report_receive(create_fragment_packet(0, 0, 2, 0, 2, b'abcd'))
+    client.report_receive(create_fragment_packet(0, 0, 4, 0, 2, b'efgh'))
+    client.report_receive(create_fragment_packet(0, 0, 6, 0, 2, b'ijkl'))
+    assert client.reassembly_size == 208
+    client.report_receive(create_fragment_packet(0, 0, 0, 0, 2, b'mnop'))
+    assert client.reassembly_size == 312
+    client.report_receive(create_fragment_packet(0, 0, 3, 1, 2, b'q'))
+    assert client.receive() == (2, b'abcdq')
+    assert client.reassembly_size == 208
+    client.report_receive(create_fragment_packet(0, 0, 6, 0, 2, b'ijkl'))
+    assert client.reassembly_size == 208
+    client.report_receive(create_fragment_packet(0, 0, 1, 1, 2, b's'))
+    assert client.receive() == (0, b'mnops')
+    client.report_receive(create_fragment_packet(0, 0, 6, 0, 2, b'ijkl'))
+    client.report_receive(create_fragment_packet(0, 0, 7, 1, 2, b'r'))
+    assert client.receive() == (6, b'ijklr')
+    assert client.receive() is None
+    assert client.reassembly_size == 104
+    print('testing messages that cannot be reassembled are refused when sent')
+    client = Connection(0, 0, 10, 0)
+    client.set_max_fragment_size(4)
+    client.set_max_reassembly_size(208)
+    try:
+        client.send(b'a' * 17)
+        assert False
+    except ValueError:
+        pass
+    client.send(b'a' * 16)
+    assert len(client.tick(0)) == 4
+    print('testing reassembly buffers that can never be completed are evicted')
+    client = Connection(0, 0, 10, 0)
+    client.set_max_fragment_size(4)
+    client.report_receive(create_fragment_packet(0, 0, 2, 0, 2, b'abcd'))
+    assert client.reassembly_size == 104
+    client.report_receive(create_fragment_packet(0, 0, 3, 1, 3, b'efgh'))
+    assert list(client.reassembly_buffers) == [2] and len(client.reassembly_buffers[2]) == 3
+    assert client.reassembly_size == 156
+    client.report_receive(create_data_packet(0, (0, b'x')))
+    assert client.reassembly_size == 156
+    client.report_receive(create_data_packet(0, (1, b'y')))
+    assert client.lowest_unreceived_message_number == 4
+    assert client.reassembly_buffers == {}
+    assert client.reassembly_size == 0
+    client.report_receive(create_fragment_packet(0, 0, 4, 2, 3, b'ijkl'))
+    assert client.reassembly_buffers == {}
+    assert client.lowest_unreceived_message_number == 4
+    assert [client.receive() for _ in range(3)] == [(0, b'x'), (1, b'y'), None]
+    print("-completed testing fragmentation")
+
+def test_next_deadline():
+    print("-testing next deadline")
+    print('testing nothing to send')
+    client = Connection(0, 0, 10, 50)
+    assert client.next_deadline() is None
+    print('testing new messages and retransmissions')
+    client.send(b'0')
+    assert client.next_deadline() == 0
+    client.tick(5)
+    assert client.next_deadline() == 5 + calculate_ack_time(10, 5)
+    client.send(b'1')
+    assert client.next_deadline() == 5
+    client.tick(6)
+    assert client.next_deadline() == 5 + calculate_ack_time(10, 5)
+    client.report_receive(create_data_packet(1, None))
+    assert client.next_deadline() == 6 + calculate_ack_time(10, 5)
+    client.report_receive(create_data_packet(2, None))
+    assert client.next_deadline() is None
+    print('testing acks and accepts')
+    client.report_receive(create_data_packet(2, (0, b'0')))
+    assert client.next_deadline() == 6 + 50
+    client.report_receive(create_request_packet(0))
+    assert client.next_deadline() == 6
+    client.tick(7)
+    assert client.next_deadline() == 6 + 50
+    client.tick(56)
+    assert client.next_deadline() is None
+    print('testing deadlines with congestion control')
+    client = Connection(0, 0, 100, 50)
+    client.set_congestion_controller(NewRenoController(10, 2))
+    for i in range(3):
+        client.send(b'x' * 10)
+    assert client.next_deadline() == 0
+    assert len(client.tick(0)) == 2
+    assert client.next_deadline() == calculate_ack_time(100, 50)
+    client.report_receive(create_data_packet(1, None))
+    assert client.next_deadline() == 1 # pacing budget is used up until the next tick
+    print('testing disconnected connections')
+    client = Connection(0, 0, 10, 50)
+    client.report_receive(create_request_packet(1))
+    assert client.next_deadline() is None
+    print("-completed testing next deadline")
+
+def test_close():
+    print("-testing closing connections")
+    print('testing close is retransmitted until acknowledged')
+    client = Connection(7, 0, 10, 50)
+    client.send(b'0')
+    client.tick(0)
+    client.close()
+    assert client.is_closing() and client.next_deadline() == 0
+    assert client.tick(1) == [create_close_packet(7)]
+    assert client.next_deadline() == 1 + calculate_ack_time(10, 5)
+    assert client.tick(2) == [] # neither the close nor the unacknowledged message is due
+    assert client.tick(1 + calculate_ack_time(10, 5)) == [create_close_packet(7)]
+    client.report_receive(create_data_packet(0, (0, b'late')))
+    assert client.receive() is None # data is ignored once closed
+    client.report_receive(create_close_ack_packet(8))
+    assert client.is_connected()
+    client.report_receive(create_close_ack_packet(7))
+    assert not client.is_connected() and not client.is_closing() and client.next_deadline() is None
+    print('testing close gives up after max timeouts')
+    client = Connection(7, 0, 10, 50)
+    client.set_max_timeouts(2)
+    client.close()
+    assert client.tick(0) == [create_close_packet(7)]
+    assert client.tick(calculate_ack_time(10, 5)) == [create_close_packet(7)]
+    assert client.tick(2 * calculate_ack_time(10, 5)) == []
+    assert not client.is_connected()
+    print('testing close from the other endpoint')
+    server = Connection(7, 0, 10, 50)
+    server.report_receive(create_close_packet(8))
+    assert server.is_connected()
+    server.report_receive(create_close_packet(7))
+    assert not server.is_connected() and server.next_deadline() == 0
+    assert server.tick(1) == [create_close_ack_packet(7)]
+    assert server.tick(2) == [] and server.next_deadline() is None
+    print('testing both endpoints closing at once')
+    client = Connection(7, 0, 10, 50)
+    client.close()
+    client.tick(0)
+    client.report_receive(create_close_packet(7))
+    assert not client.is_connected() and client.tick(1) == [create_close_ack_packet(7)]
+    print("-completed testing closing connections")
+
+def test_buffer_pool():
+    print("-testing pooled receive buffers")
+    pool = BufferPool(100, 4)
+    print('testing messages are copied without a pool')
+    client = Connection(0, 0, 10, 50)
+    buffer = pool.acquire()
+    packet = create_data_packet(0, (0, b'abc'))
+    buffer[:len(packet)] = packet
+    client.report_receive(memoryview(buffer)[:len(packet)])
+    pool.release(memoryview(buffer))
+    assert pool.get_buffers_in_use() == 0
+    buffer[:len(packet)] = create_data_packet(0, (0, b'xyz'))
+    received = client.receive()
+    assert received is not None and received[1] == b'abc' and isinstance(received[1], bytes)
+    print('testing views are kept until received')
+    client = Connection(0, 0, 10, 50)
+    client.set_buffer_pool(pool)
+    views: list[memoryview] = []
+    for i in range(2):
+        buffer = pool.acquire()
+        packet = create_multi_packet(0, 0, [(2 * i, b'a' * i), (2 * i + 1, b'b' * i)])
+        buffer[:len(packet)] = packet
+        view = memoryview(buffer)[:len(packet)]
+        client.report_receive(view)
+        views.append(view)
+    for view in views:
+        pool.release(view)
+    assert pool.get_buffers_in_use() == 2
+    expected = [(0, b''), (1, b''), (2, b'a'), (3, b'b')]
+    for i in range(4):
+        received = client.receive()
+        assert received is not None and isinstance(received[1], memoryview)
+        assert (received[0], bytes(received[1])) == expected[i]
+        assert pool.get_buffers_in_use() == (2 if i < 2 else 1)
+    assert client.receive() is None
+    assert pool.get_buffers_in_use() == 0
+    assert pool.get_free_buffer_count() == 2
+    print('testing fragments are copied while reassembling')
+    client = Connection(0, 0, 10, 50)
+    client.set_buffer_pool(pool)
+    for i in range(2):
+        buffer = pool.acquire()
+        packet = create_fragment_packet(0, 0, i, i, 2, bytes([65 + i]) * 3)
+        buffer[:len(packet)] = packet
+        client.report_receive(memoryview(buffer)[:len(packet)])
+        buffer[:len(packet)] = bytes(len(packet))
+        pool.release(memoryview(buffer))
+    received = client.receive()
+    assert received == (0, b'AAABBB')
+    assert pool.get_buffers_in_use() == 0
+    print("-completed testing pooled receive buffers")
+
 def main():
     print("---------testing client connections")
     test_receive_invalid_messages()
@@ -350,7 +864,16 @@ def main():
     test_ack_waiting()
     test_retransmissions_without_acks()
     test_acknowledgements()
+    test_retransmission_backoff()
     test_fast_retransmit()
+    test_send_window()
+    test_selective_acks()
+    test_congestion_control()
+    test_coalescing()
+    test_fragmentation()
+    test_next_deadline()
+    test_close()
+    test_buffer_pool()
     print("---------completed testing client connections")
 
 
@@ -0,0 +1,24 @@
+from packet import COOKIE_SIZE
+from iptools import IP_endpoint, endpoint_to_string
+from hmac import digest, compare_digest
+from os import urandom
+
+
+class CookieGenerator:
+    # Creates the cookies that a client has to echo before a server keeps any state for it
+    # A cookie is a keyed hash of the client's endpoint, its convid and the current time period, so checking one needs nothing stored per client
+    # The lifetime is in the same units as the times passed in
+    def __init__(self, lifetime: int, key: bytes | None = None):
+        self.lifetime: int = lifetime
+        self.key: bytes = key if key is not None else urandom(32)
+
+    def create_cookie(self, endpoint: IP_endpoint, convid: int, time: int) -> bytes:
+        return self._hash(endpoint, convid, time // self.lifetime)
+
+    def check_cookie(self, cookie: bytes, endpoint: IP_endpoint, convid: int, time: int) -> bool:
+        # cookies from the previous period are still accepted, so a cookie is valid for between one and two lifetimes
+        period = time // self.lifetime
+        return compare_digest(cookie, self._hash(endpoint, convid, period)) or compare_digest(cookie, self._hash(endpoint, convid, period - 1))
+
+    def _hash(self, endpoint: IP_endpoint, convid: int, period: int) -> bytes:
+        return digest(self.key, f"{endpoint_to_string(endpoint)}/{convid}/{period}".encode(), 'sha256')[:COOKIE_SIZE]
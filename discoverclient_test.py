@@ -43,7 +43,7 @@ def main():
             client.tick()
             while recv:= client.receive():
                 seg, message = recv
-                print(f"{seg}: {message.decode()}")
+                print(f"{seg}: {bytes(message).decode()}")
             if client.is_connected() and not connected:
                 connected = True
                 print("connected!")
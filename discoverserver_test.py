@@ -52,7 +52,7 @@ def main():
                 for client in clients:
                     while recv:= server.receive(client):
                         seg, message = recv
-                        print(f"from {endpoint_to_string(client)}: {seg}: {message.decode()}")
+                        print(f"from {endpoint_to_string(client)}: {seg}: {bytes(message).decode()}")
             if not broadcast.is_closed():
                 broadcast.tick()
 
@@ -0,0 +1,72 @@
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF
+from socketcommon import BUFSIZE, GRO_BUFSIZE, MAX_GSO_SEGMENTS, enable_gso, enable_gro, send_datagrams
+from bufferpool import BufferPool
+from time import perf_counter
+from typing import Any
+
+DATAGRAMS = 64_000
+DATAGRAM_SIZE = 1200
+
+
+class CountingSocket(socket):
+    # counts the system calls used to send and receive
+    def __init__(self):
+        super().__init__(AF_INET, SOCK_DGRAM)
+        self.calls = 0
+
+    def sendto(self, *args: Any) -> int: # type: ignore
+        self.calls += 1
+        return super().sendto(*args)
+
+    def sendmsg(self, *args: Any) -> int: # type: ignore
+        self.calls += 1
+        return super().sendmsg(*args)
+
+    def recvfrom_into(self, *args: Any) -> Any: # type: ignore
+        self.calls += 1
+        return super().recvfrom_into(*args)
+
+    def recvmsg_into(self, *args: Any) -> Any: # type: ignore
+        self.calls += 1
+        return super().recvmsg_into(*args)
+
+
+def run(offload: bool) -> tuple[int, int, int, float] | None:
+    # returns send calls, receive calls, datagrams received and seconds taken
+    sender = CountingSocket()
+    receiver = CountingSocket()
+    receiver.setsockopt(SOL_SOCKET, SO_RCVBUF, 2 ** 22)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(False)
+    destination = receiver.getsockname()
+    gso = offload and enable_gso(sender)
+    gro = offload and enable_gro(receiver)
+    if offload and not (gso and gro):
+        return None
+    pool = BufferPool(GRO_BUFSIZE if gro else BUFSIZE)
+    burst = [(bytes(DATAGRAM_SIZE), destination)] * MAX_GSO_SEGMENTS
+    received = 0
+    start = perf_counter()
+    for _ in range(DATAGRAMS // MAX_GSO_SEGMENTS):
+        send_datagrams(sender, burst, gso)
+        for _ in pool.receive_datagrams(receiver, None, gro):
+            received += 1
+    seconds = perf_counter() - start
+    sender.close()
+    receiver.close()
+    return (sender.calls, receiver.calls, received, seconds)
+
+
+def main():
+    print(f"sending {DATAGRAMS} datagrams of {DATAGRAM_SIZE} bytes over loopback in bursts of {MAX_GSO_SEGMENTS}")
+    for name, offload in [("plain", False), ("gso/gro", True)]:
+        result = run(offload)
+        if result is None:
+            print(f"{name}: not supported on this system")
+            continue
+        send_calls, receive_calls, received, seconds = result
+        print(f"{name}: {send_calls} send calls, {receive_calls} receive calls, {received} datagrams received in {seconds:.3f}s ({received / seconds:,.0f} datagrams/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,12 @@ class HolePuncher:
         self.targets.append(endpoint)
         self.hole_punchers.append((endpoint, self.last_tick_time, -1))
 
+    def next_deadline(self) -> int | None:
+        # the earliest time that tick needs to be called, None if not hole punching
+        if len(self.hole_punchers) == 0:
+            return None
+        return min(hole_puncher[NEXT_TIMEOUT] for hole_puncher in self.hole_punchers)
+
     def tick(self, time: int) -> list[tuple[bytes, IP_endpoint]]:
         send_data : list[tuple[bytes, IP_endpoint]] = []
         self.last_tick_time = time
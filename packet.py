@@ -1,54 +1,239 @@
 from enum import Enum
+from struct import Struct
+from collections.abc import Callable
+from typing import Any
 
 class PacketType(Enum):
     REQUEST = 0b10000000
     ACCEPT = 0b01000000
     DATA = 0b00100000
+    SACK = 0b00010000
+    MULTI = 0b00001000
+    FRAGMENT = 0b00000100
+    COOKIE = 0b00000010
+    BUSY = 0b00000001
+    # every single bit type is taken, so later types combine two bits
+    CLOSE = 0b11000000
+    CLOSE_ACK = 0b10100000
 
-def create_request_packet(convid: int) -> bytes:
-    type_bytes = PacketType.REQUEST.value.to_bytes(1, 'big')
-    convid_bytes = convid.to_bytes(4, 'big')
-    return type_bytes + convid_bytes
+# packet type values, for comparing with the type returned by decode_packet
+REQUEST_TYPE = PacketType.REQUEST.value
+ACCEPT_TYPE = PacketType.ACCEPT.value
+DATA_TYPE = PacketType.DATA.value
+SACK_TYPE = PacketType.SACK.value
+MULTI_TYPE = PacketType.MULTI.value
+FRAGMENT_TYPE = PacketType.FRAGMENT.value
+COOKIE_TYPE = PacketType.COOKIE.value
+BUSY_TYPE = PacketType.BUSY.value
+CLOSE_TYPE = PacketType.CLOSE.value
+CLOSE_ACK_TYPE = PacketType.CLOSE_ACK.value
+
+MAX_SACK_BYTES = 32 # the sack bitmap covers at most 256 messages above the acknowledgement
+MAX_RECORD_SIZE = 2 ** 16 - 1
+MULTI_HEADER_SIZE = 5 # type, ack, sack length (followed by the sack bitmap)
+RECORD_HEADER_SIZE = 5 # message number, message length
+FRAGMENT_HEADER_SIZE = 12 # type, ack, sack length, message number, fragment index, fragment count (the sack bitmap follows the sack length)
+MAX_FRAGMENTS = 2 ** 16 - 1
+MAX_RETRY_AFTER_MS = 2 ** 16 - 1
+COOKIE_SIZE = 8
+
+# 3 byte fields are packed as a 2 byte and a 1 byte field, or share 4 bytes with the packet type
+CONVID_HEADER = Struct('>BI') # type, convid
+CONVID_COOKIE = Struct(f'>BI{COOKIE_SIZE}s') # type, convid, cookie
+BUSY_HEADER = Struct('>BIH') # type, convid, milliseconds to wait before retrying
+DATA_HEADER = Struct('>I') # type in the first byte, ack in the other three
+SACK_HEADER = Struct('>IB') # type and ack, sack length
+MESSAGE_HEADER = Struct('>HB') # message number
+RECORD_HEADER = Struct('>HBH') # message number, message length
+FRAGMENT_INFO = Struct('>HBHH') # message number, fragment index, fragment count
+
+def create_request_packet(convid: int, cookie: bytes | None = None) -> bytes:
+    # the cookie is echoed back to a server that asked for one
+    if cookie is not None:
+        return CONVID_COOKIE.pack(PacketType.REQUEST.value, convid, cookie)
+    return CONVID_HEADER.pack(PacketType.REQUEST.value, convid)
+
+def create_cookie_packet(convid: int, cookie: bytes) -> bytes:
+    # sent instead of an accept by a server that only connects clients that echo its cookie
+    return CONVID_COOKIE.pack(PacketType.COOKIE.value, convid, cookie)
 
 def create_accept_packet(convid: int) -> bytes:
-    type_bytes = PacketType.ACCEPT.value.to_bytes(1, 'big')
-    convid_bytes = convid.to_bytes(4, 'big')
-    return type_bytes + convid_bytes
+    return CONVID_HEADER.pack(PacketType.ACCEPT.value, convid)
+
+def create_busy_packet(convid: int, retry_after_ms: int) -> bytes:
+    # sent instead of an accept by a server that is not taking new connections yet
+    return BUSY_HEADER.pack(PacketType.BUSY.value, convid, min(max(retry_after_ms, 0), MAX_RETRY_AFTER_MS))
+
+def create_close_packet(convid: int) -> bytes:
+    # tells the other endpoint that the connection is closed, so that it can release it immediately
+    return CONVID_HEADER.pack(PacketType.CLOSE.value, convid)
+
+def create_close_ack_packet(convid: int) -> bytes:
+    return CONVID_HEADER.pack(PacketType.CLOSE_ACK.value, convid)
+
+def pack_request_packet_into(buffer: bytearray | memoryview, offset: int, convid: int) -> int:
+    # writes the packet into the buffer at offset, returns the number of bytes written
+    CONVID_HEADER.pack_into(buffer, offset, PacketType.REQUEST.value, convid)
+    return CONVID_HEADER.size
+
+def pack_accept_packet_into(buffer: bytearray | memoryview, offset: int, convid: int) -> int:
+    CONVID_HEADER.pack_into(buffer, offset, PacketType.ACCEPT.value, convid)
+    return CONVID_HEADER.size
+
+def encode_message(message_number: int, message: bytes | memoryview) -> bytes:
+    # the message as it appears at the end of a data or sack packet, can be reused for every packet the message is sent in
+    return MESSAGE_HEADER.pack(message_number >> 8, message_number & 0xff) + message
+
+def encode_fragment(message_number: int, fragment_index: int, fragment_count: int, fragment: bytes | memoryview) -> bytes:
+    # the fragment as it appears at the end of a fragment packet
+    return FRAGMENT_INFO.pack(message_number >> 8, message_number & 0xff, fragment_index, fragment_count) + fragment
 
 def create_data_packet(ack: int, message: tuple[int, bytes] | None) -> bytes:
-    data = PacketType.DATA.value.to_bytes(1, 'big')
-    data += ack.to_bytes(3, 'big')
-    if message is not None:
-        data += message[0].to_bytes(3, 'big')
-        data += message[1]
-    return data
-
-def interpret_packet(packet: bytes) -> tuple[PacketType, int, tuple[int, bytes] | None] | None:
-    # returns the packet type, acknowledgement/version, and data (if there is data)
+    return create_encoded_data_packet(ack, encode_message(*message) if message is not None else b'')
+
+def create_encoded_data_packet(ack: int, encoded_message: bytes) -> bytes:
+    return DATA_HEADER.pack(PacketType.DATA.value << 24 | ack) + encoded_message
+
+def pack_data_packet_into(buffer: bytearray | memoryview, offset: int, ack: int, message: tuple[int, bytes] | None) -> int:
+    # writes the packet into the buffer at offset, returns the number of bytes written
+    DATA_HEADER.pack_into(buffer, offset, PacketType.DATA.value << 24 | ack)
+    if message is None:
+        return DATA_HEADER.size
+    message_number, payload = message
+    offset += DATA_HEADER.size
+    MESSAGE_HEADER.pack_into(buffer, offset, message_number >> 8, message_number & 0xff)
+    offset += MESSAGE_HEADER.size
+    buffer[offset:offset + len(payload)] = payload
+    return DATA_HEADER.size + MESSAGE_HEADER.size + len(payload)
+
+def create_sack_packet(ack: int, sack: int, message: tuple[int, bytes] | None) -> bytes:
+    # a data packet with a bitmap of received messages above the ack: bit n is set if message ack + 1 + n was received
+    return create_encoded_sack_packet(ack, sack, encode_message(*message) if message is not None else b'')
+
+def create_encoded_sack_packet(ack: int, sack: int, encoded_message: bytes) -> bytes:
+    return _create_sack_header(PacketType.SACK, ack, sack) + encoded_message
+
+def create_multi_packet(ack: int, sack: int, messages: list[tuple[int, bytes]]) -> bytes:
+    # a data packet carrying several messages, each as a (message number, length, message) record
+    parts = [_create_sack_header(PacketType.MULTI, ack, sack)]
+    for message_number, message in messages:
+        parts.append(RECORD_HEADER.pack(message_number >> 8, message_number & 0xff, len(message)))
+        parts.append(message)
+    return b''.join(parts)
+
+def create_fragment_packet(ack: int, sack: int, message_number: int, fragment_index: int, fragment_count: int, fragment: bytes) -> bytes:
+    # a data packet carrying one part of a message that was too large for a single packet
+    return create_encoded_fragment_packet(ack, sack, encode_fragment(message_number, fragment_index, fragment_count, fragment))
+
+def create_encoded_fragment_packet(ack: int, sack: int, encoded_fragment: bytes) -> bytes:
+    return _create_sack_header(PacketType.FRAGMENT, ack, sack) + encoded_fragment
+
+def _create_sack_header(type: PacketType, ack: int, sack: int) -> bytes:
+    sack_length = (sack.bit_length() + 7) // 8
+    return SACK_HEADER.pack(type.value << 24 | ack, sack_length) + sack.to_bytes(sack_length, 'little')
+
+def decode_packet(packet: bytes | memoryview) -> tuple[int, int, Any] | None:
+    # returns the packet type's int value, acknowledgement/convid, and data (if there is data)
+    # the decoder is looked up by the first byte, and fields are read in place with the precompiled structs
     if len(packet) < 2:
         return None
-    if not packet[0] in [type.value for type in PacketType]:
-        return None
-    type = PacketType(packet[0])
-    match type:
-        case PacketType.REQUEST:
-            if len(packet) < 5:
-                return None
-            convid = int.from_bytes(packet[1:5])
-            return (type, convid, None)
-        case PacketType.ACCEPT:
-            if len(packet) < 5:
-                return None
-            convid = int.from_bytes(packet[1:5])
-            return (type, convid, None)
-        case PacketType.DATA:
-            if len(packet) < 4:
-                return None
-            acknowledgement = int.from_bytes(packet[1:4], 'big')
-            if len(packet) == 4:
-                return (type, acknowledgement, None)
-            # if it is greater, expect message number
-            if len(packet) < 7:
-                return None
-            message_number = int.from_bytes(packet[4:7], 'big')
-            return (type, acknowledgement, (message_number, packet[7:]))
\ No newline at end of file
+    decoder = DECODERS[packet[0]]
+    if decoder is None:
+        return None
+    return decoder(packet)
+
+def _decode_convid_packet(packet: bytes | memoryview) -> tuple[int, int, None] | None:
+    if len(packet) < CONVID_HEADER.size:
+        return None
+    type, convid = CONVID_HEADER.unpack_from(packet)
+    return (type, convid, None)
+
+def _decode_request_packet(packet: bytes | memoryview) -> tuple[int, int, bytes | None] | None:
+    if len(packet) >= CONVID_COOKIE.size:
+        return CONVID_COOKIE.unpack_from(packet)
+    return _decode_convid_packet(packet)
+
+def _decode_cookie_packet(packet: bytes | memoryview) -> tuple[int, int, bytes] | None:
+    if len(packet) < CONVID_COOKIE.size:
+        return None
+    return CONVID_COOKIE.unpack_from(packet)
+
+def _decode_busy_packet(packet: bytes | memoryview) -> tuple[int, int, int] | None:
+    if len(packet) < BUSY_HEADER.size:
+        return None
+    return BUSY_HEADER.unpack_from(packet)
+
+def _decode_data_packet(packet: bytes | memoryview) -> tuple[int, int, tuple[int, bytes | memoryview] | None] | None:
+    if len(packet) < DATA_HEADER.size:
+        return None
+    acknowledgement = DATA_HEADER.unpack_from(packet)[0] & 0xffffff
+    if len(packet) == DATA_HEADER.size:
+        return (DATA_TYPE, acknowledgement, None)
+    if len(packet) < DATA_HEADER.size + MESSAGE_HEADER.size:
+        return None
+    high, low = MESSAGE_HEADER.unpack_from(packet, DATA_HEADER.size)
+    return (DATA_TYPE, acknowledgement, (high << 8 | low, packet[DATA_HEADER.size + MESSAGE_HEADER.size:]))
+
+def _decode_sack_header(packet: bytes | memoryview) -> tuple[int, int, int] | None:
+    # returns the ack, the sack bitmap and the position after it
+    if len(packet) < SACK_HEADER.size:
+        return None
+    type_and_ack, sack_length = SACK_HEADER.unpack_from(packet)
+    position = SACK_HEADER.size + sack_length
+    if sack_length > MAX_SACK_BYTES or len(packet) < position:
+        return None
+    return (type_and_ack & 0xffffff, int.from_bytes(packet[SACK_HEADER.size:position], 'little'), position)
+
+def _decode_sack_packet(packet: bytes | memoryview) -> tuple[int, int, tuple[int, tuple[int, bytes | memoryview] | None]] | None:
+    header = _decode_sack_header(packet)
+    if header is None:
+        return None
+    acknowledgement, sack, position = header
+    if len(packet) == position:
+        return (SACK_TYPE, acknowledgement, (sack, None))
+    if len(packet) < position + MESSAGE_HEADER.size:
+        return None
+    high, low = MESSAGE_HEADER.unpack_from(packet, position)
+    return (SACK_TYPE, acknowledgement, (sack, (high << 8 | low, packet[position + MESSAGE_HEADER.size:])))
+
+def _decode_multi_packet(packet: bytes | memoryview) -> tuple[int, int, tuple[int, list[tuple[int, bytes | memoryview]]]] | None:
+    header = _decode_sack_header(packet)
+    if header is None:
+        return None
+    acknowledgement, sack, position = header
+    messages: list[tuple[int, bytes | memoryview]] = []
+    while position < len(packet):
+        if len(packet) < position + RECORD_HEADER_SIZE:
+            return None
+        high, low, length = RECORD_HEADER.unpack_from(packet, position)
+        position += RECORD_HEADER_SIZE
+        if len(packet) < position + length:
+            return None
+        messages.append((high << 8 | low, packet[position:position + length]))
+        position += length
+    return (MULTI_TYPE, acknowledgement, (sack, messages))
+
+def _decode_fragment_packet(packet: bytes | memoryview) -> tuple[int, int, tuple[int, tuple[int, int, int, bytes | memoryview]]] | None:
+    header = _decode_sack_header(packet)
+    if header is None:
+        return None
+    acknowledgement, sack, position = header
+    if len(packet) < position + FRAGMENT_INFO.size:
+        return None
+    high, low, fragment_index, fragment_count = FRAGMENT_INFO.unpack_from(packet, position)
+    if fragment_index >= fragment_count:
+        return None
+    return (FRAGMENT_TYPE, acknowledgement, (sack, (high << 8 | low, fragment_index, fragment_count, packet[position + FRAGMENT_INFO.size:])))
+
+# first byte of a packet -> decoder for that packet type
+DECODERS: list[Callable[[bytes | memoryview], tuple[int, int, Any] | None] | None] = [None] * 256
+DECODERS[REQUEST_TYPE] = _decode_request_packet
+DECODERS[ACCEPT_TYPE] = _decode_convid_packet
+DECODERS[DATA_TYPE] = _decode_data_packet
+DECODERS[SACK_TYPE] = _decode_sack_packet
+DECODERS[MULTI_TYPE] = _decode_multi_packet
+DECODERS[FRAGMENT_TYPE] = _decode_fragment_packet
+DECODERS[COOKIE_TYPE] = _decode_cookie_packet
+DECODERS[BUSY_TYPE] = _decode_busy_packet
+DECODERS[CLOSE_TYPE] = _decode_convid_packet
+DECODERS[CLOSE_ACK_TYPE] = _decode_convid_packet
@@ -1,6 +1,108 @@
-from packet import PacketType, create_accept_packet, create_data_packet, create_request_packet, interpret_packet
-from random import randint
+from packet import PacketType, create_accept_packet, create_data_packet, create_request_packet, create_sack_packet, create_multi_packet, create_fragment_packet, MAX_SACK_BYTES, RECORD_HEADER_SIZE, FRAGMENT_HEADER_SIZE, pack_request_packet_into, pack_accept_packet_into, pack_data_packet_into
+from packet import decode_packet, create_cookie_packet, create_busy_packet, create_close_packet, create_close_ack_packet, COOKIE_SIZE, MAX_RETRY_AFTER_MS
+from random import randint, randbytes
 from collections.abc import Callable
+from timeit import timeit
+
+def interpret_packet(packet: bytes) -> tuple[PacketType, int, bytes | None] | tuple[PacketType, int, int] | tuple[PacketType, int, tuple[int, bytes] | None] | tuple[PacketType, int, tuple[int, tuple[int, bytes] | None]] | tuple[PacketType, int, tuple[int, list[tuple[int, bytes]]]] | tuple[PacketType, int, tuple[int, tuple[int, int, int, bytes]]] | None:
+    # the decoder from before decode_packet, kept as the reference that decode_packet is checked and benchmarked against
+    # returns the packet type, acknowledgement/version, and data (if there is data)
+    if len(packet) < 2:
+        return None
+    if not packet[0] in [type.value for type in PacketType]:
+        return None
+    type = PacketType(packet[0])
+    match type:
+        case PacketType.REQUEST:
+            # returns the cookie if there is one
+            if len(packet) < 5:
+                return None
+            convid = int.from_bytes(packet[1:5])
+            if len(packet) >= 5 + COOKIE_SIZE:
+                return (type, convid, packet[5:5 + COOKIE_SIZE])
+            return (type, convid, None)
+        case PacketType.ACCEPT | PacketType.CLOSE | PacketType.CLOSE_ACK:
+            if len(packet) < 5:
+                return None
+            convid = int.from_bytes(packet[1:5])
+            return (type, convid, None)
+        case PacketType.DATA:
+            if len(packet) < 4:
+                return None
+            acknowledgement = int.from_bytes(packet[1:4], 'big')
+            if len(packet) == 4:
+                return (type, acknowledgement, None)
+            # if it is greater, expect message number
+            if len(packet) < 7:
+                return None
+            message_number = int.from_bytes(packet[4:7], 'big')
+            return (type, acknowledgement, (message_number, packet[7:]))
+        case PacketType.SACK:
+            # returns the sack bitmap along with the message
+            if len(packet) < 5:
+                return None
+            acknowledgement = int.from_bytes(packet[1:4], 'big')
+            sack_length = packet[4]
+            if sack_length > MAX_SACK_BYTES or len(packet) < 5 + sack_length:
+                return None
+            sack = int.from_bytes(packet[5:5 + sack_length], 'little')
+            packet = packet[5 + sack_length:]
+            if len(packet) == 0:
+                return (type, acknowledgement, (sack, None))
+            if len(packet) < 3:
+                return None
+            message_number = int.from_bytes(packet[0:3], 'big')
+            return (type, acknowledgement, (sack, (message_number, packet[3:])))
+        case PacketType.MULTI:
+            # returns the sack bitmap along with all messages
+            if len(packet) < 5:
+                return None
+            acknowledgement = int.from_bytes(packet[1:4], 'big')
+            sack_length = packet[4]
+            if sack_length > MAX_SACK_BYTES or len(packet) < 5 + sack_length:
+                return None
+            sack = int.from_bytes(packet[5:5 + sack_length], 'little')
+            messages: list[tuple[int, bytes]] = []
+            position = 5 + sack_length
+            while position < len(packet):
+                if len(packet) < position + RECORD_HEADER_SIZE:
+                    return None
+                message_number = int.from_bytes(packet[position:position + 3], 'big')
+                length = int.from_bytes(packet[position + 3:position + 5], 'big')
+                position += RECORD_HEADER_SIZE
+                if len(packet) < position + length:
+                    return None
+                messages.append((message_number, packet[position:position + length]))
+                position += length
+            return (type, acknowledgement, (sack, messages))
+        case PacketType.FRAGMENT:
+            # returns the sack bitmap along with the message number, fragment index, fragment count and fragment
+            if len(packet) < 5:
+                return None
+            acknowledgement = int.from_bytes(packet[1:4], 'big')
+            sack_length = packet[4]
+            if sack_length > MAX_SACK_BYTES or len(packet) < FRAGMENT_HEADER_SIZE + sack_length:
+                return None
+            sack = int.from_bytes(packet[5:5 + sack_length], 'little')
+            packet = packet[5 + sack_length:]
+            message_number = int.from_bytes(packet[0:3], 'big')
+            fragment_index = int.from_bytes(packet[3:5], 'big')
+            fragment_count = int.from_bytes(packet[5:7], 'big')
+            if fragment_index >= fragment_count:
+                return None
+            return (type, acknowledgement, (sack, (message_number, fragment_index, fragment_count, packet[7:])))
+        case PacketType.COOKIE:
+            # returns the cookie
+            if len(packet) < 5 + COOKIE_SIZE:
+                return None
+            convid = int.from_bytes(packet[1:5])
+            return (type, convid, packet[5:5 + COOKIE_SIZE])
+        case PacketType.BUSY:
+            # returns the milliseconds to wait before retrying
+            if len(packet) < 7:
+                return None
+            convid = int.from_bytes(packet[1:5])
+            return (type, convid, int.from_bytes(packet[5:7]))
 
 def test_request() -> bool:
     type = PacketType.REQUEST
@@ -14,6 +116,21 @@ def test_accept() -> bool:
     packet = create_accept_packet(convid)
     return test_packet((type, convid, None), packet)
 
+def test_cookie() -> bool:
+    # a cookie packet, and a request echoing the cookie
+    convid = randint(0, 2**32 - 1)
+    cookie = randbytes(COOKIE_SIZE)
+    return test_packet((PacketType.COOKIE, convid, cookie), create_cookie_packet(convid, cookie)) and test_packet((PacketType.REQUEST, convid, cookie), create_request_packet(convid, cookie))
+
+def test_busy() -> bool:
+    convid = randint(0, 2**32 - 1)
+    retry_after_ms = randint(0, MAX_RETRY_AFTER_MS)
+    return test_packet((PacketType.BUSY, convid, retry_after_ms), create_busy_packet(convid, retry_after_ms))
+
+def test_close() -> bool:
+    convid = randint(0, 2**32 - 1)
+    return test_packet((PacketType.CLOSE, convid, None), create_close_packet(convid)) and test_packet((PacketType.CLOSE_ACK, convid, None), create_close_ack_packet(convid))
+
 def test_data() -> bool:
     type = PacketType.DATA
     ack = randint(0, 2 ** 24 - 1)
@@ -22,10 +139,92 @@ def test_data() -> bool:
     packet = create_data_packet(ack, data)
     return test_packet((type, ack, data), packet)
 
+def test_sack() -> bool:
+    type = PacketType.SACK
+    ack = randint(0, 2 ** 24 - 1)
+    sack = randint(0, 2 ** (8 * MAX_SACK_BYTES) - 1)
+    data_options: list[tuple[int, bytes] | None] = [None, (0, b''), (1, b'HELLO'), (2 ** 24 - 1, b'KONNICHIWA')]
+    data = data_options[randint(0, len(data_options) - 1)]
+    packet = create_sack_packet(ack, sack, data)
+    return test_packet((type, ack, (sack, data)), packet)
+def test_multi() -> bool:
+    type = PacketType.MULTI
+    ack = randint(0, 2 ** 24 - 1)
+    sack = randint(0, 1) * randint(0, 2 ** (8 * MAX_SACK_BYTES) - 1)
+    data_options: list[tuple[int, bytes]] = [(0, b''), (1, b'HELLO'), (1000, b'HEY'), (2 ** 24 - 1, b'KONNICHIWA')]
+    data = [data_options[randint(0, len(data_options) - 1)] for _ in range(randint(0, 5))]
+    packet = create_multi_packet(ack, sack, data)
+    if decode_packet(packet[:-1]) is not None and len(data) > 0 and len(data[-1][1]) > 0:
+        return False # truncated records should be rejected
+    return test_packet((type, ack, (sack, data)), packet)
+def test_fragment() -> bool:
+    type = PacketType.FRAGMENT
+    ack = randint(0, 2 ** 24 - 1)
+    sack = randint(0, 1) * randint(0, 2 ** (8 * MAX_SACK_BYTES) - 1)
+    message_number = randint(0, 2 ** 24 - 1)
+    fragment_count = randint(1, 2 ** 16 - 1)
+    fragment_index = randint(0, fragment_count - 1)
+    data_options: list[bytes] = [b'', b'HELLO', b'KONNICHIWA']
+    data = data_options[randint(0, len(data_options) - 1)]
+    packet = create_fragment_packet(ack, sack, message_number, fragment_index, fragment_count, data)
+    if decode_packet(create_fragment_packet(ack, sack, message_number, fragment_count, fragment_count, data)) is not None:
+        return False # fragment index must be less than the count
+    return test_packet((type, ack, (sack, (message_number, fragment_index, fragment_count, data))), packet)
+
+def test_pack_into() -> bool:
+    # packing into a buffer must give the same bytes as creating the packet
+    buffer = bytearray(100)
+    offset = randint(0, 50)
+    convid = randint(0, 2**32 - 1)
+    size = pack_request_packet_into(buffer, offset, convid)
+    if buffer[offset:offset + size] != create_request_packet(convid):
+        return False
+    size = pack_accept_packet_into(buffer, offset, convid)
+    if buffer[offset:offset + size] != create_accept_packet(convid):
+        return False
+    ack = randint(0, 2 ** 24 - 1)
+    data_options: list[tuple[int, bytes] | None] = [None, (0, b''), (1, b'HELLO'), (2 ** 24 - 1, b'KONNICHIWA')]
+    data = data_options[randint(0, len(data_options) - 1)]
+    size = pack_data_packet_into(memoryview(buffer), offset, ack, data)
+    return buffer[offset:offset + size] == create_data_packet(ack, data)
+
+def test_decode() -> bool:
+    # the fast decoder must agree with interpret_packet on valid, truncated and random packets
+    sack = randint(0, 1) * randint(0, 2 ** (8 * MAX_SACK_BYTES) - 1)
+    packets = [create_request_packet(randint(0, 2**32 - 1)), create_accept_packet(randint(0, 2**32 - 1)),
+               create_request_packet(randint(0, 2**32 - 1), randbytes(COOKIE_SIZE)), create_cookie_packet(randint(0, 2**32 - 1), randbytes(COOKIE_SIZE)),
+               create_busy_packet(randint(0, 2**32 - 1), randint(0, MAX_RETRY_AFTER_MS)),
+               create_close_packet(randint(0, 2**32 - 1)), create_close_ack_packet(randint(0, 2**32 - 1)),
+               create_data_packet(randint(0, 2 ** 24 - 1), (randint(0, 2 ** 24 - 1), b'HELLO')), create_data_packet(randint(0, 2 ** 24 - 1), None),
+               create_sack_packet(randint(0, 2 ** 24 - 1), sack, (randint(0, 2 ** 24 - 1), b'HI')), create_sack_packet(randint(0, 2 ** 24 - 1), sack, None),
+               create_multi_packet(randint(0, 2 ** 24 - 1), sack, [(randint(0, 2 ** 24 - 1), b'HEY'), (randint(0, 2 ** 24 - 1), b'')]),
+               create_fragment_packet(randint(0, 2 ** 24 - 1), sack, randint(0, 2 ** 24 - 1), 1, 2, b'KONNICHIWA')]
+    packet = packets[randint(0, len(packets) - 1)]
+    for candidate in [packet, packet[:randint(0, len(packet))], randbytes(randint(0, 20))]:
+        expected = interpret_packet(candidate)
+        if expected is not None:
+            expected = (expected[0].value, expected[1], expected[2])
+        if decode_packet(candidate) != expected or decode_packet(memoryview(candidate)) != expected:
+            return False
+    return True
+
+def benchmark_decoders():
+    # compares interpret_packet with the table driven decoder on a mix of packets
+    packets = [create_data_packet(100, (101, b'x' * 100)), create_data_packet(100, None), create_sack_packet(100, 0b1011, (105, b'x' * 100)),
+               create_multi_packet(100, 0, [(101, b'x' * 50), (102, b'x' * 50), (103, b'x' * 50)])]
+    rounds = 20_000
+    print("")
+    print("Benchmarking decoders-------------")
+    for name, decoder in [("interpret_packet", interpret_packet), ("decode_packet", decode_packet)]:
+        seconds = timeit(lambda: [decoder(packet) for packet in packets], number=rounds)
+        print(f"{name}: {rounds * len(packets) / seconds:,.0f} packets/s")
+    print("Finished benchmarking decoders------------")
 
-def test_packet(expected: tuple[PacketType, int, tuple[int, bytes] | None] | None, packet: bytes) -> bool:
-    result = interpret_packet(packet)
-    return result == expected
+def test_packet(expected: tuple[PacketType, int, object] | None, packet: bytes) -> bool:
+    result = decode_packet(packet)
+    if expected is None:
+        return result is None
+    return result == (expected[0].value, expected[1], expected[2])
 
 def test_number(amount: int, name: str, test: Callable[[], bool]):
     print("")
@@ -46,7 +245,16 @@ def main():
     print("-------------Starting All Packet Tests-------------")
     test_number(100, "Request Packet", test_request)
     test_number(100, "Accept Packet", test_accept)
+    test_number(100, "Cookie Packet", test_cookie)
+    test_number(100, "Busy Packet", test_busy)
+    test_number(100, "Close Packet", test_close)
     test_number(100, "Data Packet", test_data)
+    test_number(100, "Sack Packet", test_sack)
+    test_number(100, "Multi Packet", test_multi)
+    test_number(100, "Fragment Packet", test_fragment)
+    test_number(100, "Pack Into", test_pack_into)
+    test_number(1000, "Decode", test_decode)
+    benchmark_decoders()
 
     print("")
     print("-------------Finished All Packet Tests-------------")
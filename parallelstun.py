@@ -24,6 +24,7 @@ class ParallelStun:
         self.stun_result: IP_endpoint | None = None
 
         self.stunning = True
+        self.last_tick_time: int = 0
 
     def get_stun_result(self) -> IP_endpoint | None:
         return self.stun_result
@@ -44,8 +45,17 @@ class ParallelStun:
             self.stunning = False
             return
 
+    def next_deadline(self) -> int | None:
+        # the earliest time that tick needs to be called, None if not stunning
+        if not self.stunning:
+            return None
+        if self.stun_info is None:
+            return self.last_tick_time
+        return self.stun_info[2] + self.timeout
+
     def tick(self, time: int) -> list[bytes]:
         # returns data to send
+        self.last_tick_time = time
         if not self.stunning:
             return []
         
@@ -1,23 +1,47 @@
 from clientconnector import ClientConnector
 from connection import Connection
+from congestion import CongestionController
+from bufferpool import BufferPool
 from parallelstun import ParallelStun
 from socket import socket, AddressFamily, AF_INET
-from socketcommon import BUFSIZE, create_ordinary_udp_socket
+from socketcommon import BUFSIZE, GRO_BUFSIZE, MAX_DATAGRAMS_PER_TICK, create_ordinary_udp_socket, enable_gso, enable_gro, enable_drop_counter, send_datagrams, create_wakeup_sockets, wake, get_wait_timeout, wait_for_readable
 from iptools import IP_endpoint, get_canonical_endpoint, get_canonical_local_endpoint
+from packet import CLOSE_TYPE, decode_packet, create_close_packet, create_close_ack_packet
 from time import perf_counter_ns
-from select import select
 from threading import Lock
+from collections.abc import Callable
 
 
 
 class PsychicClient:
-    def __init__(self, port: int = 0, family: AddressFamily = AF_INET, ack_delay_ns: int = 500_000_000):
-        self.socket: socket = create_ordinary_udp_socket(port, family)
+    def __init__(self, port: int = 0, family: AddressFamily = AF_INET, ack_delay_ns: int = 500_000_000, selective_acks: bool = False, congestion_controller: Callable[[], CongestionController] | None = None, max_packet_size: int | None = None, max_datagrams_per_tick: int | None = MAX_DATAGRAMS_PER_TICK, memoryview_payloads: bool = False, udp_offload: bool = False, receive_buffer_size: int | None = None, send_buffer_size: int | None = None):
+        self.socket: socket = create_ordinary_udp_socket(port, family, receive_buffer_size, send_buffer_size)
+        self.wakeup_reader, self.wakeup_writer = create_wakeup_sockets() # interrupts a blocking tick when there is new work
         self.connector: tuple[ClientConnector, IP_endpoint] | None = None
         self.connection: tuple[Connection, IP_endpoint] | None = None
+        self.closing_connection: tuple[Connection, IP_endpoint] | None = None # disconnected, waiting for the server to acknowledge the close
+        self.close_acks: list[tuple[bytes, IP_endpoint]] = [] # for servers that close a connection that is already gone
         self.stun: ParallelStun | None = None
         self.lock: Lock = Lock()
         self.ack_delay_ns: int = ack_delay_ns
+        self.selective_acks: bool = selective_acks
+        self.congestion_controller: Callable[[], CongestionController] | None = congestion_controller # creates a controller for each connection
+        self.max_packet_size: int | None = max_packet_size
+        self.max_datagrams_per_tick: int | None = max_datagrams_per_tick # limits reading so that a flooded socket can't starve sending, None to drain
+        # with udp offload (linux only), bursts to one endpoint are sent with one call and the kernel coalesces received datagrams
+        self.gso: bool = udp_offload and enable_gso(self.socket)
+        self.gro: bool = udp_offload and enable_gro(self.socket)
+        self.buffer_pool: BufferPool = BufferPool(GRO_BUFSIZE if self.gro else BUFSIZE) # datagrams are received into recycled buffers
+        self.count_drops: bool = enable_drop_counter(self.socket) # linux only
+        self.memoryview_payloads: bool = memoryview_payloads # if true, received messages are views that are valid until the next receive from the same connection
+        # optional handlers, called at the end of each tick without holding the lock
+        self.on_connect: Callable[[IP_endpoint], None] | None = None
+        self.on_message: Callable[[int, bytes | memoryview], None] | None = None
+        self.on_disconnect: Callable[[IP_endpoint], None] | None = None
+        self.on_stun_result: Callable[[IP_endpoint | None], None] | None = None
+        self.stun_reported: bool = False # true once the current stun's result has been passed to on_stun_result
+        self.connected_server: IP_endpoint | None = None # set when a connection is made during a tick
+        self.disconnected_server: IP_endpoint | None = None # set when the connection is lost during a tick
 
         self.closed = False
     
@@ -45,6 +69,14 @@ class PsychicClient:
                 return None
             return get_canonical_local_endpoint(self.socket)
     
+    def get_kernel_drops(self) -> int | None:
+        # the number of datagrams the kernel dropped because the receive buffer was full, None if it can't be counted
+        # the count is updated whenever a datagram is received, so it can lag behind until the next one arrives
+        with self.lock:
+            if self.closed or not self.count_drops:
+                return None
+            return self.buffer_pool.kernel_drops
+
     def get_family(self) -> AddressFamily | None:
         with self.lock:
             if self.closed:
@@ -64,8 +96,14 @@ class PsychicClient:
             return self.connection[0].is_connected()
     
     def disconnect(self):
+        # the server is told to release the connection straight away, instead of waiting for it to time out
         with self.lock:
             self.connector = None
+            if self.connection is not None and self.connection[0].is_connected():
+                self.connection[0].set_time(perf_counter_ns())
+                self.connection[0].close()
+                self.closing_connection = self.connection
+                wake(self.wakeup_writer)
             self.connection = None
 
     def connect(self, server: IP_endpoint) -> bool:
@@ -77,7 +115,8 @@ class PsychicClient:
             server_endpoint = get_canonical_endpoint(server, self.socket.family)
             if server_endpoint is None:
                 return False
-            self.connector = (ClientConnector((perf_counter_ns() // 1_000_000) % (2**32), perf_counter_ns(), 5, 500_000_000, 1_000_000_000, self.ack_delay_ns), server_endpoint)
+            self.connector = (ClientConnector((perf_counter_ns() // 1_000_000) % (2**32), perf_counter_ns(), 5, 500_000_000, 1_000_000_000, self.ack_delay_ns, 1_000_000), server_endpoint)
+            wake(self.wakeup_writer)
             return True
     
     def start_stun(self, servers: list[IP_endpoint]):
@@ -85,6 +124,8 @@ class PsychicClient:
             if self.closed:
                 return
             self.stun = ParallelStun(1_000_000_000, 3, servers)
+            self.stun_reported = False
+            wake(self.wakeup_writer)
     
     def get_stun_result(self) -> IP_endpoint | None:
         with self.lock:
@@ -92,26 +133,62 @@ class PsychicClient:
                 return None
             return self.stun.get_stun_result()
 
-    def _report_receive(self, data: bytes, address: IP_endpoint):
+    def _configure_connection(self, connection: Connection):
+        connection.set_selective_acks(self.selective_acks)
+        connection.set_max_packet_size(self.max_packet_size)
+        if self.congestion_controller is not None:
+            connection.set_congestion_controller(self.congestion_controller())
+        if self.memoryview_payloads:
+            connection.set_buffer_pool(self.buffer_pool)
+
+    def _report_receive(self, data: bytes | memoryview, address: IP_endpoint):
+        if self.closing_connection is not None and address == self.closing_connection[1]:
+            # first, in case a new connection is being made to the same server
+            self.closing_connection[0].report_receive(data)
+            if not self.closing_connection[0].is_connected():
+                return
         if self.connector is not None and address == self.connector[1]:
             self.connector[0].report_receive(data)
             return
         if self.stun is not None and address == self.stun.get_current_stun_server():
-            self.stun.report_receive(data)
+            self.stun.report_receive(bytes(data))
             return
         if self.connection is not None and address == self.connection[1]:
             self.connection[0].report_receive(data)
             return
+        result = decode_packet(data)
+        if result is not None and result[0] == CLOSE_TYPE:
+            self.close_acks.append((create_close_ack_packet(result[1]), address))
+
+    def _next_deadline(self) -> int | None:
+        # the earliest time that anything needs to be ticked, None if there is nothing to do
+        deadlines: list[int | None] = []
+        if self.connector is not None:
+            deadlines.append(self.connector[0].next_deadline())
+        if self.stun is not None:
+            deadlines.append(self.stun.next_deadline())
+        if self.connection is not None:
+            deadlines.append(self.connection[0].next_deadline())
+        if self.closing_connection is not None:
+            deadlines.append(self.closing_connection[0].next_deadline())
+        return min([deadline for deadline in deadlines if deadline is not None], default=None)
 
     def _tick_all(self) -> list[tuple[bytes, IP_endpoint]]:
         send_data: list[tuple[bytes, IP_endpoint]] = []
+        # the close goes out before any request to the same server, which would otherwise replace the connection before it is acknowledged
+        if self.closing_connection is not None:
+            send_data.extend([(data, self.closing_connection[1]) for data in self.closing_connection[0].tick(perf_counter_ns())])
+            if not self.closing_connection[0].is_connected():
+                self.closing_connection = None
         if self.connector is not None:
             send_data.extend([(data, self.connector[1]) for data in self.connector[0].tick(perf_counter_ns())])
             possible_connection = self.connector[0].get_connection_info()
             if possible_connection is not None:
                 server = self.connector[1]
                 self.connector = None # remove connector
+                self._configure_connection(possible_connection)
                 self.connection = (possible_connection, server)
+                self.connected_server = server
             elif self.connector[0].connect_failed():
                 self.connector = None
         if self.stun is not None and self.stun.stunning:
@@ -122,38 +199,97 @@ class PsychicClient:
         if self.connection is not None:
             send_data.extend([(data, self.connection[1]) for data in self.connection[0].tick(perf_counter_ns())])
             if not self.connection[0].is_connected():
+                self.disconnected_server = self.connection[1]
                 self.connection = None
+        send_data.extend(self.close_acks)
+        self.close_acks.clear()
         return send_data
 
-    def tick(self):
+    def tick(self, timeout: float | None = 0):
+        # waits up to timeout seconds for a datagram or the next deadline before ticking, None waits until either happens
+        if timeout != 0:
+            self._wait(timeout)
         with self.lock:
             if self.closed:
                 return
             # first get all info from the socket
-            rl, _, _ = select([self.socket], [], [], 0)
-            while len(rl) > 0:
+            for data, address in self.buffer_pool.receive_datagrams(self.socket, self.max_datagrams_per_tick, self.gro, self.count_drops):
                 try:
-                    data, address = self.socket.recvfrom(BUFSIZE)
                     address = get_canonical_endpoint(address, self.socket.family)
                     if address is not None:
                         self._report_receive(data, address)
                 except:
                     pass
-                rl, _, _ = select([self.socket], [], [], 0)
             send_data = self._tick_all()
-            for data, destination in send_data:
-                try:
-                    self.socket.sendto(data, destination)
-                except:
-                    pass
+            self.gso = send_datagrams(self.socket, send_data, self.gso)
+            connected, disconnected = self.connected_server, self.disconnected_server
+            self.connected_server = None
+            self.disconnected_server = None
+            connection = self.connection[0] if self.connection is not None else None
+            stun_finished = self.stun is not None and not self.stun.stun_in_progress() and not self.stun_reported
+            if stun_finished:
+                self.stun_reported = True
+        self._dispatch(connected, connection, disconnected, stun_finished)
+
+    def set_handlers(self, on_connect: Callable[[IP_endpoint], None] | None = None, on_message: Callable[[int, bytes | memoryview], None] | None = None,
+                     on_disconnect: Callable[[IP_endpoint], None] | None = None, on_stun_result: Callable[[IP_endpoint | None], None] | None = None):
+        # handlers are called by tick as events happen, so the events don't need to be polled
+        # on_message takes the messages that receive would return, on_disconnect is called when the connection is lost but not after disconnect
+        # a handler may call any method except tick
+        self.on_connect = on_connect
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+        self.on_stun_result = on_stun_result
+
+    def _dispatch(self, connected: IP_endpoint | None, connection: Connection | None, disconnected: IP_endpoint | None, stun_finished: bool):
+        if connected is not None and self.on_connect is not None:
+            self.on_connect(connected)
+        if connection is not None and self.on_message is not None:
+            while (received := connection.receive()) is not None:
+                self.on_message(*received)
+        if disconnected is not None and self.on_disconnect is not None:
+            self.on_disconnect(disconnected)
+        if stun_finished and self.on_stun_result is not None:
+            self.on_stun_result(self.get_stun_result())
         
+    def _wait(self, timeout: float | None):
+        with self.lock:
+            if self.closed:
+                return
+            time = perf_counter_ns()
+            wait = get_wait_timeout(self._next_deadline(), time, timeout)
+        # wait without holding the lock so that other threads can send, they wake this up
+        wait_for_readable([self.socket], self.wakeup_reader, wait)
+
+    def is_idle(self) -> bool:
+        # true when nothing is waiting to be sent, acked or retried
+        with self.lock:
+            return self.closed or self._next_deadline() is None
+
+    def next_deadline(self) -> int | None:
+        # the perf_counter_ns time at which tick next needs to be called, None if only a datagram or a wakeup needs it
+        with self.lock:
+            if self.closed:
+                return None
+            return self._next_deadline()
+
+    def run_until_idle(self, timeout: float | None = None):
+        # ticks, blocking between deadlines, until idle or until timeout seconds have passed
+        end_time = None if timeout is None else perf_counter_ns() + int(timeout * 1_000_000_000)
+        while not self.is_idle():
+            remaining = None if end_time is None else max(end_time - perf_counter_ns(), 0) / 1_000_000_000
+            self.tick(remaining)
+            if remaining == 0:
+                break
+
     def send(self, message: bytes):
         with self.lock:
             if self.connection is None:
                 return
             self.connection[0].send(message)
+            wake(self.wakeup_writer)
     
-    def receive(self) -> tuple[int, bytes] | None:
+    def receive(self) -> tuple[int, bytes | memoryview] | None:
         with self.lock:
             if self.connection is None:
                 return None
@@ -167,7 +303,15 @@ class PsychicClient:
             if self.closed:
                 return
             self.closed = True
+            if self.connection is not None:
+                # best effort, so that the server doesn't wait for the connection to time out
+                send_datagrams(self.socket, [(create_close_packet(self.connection[0].convid), self.connection[1])], False)
             self.socket.close()
+            wake(self.wakeup_writer)
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
             self.connector = None
             self.connection = None
+            self.closing_connection = None
+            self.close_acks.clear()
             self.stun = None
\ No newline at end of file
@@ -1,223 +1,612 @@
 from connection import Connection
+from congestion import CongestionController
+from bufferpool import BufferPool
 from parallelstun import ParallelStun
 from socket import socket, AddressFamily, AF_INET
-from socketcommon import BUFSIZE, create_ordinary_udp_socket
+from socketcommon import BUFSIZE, GRO_BUFSIZE, MAX_DATAGRAMS_PER_TICK, create_ordinary_udp_socket, enable_gso, enable_gro, enable_drop_counter, send_datagrams, create_wakeup_sockets, wake, get_wait_timeout, wait_for_readable
 from iptools import IP_endpoint, get_canonical_endpoint, get_canonical_local_endpoint
 from time import perf_counter_ns
-from select import select
-from packet import PacketType, interpret_packet, create_accept_packet
-from threading import Lock
+from packet import REQUEST_TYPE, CLOSE_TYPE, decode_packet, create_accept_packet, create_cookie_packet, create_busy_packet, create_close_packet, create_close_ack_packet
+from cookie import CookieGenerator
+from admission import AdmissionControl
+from threading import Lock, Thread
+from collections import deque
+from typing import Any
+from collections.abc import Callable
 from holepuncher import HolePuncher
+from heapq import heappush, heappop
+
+FULL_RETRY_AFTER_MS = 1_000 # how long clients are told to wait when the server has max_connections
+
+
+class Handshake:
+    # Decides what a server does with a datagram from an address that has no connection, shared by PsychicServer and AsyncPsychicServer
+    # With the cookie handshake, a client has to echo a cookie before any state is kept for it, so a flood of spoofed requests costs nothing
+    # New connections are refused with a busy packet when there are max_connections, or when the admission control's rate limits are reached
+    def __init__(self, cookie_handshake: bool = False, max_connections: int | None = None, admission_control: AdmissionControl | None = None):
+        self.cookies: CookieGenerator | None = CookieGenerator(10_000_000_000) if cookie_handshake else None
+        self.max_connections: int | None = max_connections
+        self.admission_control: AdmissionControl | None = admission_control
+
+    def respond(self, data: bytes | memoryview, address: IP_endpoint, time: int, connections: int) -> tuple[int | None, bytes | None]:
+        # returns the convid of a new connection to accept (None if there isn't one), and a packet to reply with instead (None if there isn't one)
+        result = decode_packet(data)
+        if result is None:
+            return (None, None)
+        if result[0] == CLOSE_TYPE:
+            # the connection is already gone, but the client needs an ack to stop closing
+            return (None, create_close_ack_packet(result[1]))
+        if result[0] != REQUEST_TYPE:
+            return (None, None)
+        convid = result[1]
+        if self.cookies is not None and (result[2] is None or not self.cookies.check_cookie(result[2], address, convid, time)):
+            return (None, create_cookie_packet(convid, self.cookies.create_cookie(address, convid, time)))
+        retry_after_ms = self._get_admission_delay(address, time, connections)
+        if retry_after_ms is not None:
+            return (None, create_busy_packet(convid, retry_after_ms))
+        return (convid, None)
+
+    def _get_admission_delay(self, address: IP_endpoint, time: int, connections: int) -> int | None:
+        # None if a new connection from the address can be made now, otherwise the milliseconds it should wait
+        if self.max_connections is not None and connections >= self.max_connections:
+            return FULL_RETRY_AFTER_MS
+        if self.admission_control is None:
+            return None
+        wait = self.admission_control.admit(address, time)
+        return None if wait is None else -(-wait // 1_000_000)
 
 
 class PsychicServer:
-    def __init__(self, port: int = 0, family: AddressFamily = AF_INET, hole_punch_timeout: int = 3_000_000_000,  ack_delay_ns: int = 500_000_000):
-        self.socket: socket = create_ordinary_udp_socket(port, family)
-        self.client_endpoints: list[IP_endpoint] = []
-        self.connections: list[Connection] = []
+    def __init__(self, port: int = 0, family: AddressFamily = AF_INET, hole_punch_timeout: int = 3_000_000_000,  ack_delay_ns: int = 500_000_000, selective_acks: bool = False, congestion_controller: Callable[[], CongestionController] | None = None, max_packet_size: int | None = None, max_datagrams_per_tick: int | None = MAX_DATAGRAMS_PER_TICK, memoryview_payloads: bool = False, udp_offload: bool = False, receive_buffer_size: int | None = None, send_buffer_size: int | None = None, reuse_port: bool = False, cookie_handshake: bool = False, max_connections: int | None = None, admission_control: AdmissionControl | None = None):
+        # with reuse_port, other sockets can bind the same port even when it is chosen by the kernel
+        self.socket: socket = create_ordinary_udp_socket(port, family, receive_buffer_size, send_buffer_size, True if reuse_port else None)
+        self.wakeup_reader, self.wakeup_writer = create_wakeup_sockets() # interrupts a blocking tick when there is new work
+        self.connections: dict[IP_endpoint, Connection] = {} # canonical client endpoint -> connection
+        self.closing_connections: dict[IP_endpoint, Connection] = {} # disconnected by the server, waiting for the client to acknowledge the close
+        self.handles: dict[IP_endpoint, int] = {}
+        self.handle_clients: dict[int, tuple[IP_endpoint, Connection]] = {} # handle -> client and connection
+        self.next_handle: int = 0
         self.hole_puncher: HolePuncher = HolePuncher(hole_punch_timeout, 5)
         self.stun: ParallelStun | None = None
         self.ack_delay_ns: int = ack_delay_ns
+        self.selective_acks: bool = selective_acks
+        self.congestion_controller: Callable[[], CongestionController] | None = congestion_controller # creates a controller for each connection
+        self.max_packet_size: int | None = max_packet_size
+        self.handshake: Handshake = Handshake(cookie_handshake, max_connections, admission_control)
+        self.stateless_replies: list[tuple[bytes, IP_endpoint]] = [] # cookie, busy and close ack replies, sent at the end of the tick
+        self.max_datagrams_per_tick: int | None = max_datagrams_per_tick # limits reading so that a flooded socket can't starve sending, None to drain
+        # with udp offload (linux only), bursts to one endpoint are sent with one call and the kernel coalesces received datagrams
+        self.gso: bool = udp_offload and enable_gso(self.socket)
+        self.gro: bool = udp_offload and enable_gro(self.socket)
+        self.buffer_pool: BufferPool = BufferPool(GRO_BUFSIZE if self.gro else BUFSIZE) # datagrams are received into recycled buffers
+        self.count_drops: bool = enable_drop_counter(self.socket) # linux only
+        self.memoryview_payloads: bool = memoryview_payloads # if true, received messages are views that are valid until the next receive from the same connection
 
         self.new_connections: list[tuple[IP_endpoint, int]] = [] # client, convid
         self.disconnections: list[IP_endpoint] = []
+        self.hole_punch_fails: deque[IP_endpoint] = deque()
 
+        # connections are only ticked when they have received data, have data to send or have reached their next deadline
+        self.deadlines: list[tuple[int, IP_endpoint]] = [] # min heap of (deadline, client), entries not matching scheduled_deadlines are skipped
+        self.scheduled_deadlines: dict[IP_endpoint, int] = {}
+        self.active_clients: set[IP_endpoint] = set()
+
+        # the lock is held for a whole tick, it owns the socket and the connections' state
+        # other threads queue commands that are run at the start of the next tick, and only take the table lock to look up clients
         self.lock: Lock = Lock()
+        self.table_lock: Lock = Lock() # held while the client tables change
+        self.commands: deque[tuple[Any, ...]] = deque()
+        self.network_thread: Thread | None = None
+        self.pending_connections: deque[IP_endpoint] = deque() # events collected by the network thread
+        self.pending_disconnections: deque[IP_endpoint] = deque()
+        # clients with received data in the order they became ready, read with receive_any and receive_batch
+        self.ready_lock: Lock = Lock()
+        self.ready_clients: deque[IP_endpoint] = deque()
+        self.ready_set: set[IP_endpoint] = set()
+        # optional handlers, called at the end of each tick without holding the lock
+        self.on_connect: Callable[[IP_endpoint], None] | None = None
+        self.on_message: Callable[[IP_endpoint, int, bytes | memoryview], None] | None = None
+        self.on_disconnect: Callable[[IP_endpoint], None] | None = None
+        self.on_hole_punch_failed: Callable[[IP_endpoint], None] | None = None
+        self.on_stun_result: Callable[[IP_endpoint | None], None] | None = None
+        self.stun_reported: bool = False # true once the current stun's result has been passed to on_stun_result
         self.closed = False
     
     def get_clients(self) -> list[IP_endpoint]:
-        with self.lock:
+        with self.table_lock:
             if self.closed:
                 return []
-            return self.client_endpoints.copy()
+            return list(self.connections)
 
     def get_rtt(self, client: IP_endpoint) -> float | None:
-        with self.lock:
-            if self.closed:
-                return None
-            endpoint = get_canonical_endpoint(client, self.socket.family)
-            if endpoint is None or endpoint not in self.client_endpoints:
+        if self.closed:
+            return None
+        connection = self._get_connection(client)
+        if connection is None:
+            return None
+        return connection.get_rtt()
+
+    def get_handle(self, client: IP_endpoint) -> int | None:
+        # returns a handle that identifies the client for as long as it is connected
+        if self.closed:
+            return None
+        endpoint = get_canonical_endpoint(client, self.socket.family)
+        if endpoint is None:
+            return None
+        with self.table_lock:
+            return self.handles.get(endpoint)
+
+    def get_client(self, handle: int) -> IP_endpoint | None:
+        with self.table_lock:
+            if self.closed or handle not in self.handle_clients:
                 return None
-            index = self.client_endpoints.index(endpoint)
-            return self.connections[index].get_rtt()
+            return self.handle_clients[handle][0]
 
     def stun_in_progress(self) -> bool:
-        with self.lock:
-            if self.closed or self.stun is None:
-                return False
-            return self.stun.stun_in_progress()
+        stun = self.stun
+        if self.closed or stun is None:
+            return False
+        return stun.stun_in_progress()
 
     def get_local_endpoint(self) -> IP_endpoint | None:
-        with self.lock:
-            if self.closed:
-                return None
-            return get_canonical_local_endpoint(self.socket)
+        if self.closed:
+            return None
+        return get_canonical_local_endpoint(self.socket)
     
+    def get_kernel_drops(self) -> int | None:
+        # the number of datagrams the kernel dropped because the receive buffer was full, None if it can't be counted
+        # the count is updated whenever a datagram is received, so it can lag behind until the next one arrives
+        if self.closed or not self.count_drops:
+            return None
+        return self.buffer_pool.kernel_drops
+
     def get_family(self) -> AddressFamily | None:
-        with self.lock:
-            if self.closed:
-                return None
-            return self.socket.family
+        if self.closed:
+            return None
+        return self.socket.family
 
     def stop_hole_punch(self, target: IP_endpoint):
-        with self.lock:
-            if self.closed:
-                return
-            endpoint = get_canonical_endpoint(target, self.socket.family)
-            if endpoint is None:
-                return
-            self.hole_puncher.stop_hole_punch(endpoint)
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(target, self.socket.family)
+        if endpoint is None:
+            return
+        self._queue_command(('stop_hole_punch', endpoint))
 
     def get_hole_punch_fails(self) -> list[IP_endpoint]:
-        with self.lock:
-            if self.closed:
-                return []
-            return self.hole_puncher.get_fails()
+        fails: list[IP_endpoint] = []
+        while len(self.hole_punch_fails) > 0:
+            fails.append(self.hole_punch_fails.popleft())
+        return fails
 
     def hole_punch(self, target: IP_endpoint):
-        with self.lock:
-            if self.closed:
-                return
-            endpoint = get_canonical_endpoint(target, self.socket.family)
-            if endpoint is None or endpoint in self.client_endpoints:
-                return
-            self.hole_puncher.hole_punch(endpoint)
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(target, self.socket.family)
+        if endpoint is None or endpoint in self.connections:
+            return
+        self._queue_command(('hole_punch', endpoint))
 
     def disconnect(self, client: IP_endpoint):
-        with self.lock:
-            if self.closed:
-                return
-            endpoint = get_canonical_endpoint(client, self.socket.family)
-            if endpoint is None or endpoint not in self.client_endpoints:
-                return
-            self._disconnect(endpoint)
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(client, self.socket.family)
+        if endpoint is None:
+            return
+        with self.table_lock:
+            connection = self.connections.get(endpoint)
+        if connection is not None:
+            self._queue_command(('disconnect', endpoint, connection))
     
+    def _get_connection(self, client: IP_endpoint) -> Connection | None:
+        endpoint = get_canonical_endpoint(client, self.socket.family)
+        if endpoint is None:
+            return None
+        return self.connections.get(endpoint)
+
     def _disconnect(self, client: IP_endpoint):
-        index = self.client_endpoints.index(client)
-        self.client_endpoints.pop(index)
-        self.connections.pop(index)
+        with self.table_lock:
+            self.connections.pop(client)
+            self.handle_clients.pop(self.handles.pop(client))
+        self.scheduled_deadlines.pop(client, None)
+        self.active_clients.discard(client)
         self.disconnections.append(client)
     
+    def _close(self, client: IP_endpoint):
+        # the client is told to release the connection, which is kept until it acknowledges
+        connection = self.connections[client]
+        connection.set_time(perf_counter_ns())
+        connection.close()
+        self._disconnect(client)
+        self.closing_connections[client] = connection
+        self.active_clients.add(client)
+    
     def start_stun(self, servers: list[IP_endpoint]):
-        with self.lock:
-            if self.closed:
-                return
-            self.stun = ParallelStun(1_000_000_000, 3, servers)
+        if self.closed:
+            return
+        self._queue_command(('start_stun', servers))
     
     def get_stun_result(self) -> IP_endpoint | None:
-        with self.lock:
-            if self.stun is None:
-                return None
-            return self.stun.get_stun_result()
+        stun = self.stun
+        if stun is None:
+            return None
+        return stun.get_stun_result()
 
-    def _manage_new_client(self, data: bytes, address: IP_endpoint):
-        result = interpret_packet(data)
-        if result is None:
+    def _queue_command(self, command: tuple[Any, ...]):
+        # run by the next tick, which this wakes up
+        self.commands.append(command)
+        wake(self.wakeup_writer)
+
+    def _run_commands(self, time: int):
+        # sends and disconnects are queued with the connection they were made for, and dropped if the client has since disconnected (even if it has reconnected)
+        # a command that fails is dropped, so that it can't stop the tick (and any thread that is ticking)
+        while len(self.commands) > 0:
+            command = self.commands.popleft()
+            try:
+                match command[0]:
+                    case 'send':
+                        if self.connections.get(command[1]) is command[2]:
+                            self._send(command[3], command[1], command[2], time)
+                    case 'disconnect':
+                        if self.connections.get(command[1]) is command[2]:
+                            self._close(command[1])
+                    case 'hole_punch':
+                        if command[1] not in self.connections:
+                            self.hole_puncher.hole_punch(command[1])
+                    case 'stop_hole_punch':
+                        self.hole_puncher.stop_hole_punch(command[1])
+                    case 'start_stun':
+                        self.stun = ParallelStun(1_000_000_000, 3, command[1])
+                        self.stun_reported = False
+            except Exception:
+                pass
+
+    def _configure_connection(self, connection: Connection):
+        connection.set_selective_acks(self.selective_acks)
+        connection.set_max_packet_size(self.max_packet_size)
+        if self.congestion_controller is not None:
+            connection.set_congestion_controller(self.congestion_controller())
+        if self.memoryview_payloads:
+            connection.set_buffer_pool(self.buffer_pool)
+
+    def _schedule(self, client: IP_endpoint, connection: Connection):
+        deadline = connection.next_deadline()
+        if deadline is None:
+            self.scheduled_deadlines.pop(client, None)
             return
-        if result[0] == PacketType.REQUEST:
-            convid = result[1]
-            
-            new_connection = Connection(convid, perf_counter_ns(), 1_000_000_000, self.ack_delay_ns)
-            self.client_endpoints.append(address)
-            self.connections.append(new_connection)
-            self.new_connections.append((address, convid))
-            self.hole_puncher.stop_hole_punch(address)
+        if self.scheduled_deadlines.get(client) == deadline:
+            return
+        self.scheduled_deadlines[client] = deadline
+        heappush(self.deadlines, (deadline, client))
+
+    def _get_due_clients(self, time: int) -> set[IP_endpoint]:
+        due_clients = self.active_clients
+        self.active_clients = set()
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= time:
+            deadline, client = heappop(self.deadlines)
+            if self.scheduled_deadlines.get(client) != deadline:
+                continue # rescheduled or disconnected
+            self.scheduled_deadlines.pop(client)
+            due_clients.add(client)
+        return due_clients
+
+    def _next_deadline(self, time: int) -> int | None:
+        # the earliest time that anything needs to be ticked, None if there is nothing to do
+        if len(self.active_clients) > 0 or len(self.new_connections) > 0 or len(self.commands) > 0:
+            return time
+        # discard entries from the top of the heap that have been rescheduled or disconnected
+        while len(self.deadlines) > 0 and self.scheduled_deadlines.get(self.deadlines[0][1]) != self.deadlines[0][0]:
+            heappop(self.deadlines)
+        deadlines = [self.hole_puncher.next_deadline()]
+        if len(self.deadlines) > 0:
+            deadlines.append(self.deadlines[0][0])
+        if self.stun is not None:
+            deadlines.append(self.stun.next_deadline())
+        return min([deadline for deadline in deadlines if deadline is not None], default=None)
 
-    def _report_receive(self, data: bytes, address: IP_endpoint):
+    def _manage_new_client(self, data: bytes | memoryview, address: IP_endpoint, time: int):
+        convid, reply = self.handshake.respond(data, address, time, len(self.connections))
+        if reply is not None:
+            self.stateless_replies.append((reply, address))
+        if convid is None:
+            return
+        new_connection = Connection(convid, time, 1_000_000_000, self.ack_delay_ns)
+        self._configure_connection(new_connection)
+        self.closing_connections.pop(address, None) # the client has moved on
+        with self.table_lock:
+            self.connections[address] = new_connection
+            self.handles[address] = self.next_handle
+            self.handle_clients[self.next_handle] = (address, new_connection)
+            self.next_handle += 1
+        self.new_connections.append((address, convid))
+        self.hole_puncher.stop_hole_punch(address)
+
+    def _report_receive(self, data: bytes | memoryview, address: IP_endpoint, time: int):
         if self.stun is not None and address == self.stun.get_current_stun_server():
-            self.stun.report_receive(data)
+            self.stun.report_receive(bytes(data))
             return
-        if address in self.client_endpoints:
-            index = self.client_endpoints.index(address)
-            self.connections[index].report_receive(data)
+        connection = self.connections.get(address)
+        if connection is not None:
+            connection.set_time(time)
+            connection.report_receive(data)
+            self.active_clients.add(address)
+            if connection.has_received_data():
+                with self.ready_lock:
+                    if address not in self.ready_set:
+                        self.ready_set.add(address)
+                        self.ready_clients.append(address)
             return
+        connection = self.closing_connections.get(address)
+        if connection is not None:
+            connection.report_receive(data)
+            if not connection.is_connected():
+                self.active_clients.add(address) # ticked to send any close ack and be removed
+                return
         # packet from somewhere else -> check if new connection
-        self._manage_new_client(data, address)
+        self._manage_new_client(data, address, time)
 
-    def _tick_all(self) -> list[tuple[bytes, IP_endpoint]]:
+    def _tick_all(self, time: int) -> list[tuple[bytes, IP_endpoint]]:
         send_data: list[tuple[bytes, IP_endpoint]] = []
         if self.stun is not None and self.stun.stunning:
-            stun_data = self.stun.tick(perf_counter_ns())
+            stun_data = self.stun.tick(time)
             server = self.stun.get_current_stun_server()
             if server is not None:
                 send_data.extend([(data, server) for data in stun_data])
         # send accept data for any new connections
         send_data.extend([(create_accept_packet(convid), endpoint) for endpoint, convid in self.new_connections])
+        send_data.extend(self.stateless_replies)
+        self.stateless_replies.clear()
         
 
-        # tick all connections and get data to send
+        # tick connections that are due and get data to send
         remove_connections: list[IP_endpoint] = []
-        for i, connection in enumerate(self.connections):
-            send_data.extend([(data, self.client_endpoints[i]) for data in connection.tick(perf_counter_ns())])
+        for endpoint in self._get_due_clients(time):
+            connection = self.connections.get(endpoint, self.closing_connections.get(endpoint))
+            if connection is None:
+                continue
+            send_data.extend([(data, endpoint) for data in connection.tick(time)])
             if not connection.is_connected():
-                remove_connections.append(self.client_endpoints[i])
-        # remove any endpoints that are disconnected
+                remove_connections.append(endpoint)
+            else:
+                self._schedule(endpoint, connection)
+        # remove any endpoints that are disconnected (closing connections were already reported when they were closed)
         for endpoint in remove_connections:
-            self._disconnect(endpoint)
+            if endpoint in self.connections:
+                self._disconnect(endpoint)
+            else:
+                self.closing_connections.pop(endpoint)
+                self.scheduled_deadlines.pop(endpoint, None)
 
         # tick the holepuncher
-        send_data.extend(self.hole_puncher.tick(perf_counter_ns()))
+        send_data.extend(self.hole_puncher.tick(time))
+        self.hole_punch_fails.extend(self.hole_puncher.get_fails())
         
         return send_data
 
-    def tick(self) -> tuple[list[IP_endpoint], list[IP_endpoint]]: # returns new connections and disconnections
+    def tick(self, timeout: float | None = 0) -> tuple[list[IP_endpoint], list[IP_endpoint]]: # returns new connections and disconnections
+        # waits up to timeout seconds for a datagram or the next deadline before ticking, None waits until either happens
+        if timeout != 0:
+            self._wait(timeout)
         with self.lock:
             if self.closed:
                 return ([], [])
-            # first get all info from the socket
-            rl, _, _ = select([self.socket], [], [], 0)
-            while len(rl) > 0:
+            time = perf_counter_ns()
+            self._run_commands(time)
+            # then get all info from the socket
+            for data, address in self.buffer_pool.receive_datagrams(self.socket, self.max_datagrams_per_tick, self.gro, self.count_drops):
                 try:
-                    data, address = self.socket.recvfrom(BUFSIZE)
                     address = get_canonical_endpoint(address, self.socket.family)
                     if address is not None:
-                        self._report_receive(data, address)
-                except:
-                    pass
-                rl, _, _ = select([self.socket], [], [], 0)
-            send_data = self._tick_all()
-            for data, destination in send_data:
-                try:
-                    self.socket.sendto(data, destination)
+                        self._report_receive(data, address, time)
                 except:
                     pass
+            send_data = self._tick_all(time)
+            self.gso = send_datagrams(self.socket, send_data, self.gso)
             new_connections = [endpoint for endpoint, _ in self.new_connections]
             disconnections = self.disconnections.copy()
             self.new_connections.clear()
             self.disconnections.clear()
-            return (new_connections, disconnections)
+            stun_finished = self.stun is not None and not self.stun.stun_in_progress() and not self.stun_reported
+            if stun_finished:
+                self.stun_reported = True
+        self._dispatch(new_connections, disconnections, stun_finished)
+        return (new_connections, disconnections)
+
+    def set_handlers(self, on_connect: Callable[[IP_endpoint], None] | None = None, on_message: Callable[[IP_endpoint, int, bytes | memoryview], None] | None = None,
+                     on_disconnect: Callable[[IP_endpoint], None] | None = None, on_hole_punch_failed: Callable[[IP_endpoint], None] | None = None,
+                     on_stun_result: Callable[[IP_endpoint | None], None] | None = None):
+        # handlers are called by tick as events happen, so the events don't need to be polled
+        # on_message takes the messages that receive_any would return, and on_hole_punch_failed the targets that get_hole_punch_fails would
+        # a handler may call any method except tick
+        self.on_connect = on_connect
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+        self.on_hole_punch_failed = on_hole_punch_failed
+        self.on_stun_result = on_stun_result
+
+    def _dispatch(self, new_connections: list[IP_endpoint], disconnections: list[IP_endpoint], stun_finished: bool):
+        if self.on_connect is not None:
+            for client in new_connections:
+                self.on_connect(client)
+        if self.on_message is not None:
+            while (received := self.receive_any()) is not None:
+                self.on_message(*received)
+        if self.on_disconnect is not None:
+            for client in disconnections:
+                self.on_disconnect(client)
+        if self.on_hole_punch_failed is not None:
+            for target in self.get_hole_punch_fails():
+                self.on_hole_punch_failed(target)
+        if stun_finished and self.on_stun_result is not None:
+            self.on_stun_result(self.get_stun_result())
         
-    def send(self, message: bytes, destination: IP_endpoint):
+    def _wait(self, timeout: float | None):
         with self.lock:
             if self.closed:
                 return
-            endpoint = get_canonical_endpoint(destination, self.socket.family)
-            if endpoint is None or endpoint not in self.client_endpoints:
-                return
-            index = self.client_endpoints.index(endpoint)
-            self.connections[index].send(message)
-    
-    def receive(self, source: IP_endpoint) -> tuple[int, bytes] | None:
+            time = perf_counter_ns()
+            wait = get_wait_timeout(self._next_deadline(time), time, timeout)
+        # wait without holding the lock so that other threads can send, they wake this up
+        wait_for_readable([self.socket], self.wakeup_reader, wait)
+
+    def is_idle(self) -> bool:
+        # true when nothing is waiting to be sent, acked or retried
+        with self.lock:
+            return self.closed or self._next_deadline(perf_counter_ns()) is None
+
+    def next_deadline(self) -> int | None:
+        # the perf_counter_ns time at which tick next needs to be called, None if only a datagram or a wakeup needs it
         with self.lock:
             if self.closed:
-                return
-            endpoint = get_canonical_endpoint(source, self.socket.family)
-            if endpoint is None or endpoint not in self.client_endpoints:
-                return
-            index = self.client_endpoints.index(endpoint)
-            return self.connections[index].receive()
+                return None
+            return self._next_deadline(perf_counter_ns())
+
+    def run_until_idle(self, timeout: float | None = None) -> tuple[list[IP_endpoint], list[IP_endpoint]]:
+        # ticks, blocking between deadlines, until idle or until timeout seconds have passed
+        end_time = None if timeout is None else perf_counter_ns() + int(timeout * 1_000_000_000)
+        new_connections: list[IP_endpoint] = []
+        disconnections: list[IP_endpoint] = []
+        while not self.is_idle():
+            remaining = None if end_time is None else max(end_time - perf_counter_ns(), 0) / 1_000_000_000
+            connections, disconnects = self.tick(remaining)
+            new_connections.extend(connections)
+            disconnections.extend(disconnects)
+            if remaining == 0:
+                break
+        return (new_connections, disconnections)
+
+    def start_network_thread(self) -> Thread:
+        # ticks in a background thread until closed, connections and disconnections are then read with get_events
+        if self.network_thread is None:
+            self.network_thread = Thread(target=self._run_network_thread, daemon=True)
+            self.network_thread.start()
+        return self.network_thread
+
+    def _run_network_thread(self):
+        while not self.closed:
+            new_connections, disconnections = self.tick(None)
+            if self.on_connect is None:
+                self.pending_connections.extend(new_connections)
+            if self.on_disconnect is None:
+                self.pending_disconnections.extend(disconnections)
+
+    def get_events(self) -> tuple[list[IP_endpoint], list[IP_endpoint]]:
+        # the new connections and disconnections since the last call, when running the network thread
+        new_connections: list[IP_endpoint] = []
+        disconnections: list[IP_endpoint] = []
+        while len(self.pending_connections) > 0:
+            new_connections.append(self.pending_connections.popleft())
+        while len(self.pending_disconnections) > 0:
+            disconnections.append(self.pending_disconnections.popleft())
+        return (new_connections, disconnections)
+
+    def send(self, message: bytes, destination: IP_endpoint):
+        # queued for the next tick, so this never waits for a tick to finish
+        if self.closed:
+            return
+        endpoint = get_canonical_endpoint(destination, self.socket.family)
+        if endpoint is None:
+            return
+        with self.table_lock:
+            connection = self.connections.get(endpoint)
+        if connection is not None:
+            connection.check_message_size(len(message)) # raised here, the tick that runs the send can't report it
+            self._queue_command(('send', endpoint, connection, message))
+
+    def send_to_handle(self, message: bytes, handle: int):
+        if self.closed:
+            return
+        with self.table_lock:
+            client = self.handle_clients.get(handle)
+        if client is not None:
+            client[1].check_message_size(len(message))
+            self._queue_command(('send', client[0], client[1], message))
+
+    def _send(self, message: bytes, endpoint: IP_endpoint, connection: Connection, time: int):
+        connection.set_time(time)
+        connection.send(message)
+        self.active_clients.add(endpoint)
+    
+    def receive(self, source: IP_endpoint) -> tuple[int, bytes | memoryview] | None:
+        # reads from the connection's delivery queue without waiting for a tick to finish
+        if self.closed:
+            return None
+        connection = self._get_connection(source)
+        if connection is None:
+            return None
+        return connection.receive()
+
+    def receive_from_handle(self, handle: int) -> tuple[int, bytes | memoryview] | None:
+        if self.closed:
+            return None
+        client = self.handle_clients.get(handle)
+        if client is None:
+            return None
+        return client[1].receive()
+
+    def receive_any(self) -> tuple[IP_endpoint, int, bytes | memoryview] | None:
+        # returns the client, message number and message of the next message from any client, without polling every client
+        with self.ready_lock:
+            while len(self.ready_clients) > 0:
+                received = self._receive_ready()
+                if received is not None:
+                    return received
+            return None
+
+    def receive_batch(self, max_messages: int) -> list[tuple[IP_endpoint, int, bytes | memoryview]]:
+        # up to max_messages messages from any clients, taken in turn from each ready client
+        # with memoryview payloads, a view is only valid until the next receive from the same client, so the batch then ends before a client repeats
+        batch: list[tuple[IP_endpoint, int, bytes | memoryview]] = []
+        batch_clients: set[IP_endpoint] = set()
+        with self.ready_lock:
+            while len(batch) < max_messages and len(self.ready_clients) > 0:
+                if self.memoryview_payloads and self.ready_clients[0] in batch_clients:
+                    break
+                received = self._receive_ready()
+                if received is not None:
+                    batch.append(received)
+                    batch_clients.add(received[0])
+        return batch
+
+    def _receive_ready(self) -> tuple[IP_endpoint, int, bytes | memoryview] | None:
+        # receives from the first ready client, which goes to the back of the queue if it has more data so that one client can't starve the others
+        client = self.ready_clients.popleft()
+        connection = self.connections.get(client)
+        received = connection.receive() if connection is not None else None
+        if connection is not None and connection.has_received_data():
+            self.ready_clients.append(client)
+        else:
+            self.ready_set.discard(client)
+        if received is None:
+            return None
+        return (client, received[0], received[1])
     
     def is_closed(self):
         return self.closed
 
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        wake(self.wakeup_writer)
         with self.lock:
-            if self.closed:
-                return
-            self.closed = True
+            # best effort, so that clients don't wait for the connection to time out
+            send_datagrams(self.socket, [(create_close_packet(connection.convid), client) for client, connection in self.connections.items()], False)
             self.socket.close()
-            self.client_endpoints.clear()
-            self.connections.clear()
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+            with self.table_lock:
+                self.connections.clear()
+                self.closing_connections.clear()
+                self.handles.clear()
+                self.handle_clients.clear()
+            with self.ready_lock:
+                self.ready_clients.clear()
+                self.ready_set.clear()
+            self.commands.clear()
             self.stun = None
             self.new_connections.clear()
-            self.disconnections.clear()
\ No newline at end of file
+            self.disconnections.clear()
+            self.deadlines.clear()
+            self.scheduled_deadlines.clear()
+            self.active_clients.clear()
\ No newline at end of file
@@ -0,0 +1,385 @@
+from psychicserver import PsychicServer, Handshake, FULL_RETRY_AFTER_MS
+from psychicclient import PsychicClient
+from iptools import IP_endpoint
+from packet import COOKIE_TYPE, decode_packet, create_request_packet, create_data_packet, create_close_packet, create_close_ack_packet, create_busy_packet
+from admission import AdmissionControl
+from connection import INIT_MAX_REASSEMBLY_SIZE
+from socketcommon import create_ordinary_udp_socket, receive_datagrams
+from socket import AF_INET
+from time import perf_counter, perf_counter_ns, sleep
+from threading import Thread
+from collections.abc import Callable
+from typing import Any
+
+def tick_until(server: PsychicServer, clients: list[PsychicClient], condition: Callable[[], bool], timeout: float = 5) -> bool:
+    end = perf_counter() + timeout
+    while perf_counter() < end:
+        server.tick()
+        for client in clients:
+            client.tick()
+        if condition():
+            return True
+        sleep(0.001)
+    return False
+
+def connect_clients(server: PsychicServer, count: int) -> list[PsychicClient]:
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    clients = [PsychicClient(0, ack_delay_ns=0) for _ in range(count)]
+    for client in clients:
+        client.connect(('127.0.0.1', local_endpoint[1]))
+    assert tick_until(server, clients, lambda: all(client.is_connected() for client in clients) and len(server.get_clients()) == count)
+    return clients
+
+def get_server_endpoint(server: PsychicServer, client: PsychicClient) -> IP_endpoint:
+    local_endpoint = client.get_local_endpoint()
+    assert local_endpoint is not None
+    handle = server.get_handle(('127.0.0.1', local_endpoint[1]))
+    assert handle is not None
+    endpoint = server.get_client(handle)
+    assert endpoint is not None
+    return endpoint
+
+def close_all(server: PsychicServer, clients: list[PsychicClient]):
+    for client in clients:
+        client.close()
+    server.close()
+
+def record_connection_ticks(server: PsychicServer) -> list[IP_endpoint]:
+    # the endpoints of the server's connections, each time one is ticked
+    ticked: list[IP_endpoint] = []
+    def record(endpoint: IP_endpoint, tick: Callable[[int], list[bytes]]) -> Callable[[int], list[bytes]]:
+        def recorded_tick(time: int) -> list[bytes]:
+            ticked.append(endpoint)
+            return tick(time)
+        return recorded_tick
+    for endpoint, connection in server.connections.items():
+        connection.tick = record(endpoint, connection.tick) # type: ignore
+    return ticked
+
+def test_deadline_scheduling():
+    print("-testing deadline scheduling")
+    server = PsychicServer(0, ack_delay_ns=0)
+    clients = connect_clients(server, 5)
+    print('testing idle connections are not ticked')
+    assert tick_until(server, clients, server.is_idle)
+    assert server.next_deadline() is None
+    ticked = record_connection_ticks(server)
+    for _ in range(10):
+        server.tick()
+    assert ticked == []
+    print('testing only connections with work are ticked')
+    clients[2].send(b'hello')
+    assert tick_until(server, clients, lambda: server.receive(get_server_endpoint(server, clients[2])) is not None)
+    assert set(ticked) == {get_server_endpoint(server, clients[2])}
+    print('testing a connection is ticked again when its deadline passes')
+    ticked.clear()
+    server.send(b'hello', get_server_endpoint(server, clients[4]))
+    server.tick()
+    assert ticked == [get_server_endpoint(server, clients[4])]
+    deadline = server.next_deadline()
+    assert deadline is not None # waiting for the ack, which is not sent while the client is not ticked
+    while perf_counter_ns() < deadline:
+        sleep(0.001)
+    server.tick()
+    assert ticked == [get_server_endpoint(server, clients[4])] * 2
+    assert tick_until(server, clients, lambda: clients[4].receive() is not None)
+    assert tick_until(server, clients, server.is_idle)
+    assert set(ticked) == {get_server_endpoint(server, clients[4])}
+    close_all(server, clients)
+    print("-completed testing deadline scheduling")
+
+def test_client_table():
+    print("-testing the client table")
+    server = PsychicServer(0, ack_delay_ns=0)
+    clients = connect_clients(server, 3)
+    print('testing handles identify clients')
+    endpoints = [get_server_endpoint(server, client) for client in clients]
+    handles = [server.get_handle(endpoint) for endpoint in endpoints]
+    assert len(set(handles)) == 3
+    assert [server.get_client(handle) for handle in handles] == endpoints # type: ignore
+    assert sorted(server.get_clients()) == sorted(endpoints)
+    print('testing sending and receiving with handles')
+    server.send_to_handle(b'to 1', handles[1]) # type: ignore
+    assert tick_until(server, clients, lambda: clients[1].receive() == (0, b'to 1'))
+    clients[0].send(b'from 0')
+    assert tick_until(server, clients, lambda: server.receive_from_handle(handles[0]) == (0, b'from 0')) # type: ignore
+    assert server.receive_from_handle(handles[0]) is None # type: ignore
+    print('testing handles are not reused after a disconnect')
+    clients[2].disconnect()
+    assert tick_until(server, clients, lambda: endpoints[2] not in server.get_clients())
+    assert server.get_handle(endpoints[2]) is None
+    assert server.get_client(handles[2]) is None # type: ignore
+    assert server.receive_from_handle(handles[2]) is None # type: ignore
+    server.send_to_handle(b'gone', handles[2]) # type: ignore
+    clients[2].connect(('127.0.0.1', server.get_local_endpoint()[1])) # type: ignore
+    assert tick_until(server, clients, lambda: clients[2].is_connected() and endpoints[2] in server.get_clients())
+    new_handle = server.get_handle(endpoints[2])
+    assert new_handle is not None and new_handle not in handles
+    assert server.get_client(new_handle) == endpoints[2]
+    assert server.get_client(handles[2]) is None # type: ignore
+    assert not tick_until(server, clients, lambda: clients[2].receive() is not None, 0.2) # the send to the old handle is dropped
+    assert server.get_handle(('127.0.0.1', 1)) is None
+    close_all(server, clients)
+    print("-completed testing the client table")
+
+def test_blocking_tick():
+    print("-testing blocking ticks")
+    server = PsychicServer(0, ack_delay_ns=0)
+    clients = connect_clients(server, 1)
+    client = clients[0]
+    assert tick_until(server, clients, lambda: server.is_idle() and client.is_idle())
+    print('testing an idle tick waits for the timeout')
+    start = perf_counter()
+    server.tick(0.2)
+    assert 0.15 < perf_counter() - start < 2
+    print('testing a blocking tick returns when a datagram arrives')
+    def send_later():
+        sleep(0.1)
+        client.send(b'wake up')
+        client.tick()
+    thread = Thread(target=send_later)
+    start = perf_counter()
+    thread.start()
+    server.tick(5)
+    assert perf_counter() - start < 2
+    thread.join()
+    assert tick_until(server, clients, lambda: server.receive(get_server_endpoint(server, client)) == (0, b'wake up'))
+    assert tick_until(server, clients, lambda: server.is_idle() and client.is_idle())
+    print('testing a blocking tick is woken up by a send from another thread')
+    endpoint = get_server_endpoint(server, client)
+    thread = Thread(target=lambda: (sleep(0.1), server.send(b'woken', endpoint)))
+    start = perf_counter()
+    thread.start()
+    server.tick(None)
+    assert perf_counter() - start < 2
+    thread.join()
+    print('testing run until idle waits for the deadlines')
+    assert not server.is_idle() # the message is waiting for its ack
+    thread = Thread(target=lambda: (client.tick(5), client.run_until_idle(5))) # the client is idle until the message arrives
+    thread.start()
+    server.run_until_idle(5)
+    thread.join()
+    assert server.is_idle() and server.next_deadline() is None
+    assert client.receive() == (0, b'woken')
+    close_all(server, clients)
+    print("-completed testing blocking ticks")
+
+def test_receive_budget():
+    print("-testing the receive budget")
+    server = PsychicServer(0, ack_delay_ns=0, max_datagrams_per_tick=3)
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    sender = create_ordinary_udp_socket(0, AF_INET)
+    print('testing a tick reads at most the budget')
+    for index in range(10):
+        sender.sendto(b'not a packet %d' % index, ('127.0.0.1', local_endpoint[1]))
+    sleep(0.1)
+    server.tick()
+    assert len(receive_datagrams(server.socket, 2)) == 2
+    print('testing the socket is drained without blocking')
+    start = perf_counter()
+    assert len(receive_datagrams(server.socket, None)) == 5
+    assert receive_datagrams(server.socket, None) == []
+    assert len(list(server.buffer_pool.receive_datagrams(server.socket, None))) == 0
+    assert perf_counter() - start < 1
+    sender.close()
+    server.close()
+    print("-completed testing the receive budget")
+
+def test_udp_offload():
+    print("-testing udp offload")
+    server = PsychicServer(0, ack_delay_ns=0, udp_offload=True)
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    client = PsychicClient(0, ack_delay_ns=0, udp_offload=True)
+    client.connect(('127.0.0.1', local_endpoint[1]))
+    assert tick_until(server, [client], lambda: client.is_connected() and len(server.get_clients()) == 1)
+    print('testing bursts in both directions arrive in full')
+    endpoint = get_server_endpoint(server, client)
+    for index in range(30):
+        client.send(b'%d' % index * 100)
+        server.send(b'%d' % index * 100, endpoint)
+    server_received: list[bytes] = []
+    client_received: list[bytes] = []
+    def receive_all() -> bool:
+        while (received := server.receive(endpoint)) is not None:
+            server_received.append(bytes(received[1]))
+        while (received := client.receive()) is not None:
+            client_received.append(bytes(received[1]))
+        return len(server_received) == 30 and len(client_received) == 30
+    assert tick_until(server, [client], receive_all)
+    assert sorted(server_received) == sorted(client_received) == sorted(b'%d' % index * 100 for index in range(30))
+    close_all(server, [client])
+    print("-completed testing udp offload")
+
+def test_queued_commands():
+    print("-testing queued commands")
+    server = PsychicServer(0, ack_delay_ns=0)
+    clients = connect_clients(server, 2)
+    endpoints = [get_server_endpoint(server, client) for client in clients]
+    print('testing queued sends and disconnects are dropped once their connection is gone')
+    server.send(b'stale', endpoints[0])
+    server.send_to_handle(b'stale handle', server.get_handle(endpoints[0])) # type: ignore
+    server.disconnect(endpoints[0])
+    stale_commands = list(server.commands)
+    server.commands.clear()
+    # the client reconnects from the same endpoint before the commands run, as if they had raced the reconnection
+    clients[0].disconnect()
+    assert tick_until(server, clients, lambda: endpoints[0] not in server.get_clients())
+    clients[0].connect(('127.0.0.1', server.get_local_endpoint()[1])) # type: ignore
+    assert tick_until(server, clients, lambda: clients[0].is_connected() and endpoints[0] in server.get_clients())
+    server.commands.extend(stale_commands)
+    assert not tick_until(server, clients, lambda: clients[0].receive() is not None or not clients[0].is_connected(), 0.3)
+    assert endpoints[0] in server.get_clients()
+    print('testing queued commands reach a connection that is still there')
+    server.send(b'fresh', endpoints[0])
+    server.disconnect(endpoints[1])
+    assert tick_until(server, clients, lambda: clients[0].receive() == (0, b'fresh'))
+    assert tick_until(server, clients, lambda: not clients[1].is_connected() and endpoints[1] not in server.get_clients())
+    print('testing a message that is too large is refused before it is queued')
+    too_large = bytes(INIT_MAX_REASSEMBLY_SIZE + 1)
+    for send in (lambda: server.send(too_large, endpoints[0]), lambda: server.send_to_handle(too_large, server.get_handle(endpoints[0]))): # type: ignore
+        try:
+            send()
+            assert False
+        except ValueError:
+            pass
+    assert len(server.commands) == 0
+    print('testing a command that fails does not stop the tick')
+    server._queue_command(('send', endpoints[0], server.connections[endpoints[0]], too_large))
+    server.send(b'after', endpoints[0])
+    assert tick_until(server, clients, lambda: clients[0].receive() == (1, b'after'))
+    close_all(server, clients)
+    print("-completed testing queued commands")
+
+def send_and_deliver(server: PsychicServer, client: PsychicClient, messages: list[bytes]):
+    # the messages arrive at the server in one tick, without reading them
+    for message in messages:
+        client.send(message)
+    client.tick()
+    sleep(0.05)
+    server.tick()
+
+def test_receive_any():
+    print("-testing receiving from any client")
+    for memoryview_payloads in [False, True]:
+        server = PsychicServer(0, ack_delay_ns=0, memoryview_payloads=memoryview_payloads)
+        clients = connect_clients(server, 3)
+        assert tick_until(server, clients, lambda: server.is_idle() and all(client.is_idle() for client in clients))
+        a, b, c = [get_server_endpoint(server, client) for client in clients]
+        print('testing clients take turns in the order they became ready')
+        send_and_deliver(server, clients[0], [b'a0', b'a1', b'a2'])
+        send_and_deliver(server, clients[1], [b'b0', b'b1'])
+        send_and_deliver(server, clients[2], [b'c0'])
+        if memoryview_payloads:
+            # a view is only valid until the next receive from its client, so a batch ends before a client repeats
+            assert [(client, number, bytes(message)) for client, number, message in server.receive_batch(10)] == [(a, 0, b'a0'), (b, 0, b'b0'), (c, 0, b'c0')]
+            assert [(client, number, bytes(message)) for client, number, message in server.receive_batch(10)] == [(a, 1, b'a1'), (b, 1, b'b1')]
+        else:
+            print('testing a batch stops at its limit')
+            assert server.receive_batch(4) == [(a, 0, b'a0'), (b, 0, b'b0'), (c, 0, b'c0'), (a, 1, b'a1')]
+            assert server.receive_any() == (b, 1, b'b1')
+        received = server.receive_any()
+        assert received is not None and (received[0], received[1], bytes(received[2])) == (a, 2, b'a2')
+        assert server.receive_any() is None
+        assert server.receive_batch(10) == []
+        print("testing a disconnected client's messages are skipped")
+        send_and_deliver(server, clients[0], [b'a3', b'a4'])
+        send_and_deliver(server, clients[1], [b'b2'])
+        server.disconnect(a)
+        server.tick()
+        assert a not in server.get_clients()
+        received = server.receive_any()
+        assert received is not None and (received[0], received[1], bytes(received[2])) == (b, 2, b'b2')
+        assert server.receive_any() is None
+        assert len(server.ready_clients) == 0
+        close_all(server, clients)
+    print("-completed testing receiving from any client")
+
+def test_handlers():
+    print("-testing handlers")
+    server = PsychicServer(0, hole_punch_timeout=50_000_000, ack_delay_ns=0)
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    server_endpoint = ('127.0.0.1', local_endpoint[1])
+    client = PsychicClient(0, ack_delay_ns=0)
+    server_events: list[tuple[Any, ...]] = []
+    client_events: list[tuple[Any, ...]] = []
+    # the server echoes every message from inside its handler
+    server.set_handlers(on_connect=lambda client: server_events.append(('connect', client)),
+                        on_message=lambda client, number, message: server.send(b'echo ' + bytes(message), client),
+                        on_disconnect=lambda client: server_events.append(('disconnect', client)),
+                        on_hole_punch_failed=lambda target: server_events.append(('hole_punch_failed', target)),
+                        on_stun_result=lambda result: server_events.append(('stun_result', result)))
+    client.set_handlers(on_connect=lambda server: client_events.append(('connect', server)),
+                        on_message=lambda number, message: client_events.append(('message', bytes(message))),
+                        on_disconnect=lambda server: client_events.append(('disconnect', server)))
+    print('testing connect handlers')
+    client.connect(server_endpoint)
+    assert tick_until(server, [client], lambda: len(server_events) == 1 and len(client_events) == 1)
+    endpoint = get_server_endpoint(server, client)
+    assert server_events == [('connect', endpoint)]
+    assert client_events == [('connect', server_endpoint)]
+    print('testing message handlers')
+    for index in range(5):
+        client.send(b'%d' % index)
+    assert tick_until(server, [client], lambda: len(client_events) == 6)
+    assert sorted(client_events[1:]) == [('message', b'echo %d' % index) for index in range(5)]
+    assert server.receive_any() is None and client.receive() is None # taken by the handlers
+    print('testing hole punch and stun handlers')
+    server.hole_punch(('127.0.0.1', 9))
+    server.start_stun([('127.0.0.1', 9)])
+    assert tick_until(server, [client], lambda: len(server_events) == 3)
+    assert sorted(server_events[1:], key=str) == [('hole_punch_failed', ('127.0.0.1', 9)), ('stun_result', None)]
+    print('testing disconnect handlers')
+    server.disconnect(endpoint)
+    assert tick_until(server, [client], lambda: len(server_events) == 4 and len(client_events) == 7)
+    assert server_events[3] == ('disconnect', endpoint)
+    assert client_events[6] == ('disconnect', server_endpoint)
+    close_all(server, [client])
+    print("-completed testing handlers")
+
+def test_handshake():
+    print("-testing the handshake")
+    address = ('127.0.0.1', 1000)
+    print('testing requests are accepted')
+    handshake = Handshake()
+    assert handshake.respond(create_request_packet(7), address, 0, 0) == (7, None)
+    assert handshake.respond(create_data_packet(0, (0, b'hi')), address, 0, 0) == (None, None)
+    assert handshake.respond(b'x', address, 0, 0) == (None, None)
+    print('testing a close from an unknown address is acknowledged')
+    assert handshake.respond(create_close_packet(7), address, 0, 0) == (None, create_close_ack_packet(7))
+    print('testing a request has to echo a cookie')
+    handshake = Handshake(cookie_handshake=True)
+    convid, reply = handshake.respond(create_request_packet(7), address, 0, 0)
+    assert convid is None and reply is not None
+    decoded = decode_packet(reply)
+    assert decoded is not None and decoded[0] == COOKIE_TYPE and decoded[1] == 7
+    assert handshake.respond(create_request_packet(7, decoded[2]), ('127.0.0.1', 1001), 0, 0)[0] is None
+    assert handshake.respond(create_request_packet(7, decoded[2]), address, 0, 0) == (7, None)
+    print('testing a full server replies busy')
+    handshake = Handshake(max_connections=2)
+    assert handshake.respond(create_request_packet(7), address, 0, 1) == (7, None)
+    assert handshake.respond(create_request_packet(7), address, 0, 2) == (None, create_busy_packet(7, FULL_RETRY_AFTER_MS))
+    print('testing rate limited requests reply busy')
+    handshake = Handshake(admission_control=AdmissionControl(1, 1, 100, 100))
+    assert handshake.respond(create_request_packet(7), address, 0, 0) == (7, None)
+    assert handshake.respond(create_request_packet(7), address, 0, 0) == (None, create_busy_packet(7, 1_001)) # a token in just over a second, rounded up to milliseconds
+    print("-completed testing the handshake")
+
+def main():
+    print("---------testing psychic server")
+    test_deadline_scheduling()
+    test_client_table()
+    test_blocking_tick()
+    test_receive_budget()
+    test_udp_offload()
+    test_queued_commands()
+    test_receive_any()
+    test_handlers()
+    test_handshake()
+    print("---------completed testing psychic server")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+from socketcommon import create_wakeup_sockets, wake, drain_wakeup, get_wait_timeout
+from selectors import BaseSelector, EVENT_READ
+from time import perf_counter_ns
+from threading import Lock
+from heapq import heappush, heappop
+from collections.abc import Callable
+from typing import Any
+try:
+    from selectors import EpollSelector as ReactorSelector # linux
+except ImportError:
+    from selectors import DefaultSelector as ReactorSelector
+
+
+class Reactor:
+    # Drives any number of servers, clients and broadcast objects from one thread with a single selector
+    # A transport is ticked when its socket is readable, when it is woken by another thread, or when its next deadline passes
+    # Transports need a socket, a wakeup_reader, tick, next_deadline and is_closed, as PsychicServer, PsychicClient, BroadcastServer and BroadcastClient have
+    def __init__(self):
+        self.selector: BaseSelector = ReactorSelector()
+        self.wakeup_reader, self.wakeup_writer = create_wakeup_sockets() # interrupts the select when transports are added or on close
+        self.selector.register(self.wakeup_reader, EVENT_READ, None)
+        self.transports: dict[int, tuple[Any, Callable[[Any, Any], None] | None]] = {} # id of transport -> transport and callback
+        self.deadlines: list[tuple[int, int]] = [] # heap of (deadline, id of transport)
+        self.scheduled_deadlines: dict[int, int] = {} # id of transport -> its deadline in the heap
+        self.lock: Lock = Lock()
+        self.selecting: bool = False # true while run_once waits in the selector, which close must then leave to run_once to close
+        self.closed = False
+
+    def register(self, transport: Any, callback: Callable[[Any, Any], None] | None = None):
+        # callback is called with the transport and whatever its tick returned, each time it is ticked
+        with self.lock:
+            if self.closed or id(transport) in self.transports or transport.is_closed():
+                return
+            self.transports[id(transport)] = (transport, callback)
+            self.selector.register(transport.socket, EVENT_READ, transport)
+            self.selector.register(transport.wakeup_reader, EVENT_READ, transport)
+            self._schedule(transport)
+            wake(self.wakeup_writer)
+
+    def unregister(self, transport: Any):
+        # call before closing a transport from another thread, transports closed while they are ticked are unregistered automatically
+        with self.lock:
+            if id(transport) not in self.transports:
+                return
+            self._unregister(transport)
+
+    def get_transport_count(self) -> int:
+        return len(self.transports)
+
+    def run_once(self, timeout: float | None = None) -> int:
+        # waits up to timeout seconds for a transport to need ticking (None waits until one does), returns the number ticked
+        with self.lock:
+            if self.closed:
+                return 0
+            wait = get_wait_timeout(self._next_deadline(), perf_counter_ns(), timeout)
+            self.selecting = True
+        try:
+            events = self.selector.select(wait)
+        except (OSError, ValueError):
+            events = []
+        with self.lock:
+            self.selecting = False
+            if self.closed:
+                self._close_selector()
+                return 0
+            ready: dict[int, Any] = {}
+            for key, _ in events:
+                if key.data is None or key.fileobj is key.data.wakeup_reader:
+                    drain_wakeup(key.fileobj) # type: ignore
+                if key.data is not None:
+                    ready[id(key.data)] = key.data
+            time = perf_counter_ns()
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= time:
+                deadline, transport_id = heappop(self.deadlines)
+                if self.scheduled_deadlines.get(transport_id) != deadline:
+                    continue # rescheduled or unregistered
+                self.scheduled_deadlines.pop(transport_id)
+                ready[transport_id] = self.transports[transport_id][0]
+            callbacks = [self.transports[transport_id][1] for transport_id in ready]
+        # ticked without the lock, so that callbacks can register and unregister transports
+        for transport, callback in zip(ready.values(), callbacks):
+            result = transport.tick(0)
+            if callback is not None:
+                callback(transport, result)
+            with self.lock:
+                if id(transport) not in self.transports or self.closed:
+                    continue
+                if transport.is_closed():
+                    self._unregister(transport)
+                else:
+                    self._schedule(transport)
+        return len(ready)
+
+    def run(self):
+        # runs until closed
+        while not self.closed:
+            self.run_once(None)
+
+    def _schedule(self, transport: Any):
+        deadline = transport.next_deadline()
+        if deadline is None:
+            self.scheduled_deadlines.pop(id(transport), None)
+            return
+        if self.scheduled_deadlines.get(id(transport)) == deadline:
+            return
+        self.scheduled_deadlines[id(transport)] = deadline
+        heappush(self.deadlines, (deadline, id(transport)))
+
+    def _next_deadline(self) -> int | None:
+        # discard entries from the top of the heap that have been rescheduled or unregistered
+        while len(self.deadlines) > 0 and self.scheduled_deadlines.get(self.deadlines[0][1]) != self.deadlines[0][0]:
+            heappop(self.deadlines)
+        if len(self.deadlines) == 0:
+            return None
+        return self.deadlines[0][0]
+
+    def _unregister(self, transport: Any):
+        self.transports.pop(id(transport))
+        self.scheduled_deadlines.pop(id(transport), None)
+        for fileobj in (transport.socket, transport.wakeup_reader):
+            try:
+                self.selector.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        # the registered transports are left open
+        if self.closed:
+            return
+        self.closed = True
+        wake(self.wakeup_writer)
+        with self.lock:
+            self.transports.clear()
+            self.deadlines.clear()
+            self.scheduled_deadlines.clear()
+            # closing the wakeup reader during a select would discard the wakeup, leaving the select waiting
+            if not self.selecting:
+                self._close_selector()
+
+    def _close_selector(self):
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
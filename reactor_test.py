@@ -0,0 +1,128 @@
+from reactor import Reactor
+from psychicserver import PsychicServer
+from psychicclient import PsychicClient
+from threading import Thread
+from time import perf_counter, sleep
+from collections.abc import Callable
+from typing import Any
+
+def wait_until(condition: Callable[[], bool], timeout: float = 5) -> bool:
+    # the reactor ticks in its own thread, this only polls
+    end = perf_counter() + timeout
+    while perf_counter() < end:
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+def echo(server: PsychicServer, _: Any):
+    while (received := server.receive_any()) is not None:
+        endpoint, _, message = received
+        server.send(bytes(message), endpoint)
+
+def test_run():
+    print("-testing running a server and clients")
+    reactor = Reactor()
+    server = PsychicServer(0, ack_delay_ns=0)
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    reactor.register(server, echo)
+    clients = [PsychicClient(0, ack_delay_ns=0) for _ in range(20)]
+    echoes: dict[int, list[bytes]] = {index: [] for index in range(len(clients))}
+    def receive(index: int) -> Callable[[PsychicClient, Any], None]:
+        def callback(client: PsychicClient, _: Any):
+            while (received := client.receive()) is not None:
+                echoes[index].append(bytes(received[1]))
+        return callback
+    for index, client in enumerate(clients):
+        reactor.register(client, receive(index))
+    assert reactor.get_transport_count() == len(clients) + 1
+    thread = Thread(target=reactor.run, daemon=True)
+    thread.start()
+    print('testing clients connect while the reactor runs')
+    for client in clients:
+        client.connect(('127.0.0.1', local_endpoint[1]))
+    assert wait_until(lambda: all(client.is_connected() for client in clients) and len(server.get_clients()) == len(clients))
+    print('testing messages are echoed to each client')
+    for index, client in enumerate(clients):
+        for number in range(5):
+            client.send(b'%d %d' % (index, number))
+    assert wait_until(lambda: all(len(received) == 5 for received in echoes.values()))
+    assert echoes == {index: [b'%d %d' % (index, number) for number in range(5)] for index in range(len(clients))}
+    print('testing a transport closed while it is ticked is unregistered')
+    closing = clients.pop()
+    reactor.register(closing, lambda client, _: client.close()) # registering again is ignored
+    reactor.unregister(closing)
+    reactor.register(closing, lambda client, _: client.close())
+    closing.send(b'close')
+    assert wait_until(lambda: reactor.get_transport_count() == len(clients) + 1)
+    assert closing.is_closed()
+    print('testing an unregistered transport is no longer ticked')
+    unregistered = clients.pop()
+    reactor.unregister(unregistered)
+    assert reactor.get_transport_count() == len(clients) + 1
+    unregistered.send(b'unregistered')
+    sleep(0.2)
+    assert unregistered.receive() is None
+    def tick_and_receive() -> bool:
+        unregistered.tick()
+        received = unregistered.receive()
+        return received is not None and bytes(received[1]) == b'unregistered'
+    assert wait_until(tick_and_receive)
+    print('testing close ends run')
+    reactor.close()
+    thread.join(5)
+    assert not thread.is_alive() and reactor.is_closed()
+    assert reactor.get_transport_count() == 0
+    print('testing the transports are left open')
+    assert not server.is_closed() and all(not client.is_closed() for client in clients)
+    reactor.register(unregistered)
+    assert reactor.get_transport_count() == 0
+    for client in clients + [unregistered]:
+        client.close()
+    server.close()
+    print("-completed testing running a server and clients")
+
+def test_run_once():
+    print("-testing run once")
+    reactor = Reactor()
+    print('testing an empty reactor waits for the timeout')
+    start = perf_counter()
+    assert reactor.run_once(0.1) == 0
+    assert perf_counter() - start >= 0.09
+    print('testing a closed transport is not registered')
+    client = PsychicClient(0, ack_delay_ns=0)
+    client.close()
+    reactor.register(client)
+    assert reactor.get_transport_count() == 0
+    print('testing a transport with a deadline is ticked without a datagram')
+    server = PsychicServer(0, ack_delay_ns=0)
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    client = PsychicClient(0, ack_delay_ns=0)
+    client.connect(('127.0.0.1', local_endpoint[1]))
+    ticks: list[Any] = []
+    reactor.register(client, lambda _, result: ticks.append(result))
+    assert client.next_deadline() is not None
+    assert reactor.run_once(1) == 1 and len(ticks) == 1
+    print('testing close from another thread ends a waiting run once')
+    reactor.unregister(client)
+    thread = Thread(target=lambda: reactor.run_once(None), daemon=True)
+    thread.start()
+    sleep(0.1)
+    reactor.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert reactor.run_once(0) == 0
+    client.close()
+    server.close()
+    print("-completed testing run once")
+
+def main():
+    print("---------testing reactor")
+    test_run()
+    test_run_once()
+    print("---------completed testing reactor")
+
+if __name__ == "__main__":
+    main()
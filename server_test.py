@@ -34,7 +34,7 @@ def main():
     def tick():
         stun_in_progress = True
         while not server.is_closed():
-            connections, disconnections = server.tick()
+            connections, disconnections = server.tick(None)
             with clients_lock:
                 for client in connections:
                     print(f"new connection from: {endpoint_to_string(client)}")
@@ -44,10 +44,9 @@ def main():
                     clients.remove(client)
                 for target in server.get_hole_punch_fails():
                     print(f"hole punch failed: {endpoint_to_string(target)}")
-                for client in clients:
-                    while recv:= server.receive(client):
-                        seg, message = recv
-                        print(f"from {endpoint_to_string(client)}: {seg}: {message.decode()}")
+                while recv:= server.receive_any():
+                    client, seg, message = recv
+                    print(f"from {endpoint_to_string(client)}: {seg}: {bytes(message).decode()}")
             if not server.stun_in_progress() and stun_in_progress:
                 stun_in_progress = False
                 stun_result = server.get_stun_result()
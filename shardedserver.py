@@ -0,0 +1,266 @@
+from psychicserver import PsychicServer
+from socketcommon import LINUX, attach_source_hash, get_source_hash_index
+from iptools import IP_endpoint, get_canonical_endpoint
+from socket import AddressFamily, AF_INET
+from multiprocessing import get_context
+from multiprocessing.connection import Connection as Pipe, wait
+from threading import Thread, Lock
+from collections import deque
+from os import cpu_count
+from typing import Any
+
+
+class ShardedPsychicServer:
+    # Runs a PsychicServer in each of several forked worker processes, all bound to the same port with SO_REUSEPORT
+    # On linux, ipv4 clients are routed to a worker by a hash of their address (otherwise, the kernel hashes each source address and port)
+    # Either way a client stays with one worker, which reports its connections and messages back to this process
+    # Linux only: fork is not available on windows and is unsafe on macos, and other systems don't spread udp datagrams over a reuseport group
+    def __init__(self, port: int = 0, workers: int | None = None, family: AddressFamily = AF_INET, **server_options: Any):
+        if not LINUX:
+            raise OSError("ShardedPsychicServer is only supported on linux")
+        self.workers: int = workers if workers is not None else (cpu_count() or 1)
+        self.family: AddressFamily = family
+        self.pipes: list[Pipe] = []
+        self.processes: list[Any] = []
+        self.local_endpoint: IP_endpoint | None = None
+        self.source_hash: bool = False # true if clients are routed by get_source_hash_index
+
+        self.client_workers: dict[IP_endpoint, int] = {} # client -> index of the worker that owns it
+        self.received: dict[IP_endpoint, deque[tuple[int, bytes]]] = {}
+        self.new_connections: list[IP_endpoint] = []
+        self.disconnections: list[IP_endpoint] = []
+        self.hole_punch_fails: list[IP_endpoint] = []
+
+        self.lock: Lock = Lock()
+        self.closed = False
+
+        # workers are started one at a time, so that each worker's index matches its socket's index in the reuseport group
+        context = get_context('fork')
+        for index in range(self.workers):
+            parent_pipe, worker_pipe = context.Pipe()
+            # the worker also gets the earlier workers' pipes, which it closes so that each worker sees its own pipe close when this process exits
+            process = context.Process(target=_run_worker, args=(index, self.workers, port, family, server_options, worker_pipe, self.pipes + [parent_pipe]), daemon=True)
+            process.start()
+            worker_pipe.close()
+            _, local_endpoint, source_hash = parent_pipe.recv()
+            if index == 0:
+                self.local_endpoint = local_endpoint
+                self.source_hash = source_hash
+                port = local_endpoint[1]
+            self.pipes.append(parent_pipe)
+            self.processes.append(process)
+
+    def get_worker_count(self) -> int:
+        return self.workers
+
+    def get_clients(self) -> list[IP_endpoint]:
+        with self.lock:
+            if self.closed:
+                return []
+            return list(self.client_workers)
+
+    def get_local_endpoint(self) -> IP_endpoint | None:
+        with self.lock:
+            if self.closed:
+                return None
+            return self.local_endpoint
+
+    def get_family(self) -> AddressFamily | None:
+        with self.lock:
+            if self.closed:
+                return None
+            return self.family
+
+    def get_hole_punch_fails(self) -> list[IP_endpoint]:
+        with self.lock:
+            fails = self.hole_punch_fails.copy()
+            self.hole_punch_fails.clear()
+            return fails
+
+    def hole_punch(self, target: IP_endpoint):
+        # punched from the worker that the target's replies will be routed to
+        with self.lock:
+            if self.closed:
+                return
+            endpoint = get_canonical_endpoint(target, self.family)
+            if endpoint is None or endpoint in self.client_workers:
+                return
+            self._send_command(self._get_worker_for(endpoint), ('hole_punch', endpoint))
+
+    def stop_hole_punch(self, target: IP_endpoint):
+        with self.lock:
+            if self.closed:
+                return
+            endpoint = get_canonical_endpoint(target, self.family)
+            if endpoint is None:
+                return
+            self._send_command(self._get_worker_for(endpoint), ('stop_hole_punch', endpoint))
+
+    def disconnect(self, client: IP_endpoint):
+        with self.lock:
+            if self.closed:
+                return
+            endpoint = get_canonical_endpoint(client, self.family)
+            if endpoint is None or endpoint not in self.client_workers:
+                return
+            self._send_command(self.client_workers[endpoint], ('disconnect', endpoint))
+
+    def send(self, message: bytes, destination: IP_endpoint):
+        with self.lock:
+            if self.closed:
+                return
+            endpoint = get_canonical_endpoint(destination, self.family)
+            if endpoint is None or endpoint not in self.client_workers:
+                return
+            self._send_command(self.client_workers[endpoint], ('send', endpoint, bytes(message)))
+
+    def receive(self, source: IP_endpoint) -> tuple[int, bytes] | None:
+        with self.lock:
+            if self.closed:
+                return None
+            endpoint = get_canonical_endpoint(source, self.family)
+            if endpoint is None or endpoint not in self.received or len(self.received[endpoint]) == 0:
+                return None
+            return self.received[endpoint].popleft()
+
+    def tick(self, timeout: float | None = 0) -> tuple[list[IP_endpoint], list[IP_endpoint]]: # returns new connections and disconnections
+        # collects events from the workers, waiting up to timeout seconds for the first one (None waits until there is one)
+        with self.lock:
+            if self.closed:
+                return ([], [])
+            pipes = [pipe for pipe in self.pipes if not pipe.closed]
+            if len(pipes) == 0:
+                return ([], [])
+        ready = wait(pipes, timeout)
+        with self.lock:
+            if self.closed:
+                return ([], [])
+            for pipe in ready:
+                self._read_events(self.pipes.index(pipe)) # type: ignore
+            new_connections = self.new_connections.copy()
+            disconnections = self.disconnections.copy()
+            self.new_connections.clear()
+            self.disconnections.clear()
+            return (new_connections, disconnections)
+
+    def _get_worker_for(self, endpoint: IP_endpoint) -> int:
+        if endpoint in self.client_workers:
+            return self.client_workers[endpoint]
+        if self.source_hash and ':' not in endpoint[0]:
+            return get_source_hash_index(endpoint, self.workers)
+        return 0 # the kernel chooses the worker that receives the reply
+
+    def _send_command(self, worker: int, command: tuple[Any, ...]):
+        try:
+            self.pipes[worker].send(command)
+        except (OSError, ValueError):
+            self._remove_worker(worker)
+
+    def _read_events(self, worker: int):
+        pipe = self.pipes[worker]
+        try:
+            while not pipe.closed and pipe.poll():
+                for event in pipe.recv():
+                    self._manage_event(worker, event)
+        except (EOFError, OSError):
+            self._remove_worker(worker)
+
+    def _manage_event(self, worker: int, event: tuple[Any, ...]):
+        match event[0]:
+            case 'connect':
+                self.client_workers[event[1]] = worker
+                self.received[event[1]] = deque()
+                self.new_connections.append(event[1])
+            case 'disconnect':
+                self._remove_client(event[1])
+            case 'message':
+                if event[1] in self.received:
+                    self.received[event[1]].append((event[2], event[3]))
+            case 'hole_punch_failed':
+                self.hole_punch_fails.append(event[1])
+
+    def _remove_client(self, client: IP_endpoint):
+        if client not in self.client_workers:
+            return
+        self.client_workers.pop(client)
+        self.received.pop(client)
+        self.disconnections.append(client)
+
+    def _remove_worker(self, worker: int):
+        # the worker has exited -> all of its clients are disconnected
+        self.pipes[worker].close()
+        for client in [client for client, owner in self.client_workers.items() if owner == worker]:
+            self._remove_client(client)
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for pipe in self.pipes:
+                try:
+                    pipe.send(('close',))
+                except (OSError, ValueError):
+                    pass
+            for process in self.processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+            for pipe in self.pipes:
+                pipe.close()
+            self.client_workers.clear()
+            self.received.clear()
+            self.new_connections.clear()
+            self.disconnections.clear()
+
+
+def _run_worker(index: int, workers: int, port: int, family: AddressFamily, server_options: dict[str, Any], pipe: Pipe, parent_pipes: list[Pipe]):
+    for parent_pipe in parent_pipes:
+        parent_pipe.close()
+    server = PsychicServer(port, family, reuse_port=True, **server_options)
+    # the program applies to the whole group, so only the first worker attaches it
+    source_hash = attach_source_hash(server.socket, workers) if index == 0 else False
+    pipe.send(('ready', server.get_local_endpoint(), source_hash))
+
+    def read_commands():
+        while not server.is_closed():
+            try:
+                command = pipe.recv()
+            except (EOFError, OSError):
+                command = ('close',)
+            match command:
+                case ('send', endpoint, message):
+                    try:
+                        server.send(message, endpoint)
+                    except ValueError:
+                        pass # too large for the connection -> dropped, there is no caller to raise to
+                case ('disconnect', endpoint):
+                    server.disconnect(endpoint)
+                case ('hole_punch', endpoint):
+                    server.hole_punch(endpoint)
+                case ('stop_hole_punch', endpoint):
+                    server.stop_hole_punch(endpoint)
+                case ('close',):
+                    server.close()
+                case _:
+                    pass # malformed -> dropped
+
+    Thread(target=read_commands, daemon=True).start()
+    while not server.is_closed():
+        connections, disconnections = server.tick(None)
+        # events are sent in one batch per tick
+        # disconnections come first, so that a client that disconnected and connected again in the same tick stays connected
+        events: list[tuple[Any, ...]] = [('disconnect', client) for client in disconnections]
+        events.extend([('connect', client) for client in connections])
+        while (received := server.receive_any()) is not None:
+            events.append(('message', received[0], received[1], bytes(received[2])))
+        events.extend([('hole_punch_failed', target) for target in server.get_hole_punch_fails()])
+        if len(events) > 0:
+            try:
+                pipe.send(events)
+            except (OSError, ValueError):
+                server.close()
+    pipe.close()
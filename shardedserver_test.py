@@ -0,0 +1,95 @@
+from shardedserver import ShardedPsychicServer
+from psychicclient import PsychicClient
+from connection import INIT_MAX_REASSEMBLY_SIZE
+from iptools import IP_endpoint
+from time import perf_counter
+from collections.abc import Callable
+
+def tick_until(server: ShardedPsychicServer, clients: list[PsychicClient], events: tuple[list[IP_endpoint], list[IP_endpoint]], condition: Callable[[], bool], timeout: float = 5) -> bool:
+    # events collects the server's new connections and disconnections
+    end = perf_counter() + timeout
+    while perf_counter() < end:
+        connections, disconnections = server.tick(0.001)
+        events[0].extend(connections)
+        events[1].extend(disconnections)
+        for client in clients:
+            client.tick()
+        if condition():
+            return True
+    return False
+
+def test_sharded_server():
+    print("-testing the sharded server")
+    server = ShardedPsychicServer(0, 2, ack_delay_ns=0)
+    local_endpoint = server.get_local_endpoint()
+    assert local_endpoint is not None
+    assert server.get_worker_count() == 2
+    print('testing clients connect through the workers')
+    clients = [PsychicClient(0, ack_delay_ns=0) for _ in range(4)]
+    for client in clients:
+        client.connect(('127.0.0.1', local_endpoint[1]))
+    events: tuple[list[IP_endpoint], list[IP_endpoint]] = ([], [])
+    assert tick_until(server, clients, events, lambda: len(events[0]) == 4 and all(client.is_connected() for client in clients))
+    endpoints = [('127.0.0.1', client.get_local_endpoint()[1]) for client in clients] # type: ignore
+    assert sorted(events[0]) == sorted(endpoints) == sorted(server.get_clients())
+    assert all(worker in [0, 1] for worker in server.client_workers.values())
+    print('testing messages reach the right client in both directions')
+    for index, client in enumerate(clients):
+        client.send(b'from %d' % index)
+        server.send(b'to %d' % index, endpoints[index])
+    server_received: dict[IP_endpoint, tuple[int, bytes]] = {}
+    client_received: dict[int, tuple[int, bytes | memoryview]] = {}
+    def receive_all() -> bool:
+        for index, endpoint in enumerate(endpoints):
+            received = server.receive(endpoint)
+            if received is not None:
+                server_received[endpoint] = received
+            client_message = clients[index].receive()
+            if client_message is not None:
+                client_received[index] = client_message
+        return len(server_received) == 4 and len(client_received) == 4
+    assert tick_until(server, clients, events, receive_all)
+    assert server_received == {endpoint: (0, b'from %d' % index) for index, endpoint in enumerate(endpoints)}
+    assert client_received == {index: (0, b'to %d' % index) for index in range(4)}
+    print('testing malformed and failing commands are dropped by the worker')
+    worker = server.client_workers[endpoints[1]]
+    server._send_command(worker, ('send',))
+    server._send_command(worker, ('disconnect', endpoints[1], 'extra'))
+    server._send_command(worker, ('unknown', endpoints[1]))
+    server.send(bytes(INIT_MAX_REASSEMBLY_SIZE + 1), endpoints[1]) # too large, dropped by the worker
+    server.send(b'after', endpoints[1])
+    client_received.clear()
+    def receive_after() -> bool:
+        client_message = clients[1].receive()
+        if client_message is not None:
+            client_received[1] = client_message
+        return 1 in client_received
+    assert tick_until(server, clients, events, receive_after)
+    assert client_received[1] == (1, b'after') # the second message to that client
+    assert server.processes[worker].is_alive() and endpoints[1] in server.get_clients()
+    print('testing a disconnect is reported')
+    server.disconnect(endpoints[0])
+    assert tick_until(server, clients, events, lambda: events[1] == [endpoints[0]] and not clients[0].is_connected())
+    assert endpoints[0] not in server.get_clients()
+    assert server.receive(endpoints[0]) is None
+    print('testing a worker exits when its pipe to this process is closed')
+    # the other worker must not hold on to this pipe
+    server.pipes[1].close()
+    server.processes[1].join(5)
+    assert not server.processes[1].is_alive()
+    assert server.processes[0].is_alive()
+    print('testing close stops the workers')
+    server.close()
+    assert not any(process.is_alive() for process in server.processes)
+    assert server.get_clients() == [] and server.get_local_endpoint() is None
+    for client in clients:
+        client.close()
+    print("-completed testing the sharded server")
+
+def main():
+    print("---------testing sharded server")
+    test_sharded_server()
+    print("---------completed testing sharded server")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,29 @@
-from socket import SOCK_DGRAM, IPPROTO_IPV6, IPV6_V6ONLY, SOL_SOCKET, SO_REUSEADDR, SO_BROADCAST, AF_INET, IP_ADD_MEMBERSHIP, IPPROTO_IP, IP_MULTICAST_TTL, INADDR_ANY
+from socket import socketpair, SOCK_DGRAM, SO_RCVBUF, SO_SNDBUF, IPPROTO_IPV6, IPV6_V6ONLY, SOL_SOCKET, SO_REUSEADDR, SO_BROADCAST, AF_INET, IP_ADD_MEMBERSHIP, IPPROTO_IP, IP_MULTICAST_TTL, INADDR_ANY
 from iptools import *
 from typing import Any
 from struct import pack
+from ctypes import create_string_buffer, addressof
+from errno import EIO, EINVAL, ENOPROTOOPT, EOPNOTSUPP
+from select import select
+from sys import platform
 
 BUFSIZE = 2000
+MAX_DATAGRAMS_PER_TICK = 1024
+
+# the socket module does not export the linux only options below
+# other systems may use the same numbers for other options, so they are only set on linux
+LINUX = platform.startswith('linux')
+# udp offload options from linux/udp.h
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_GRO = 104
+MAX_GSO_SEGMENTS = 64
+MAX_GSO_SIZE = 65000 # largest total payload of a segmented datagram
+GRO_BUFSIZE = 2 ** 16 # a coalesced receive can be as large as the largest udp datagram
+GRO_CONTROL_SIZE = 64 # space for the segment size and drop count control messages
+SO_RXQ_OVFL = 40 # linux: report the number of datagrams dropped by the socket with each receive
+SO_ATTACH_REUSEPORT_CBPF = 51 # linux: choose the socket of a SO_REUSEPORT group with a classic bpf program
+SOURCE_HASH_MULTIPLIER = 0x9E3779B1
 DUMMY_ENDPOINT : unresolved_endpoint  = ("192.0.2.1", 2000)
 LAN_BROADCAST_DESTINATION : unresolved_endpoint = ("255.255.255.255", 2000)
 IPV6_LOOPBACK : unresolved_endpoint = ("::1", 2000)
@@ -13,60 +33,236 @@ previous_text = None
 previous_printed_text = None
 previous_amount = 1
 
-def create_unbound_udp_socket(family: AddressFamily) -> socket:
+def create_unbound_udp_socket(family: AddressFamily, receive_buffer_size: int | None = None, send_buffer_size: int | None = None, reusable: bool = False) -> socket:
+    # buffer sizes of None keep the system defaults
     udp_socket = socket(family, SOCK_DGRAM)
     if family == AF_INET6:
         udp_socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
-    make_socket_reusable(udp_socket)
+    if reusable:
+        make_socket_reusable(udp_socket)
+    set_buffer_sizes(udp_socket, receive_buffer_size, send_buffer_size)
     return udp_socket
     
-def create_ordinary_udp_socket(port: int, family: AddressFamily) -> socket:
-    udp_socket = create_unbound_udp_socket(family)
+def create_ordinary_udp_socket(port: int, family: AddressFamily, receive_buffer_size: int | None = None, send_buffer_size: int | None = None, reusable: bool | None = None) -> socket:
+    # by default only a fixed port is reusable, the kernel can give the same ephemeral port to two reusable sockets
+    udp_socket = create_unbound_udp_socket(family, receive_buffer_size, send_buffer_size, port != 0 if reusable is None else reusable)
     udp_socket.bind(('', port)) # bind the socket
+    udp_socket.setblocking(False)
     return udp_socket
 
-def create_broadcast_sending_socket(port: int, family: AddressFamily, multicast_ttl:int = 32) -> socket:
-    s = create_unbound_udp_socket(family)
+def create_broadcast_sending_socket(port: int, family: AddressFamily, multicast_ttl:int = 32, receive_buffer_size: int | None = None, send_buffer_size: int | None = None) -> socket:
+    s = create_unbound_udp_socket(family, receive_buffer_size, send_buffer_size, port != 0)
     s.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, multicast_ttl)
     s.bind(('', port))
+    s.setblocking(False)
     return s
 
-def create_broadcast_receiving_socket(port: int, multicast_group: str, family: AddressFamily) -> socket:
-    s = create_unbound_udp_socket(family)
+def create_broadcast_receiving_socket(port: int, multicast_group: str, family: AddressFamily, receive_buffer_size: int | None = None, send_buffer_size: int | None = None) -> socket:
+    s = create_unbound_udp_socket(family, receive_buffer_size, send_buffer_size, True)
     s.bind(('', port))
     mreq = pack("4sl", address_to_bytes(multicast_group, family), INADDR_ANY)
     s.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, mreq)
+    s.setblocking(False)
     return s
 
+def receive_datagrams(udp_socket: socket, max_datagrams: int | None) -> list[tuple[bytes, Any]]:
+    # reads from a non blocking socket until it is drained or max_datagrams have been read
+    datagrams: list[tuple[bytes, Any]] = []
+    while max_datagrams is None or len(datagrams) < max_datagrams:
+        try:
+            datagrams.append(udp_socket.recvfrom(BUFSIZE))
+        except BlockingIOError:
+            break
+        except ConnectionResetError:
+            continue # icmp port unreachable from an earlier send on windows
+        except OSError:
+            break
+    return datagrams
+
+def set_buffer_sizes(udp_socket: socket, receive_buffer_size: int | None, send_buffer_size: int | None):
+    # the kernel may round the sizes or cap them (e.g. at net.core.rmem_max on linux)
+    if receive_buffer_size is not None:
+        udp_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, receive_buffer_size)
+    if send_buffer_size is not None:
+        udp_socket.setsockopt(SOL_SOCKET, SO_SNDBUF, send_buffer_size)
+
+def enable_drop_counter(udp_socket: socket) -> bool:
+    # returns true if the kernel will report the number of dropped datagrams, they must then be received with receive_datagrams of a BufferPool
+    if not LINUX:
+        return False
+    try:
+        udp_socket.setsockopt(SOL_SOCKET, SO_RXQ_OVFL, 1)
+        return hasattr(udp_socket, 'recvmsg_into')
+    except OSError:
+        return False
+
+def attach_source_hash(udp_socket: socket, group_size: int) -> bool:
+    # routes each ipv4 source address to the socket at get_source_hash_index in the socket's SO_REUSEPORT group (in the order they were bound)
+    # returns false if the program could not be attached, the kernel then hashes each source address and port instead
+    if not LINUX or udp_socket.family != AF_INET:
+        return False
+    net_offset = -0x100000 # SKF_NET_OFF, loads relative to the ip header
+    instructions = [
+        (0x20, net_offset + 12), # load the source address (BPF_LD | BPF_W | BPF_ABS)
+        (0x24, SOURCE_HASH_MULTIPLIER), # multiply (BPF_ALU | BPF_MUL | BPF_K)
+        (0x74, 16), # shift right (BPF_ALU | BPF_RSH | BPF_K)
+        (0x94, group_size), # modulo (BPF_ALU | BPF_MOD | BPF_K)
+        (0x16, 0), # return the socket index (BPF_RET | BPF_A)
+    ]
+    program = create_string_buffer(b''.join([pack('HBBI', code, 0, 0, k & 0xffffffff) for code, k in instructions]))
+    try:
+        udp_socket.setsockopt(SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, pack('HL', len(instructions), addressof(program)))
+        return True
+    except OSError:
+        return False
+
+def get_source_hash_index(endpoint: IP_endpoint, group_size: int) -> int:
+    # the index that the program from attach_source_hash chooses for datagrams from the endpoint
+    address = int.from_bytes(address_to_bytes(endpoint[0], AF_INET), 'big')
+    return (((address * SOURCE_HASH_MULTIPLIER) & 0xffffffff) >> 16) % group_size
+
+def enable_gso(udp_socket: socket) -> bool:
+    # returns true if the kernel can split one large send into several datagrams
+    if not LINUX:
+        return False
+    try:
+        udp_socket.getsockopt(SOL_UDP, UDP_SEGMENT)
+        return hasattr(udp_socket, 'sendmsg')
+    except OSError:
+        return False
+
+def enable_gro(udp_socket: socket) -> bool:
+    # returns true if the kernel will coalesce received datagrams, they must then be received with receive_datagrams of a BufferPool
+    if not LINUX:
+        return False
+    try:
+        udp_socket.setsockopt(SOL_UDP, UDP_GRO, 1)
+        return hasattr(udp_socket, 'recvmsg_into')
+    except OSError:
+        return False
+
+def send_datagrams(udp_socket: socket, datagrams: list[tuple[bytes, Any]], use_gso: bool) -> bool:
+    # sends in order, with gso each run of datagrams to the same destination is sent with one call when their sizes allow it
+    # returns false if the kernel does not support gso, so that it is not used again
+    index = 0
+    while index < len(datagrams):
+        data, destination = datagrams[index]
+        run_end = _get_gso_run_end(datagrams, index) if use_gso else index + 1
+        if run_end - index > 1:
+            try:
+                # the segments are passed as separate buffers, the kernel gathers them into one datagram without joining them here
+                udp_socket.sendmsg([segment for segment, _ in datagrams[index:run_end]], [(SOL_UDP, UDP_SEGMENT, pack('=H', len(data)))], 0, destination)
+                index = run_end
+                continue
+            except OSError as error:
+                if error.errno in (EIO, ENOPROTOOPT, EOPNOTSUPP):
+                    use_gso = False # not supported by the kernel or device
+                elif error.errno != EINVAL:
+                    index = run_end # could not send (e.g. the send buffer is full) -> drop like any other failed send
+                    continue
+                # otherwise, the segments were too large to be split -> send the rest of the run individually
+        for position in range(index, run_end):
+            data, destination = datagrams[position]
+            try:
+                udp_socket.sendto(data, destination)
+            except:
+                pass
+        index = run_end
+    return use_gso
+
+def _get_gso_run_end(datagrams: list[tuple[bytes, Any]], start: int) -> int:
+    # every segment must be the size of the first, except for the last, which can be smaller
+    size = len(datagrams[start][0])
+    destination = datagrams[start][1]
+    if size == 0:
+        return start + 1
+    total = size
+    end = start + 1
+    while end < len(datagrams) and end - start < MAX_GSO_SEGMENTS:
+        data, other_destination = datagrams[end]
+        if other_destination != destination or len(data) > size or total + len(data) > MAX_GSO_SIZE or len(data) == 0:
+            break
+        total += len(data)
+        end += 1
+        if len(data) < size:
+            break
+    return end
+
+def create_wakeup_sockets() -> tuple[socket, socket]:
+    # writing to the second socket makes the first readable, used to interrupt a blocking wait from another thread
+    reader, writer = socketpair()
+    reader.setblocking(False)
+    writer.setblocking(False)
+    return (reader, writer)
+
+def wake(writer: socket):
+    try:
+        writer.send(b'\x00')
+    except (BlockingIOError, OSError):
+        pass # already woken or closed
+
+def get_wait_timeout(deadline_ns: int | None, time_ns: int, timeout: float | None) -> float | None:
+    # seconds to wait until the deadline, no longer than timeout, None waits until woken
+    if deadline_ns is None:
+        return timeout
+    until_deadline = max(deadline_ns - time_ns, 0) / 1_000_000_000
+    return until_deadline if timeout is None else min(until_deadline, timeout)
+
+def wait_for_readable(sockets: list[socket], wakeup_reader: socket, timeout: float | None):
+    # blocks until one of the sockets is readable, the wakeup socket is written to, or the timeout passes
+    if timeout is not None and timeout <= 0:
+        return
+    try:
+        rl, _, _ = select(sockets + [wakeup_reader], [], [], timeout)
+        if wakeup_reader in rl:
+            drain_wakeup(wakeup_reader)
+    except (OSError, ValueError):
+        pass # closed while waiting
+
+def drain_wakeup(wakeup_reader: socket):
+    # clears the wakeups written so far, so that the reader is no longer readable
+    try:
+        while len(wakeup_reader.recv(BUFSIZE)) > 0:
+            pass
+    except (BlockingIOError, OSError):
+        pass # drained or closed
+
 def make_socket_reusable(socket: socket):
     socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     try:
-        socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1) # unix version # type: ignore
-    except (AttributeError, NameError):
+        from socket import SO_REUSEPORT # unix version
+        socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    except (ImportError, AttributeError, NameError):
         pass
 
 def get_lan_endpoint(family: AddressFamily, local_endpoint: IP_endpoint) -> IP_endpoint | None:
     try:
+        bind_endpoint = get_canonical_endpoint_with_port(local_endpoint, 0, family)
+        if bind_endpoint is None:
+            return None
         s = create_unbound_udp_socket(family)
         s.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-        s.bind(local_endpoint)
+        s.bind(bind_endpoint)
         endpoint = resolve_to_canonical_endpoint(LAN_BROADCAST_DESTINATION, family)
         if endpoint is None:
             return None
         s.connect(endpoint)
-        return get_canonical_local_endpoint(s)
+        return get_canonical_endpoint_with_port(get_canonical_local_endpoint(s), local_endpoint[1], family) # same address, with the port of local_endpoint
     except Exception:
         return None
     
 def get_loopback_endpoint(family: AddressFamily, local_endpoint: IP_endpoint) -> IP_endpoint | None:
     try:
+        bind_endpoint = get_canonical_endpoint_with_port(local_endpoint, 0, family)
+        if bind_endpoint is None:
+            return None
         s = create_unbound_udp_socket(family)
-        s.bind(local_endpoint)
+        s.bind(bind_endpoint)
         endpoint = resolve_to_canonical_endpoint(IPV4_LOOPBACK if family == AF_INET else IPV6_LOOPBACK, family)
         if endpoint is None:
             return None
         s.connect(endpoint)
-        return get_canonical_local_endpoint(s)
+        return get_canonical_endpoint_with_port(get_canonical_local_endpoint(s), local_endpoint[1], family) # same address, with the port of local_endpoint
     except Exception:
         return None
     
@@ -0,0 +1,196 @@
+import socketcommon
+from socketcommon import GRO_BUFSIZE, MAX_GSO_SEGMENTS, SOL_UDP, UDP_GRO, SO_RXQ_OVFL, create_ordinary_udp_socket, get_loopback_endpoint, enable_gso, enable_gro, enable_drop_counter, attach_source_hash, set_buffer_sizes, send_datagrams, _get_gso_run_end
+from bufferpool import BufferPool
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, SO_RCVBUF, SO_SNDBUF
+from errno import EIO, EINVAL
+from struct import pack
+from time import sleep
+from typing import Any
+
+class CountingSocket(socket):
+    # counts the calls used to send, and can pretend that the kernel does not support gso
+    def __init__(self, gso_supported: bool = True):
+        super().__init__(AF_INET, SOCK_DGRAM)
+        self.gso_supported = gso_supported
+        self.gso_too_large = False
+        self.calls = 0
+
+    def sendto(self, *args: Any) -> int: # type: ignore
+        self.calls += 1
+        return super().sendto(*args)
+
+    def sendmsg(self, *args: Any) -> int: # type: ignore
+        self.calls += 1
+        if not self.gso_supported:
+            raise OSError(EIO, 'gso not supported')
+        if self.gso_too_large:
+            raise OSError(EINVAL, 'segments too large')
+        return super().sendmsg(*args)
+
+class DropReportingSocket(socket):
+    # returns the queued datagrams with a made up drop count, as a socket with the drop counter enabled does on linux
+    def __init__(self, datagrams: list[tuple[bytes, int]]):
+        super().__init__(AF_INET, SOCK_DGRAM)
+        self.datagrams = datagrams
+
+    def recvmsg_into(self, buffers: Any, ancillary_size: int = 0, flags: int = 0) -> tuple[int, list[tuple[int, int, bytes]], int, Any]: # type: ignore
+        if not self.datagrams:
+            raise BlockingIOError()
+        data, drops = self.datagrams.pop(0)
+        buffers[0][:len(data)] = data
+        return (len(data), [(SOL_SOCKET, SO_RXQ_OVFL, pack('=I', drops))], 0, ('127.0.0.1', 1))
+
+def receive_all(receiver: socket, gro: bool) -> list[bytes]:
+    sleep(0.05)
+    buffer_pool = BufferPool(GRO_BUFSIZE if gro else 2000)
+    return [bytes(data) for data, _ in buffer_pool.receive_datagrams(receiver, None, gro)]
+
+def test_gso_runs():
+    print("-testing gso runs")
+    first = ('127.0.0.1', 1)
+    second = ('127.0.0.1', 2)
+    print('testing a run takes same sized datagrams to the same destination')
+    assert _get_gso_run_end([(b'a' * 10, first)] * 5, 0) == 5
+    assert _get_gso_run_end([(b'a' * 10, first)] * 3 + [(b'a' * 10, second)], 0) == 3
+    assert _get_gso_run_end([(b'a' * 10, first), (b'a' * 11, first)], 0) == 1
+    print('testing a smaller datagram ends a run')
+    assert _get_gso_run_end([(b'a' * 10, first), (b'a' * 5, first), (b'a' * 5, first)], 0) == 2
+    assert _get_gso_run_end([(b'', first), (b'', first)], 0) == 1
+    print('testing a run has at most the max segments')
+    assert _get_gso_run_end([(b'a', first)] * (MAX_GSO_SEGMENTS + 10), 0) == MAX_GSO_SEGMENTS
+    print("-completed testing gso runs")
+
+def test_offload():
+    print("-testing udp offload")
+    receiver = create_ordinary_udp_socket(0, AF_INET)
+    destination = ('127.0.0.1', receiver.getsockname()[1])
+    datagrams = [(bytes([index]) * 100, destination) for index in range(10)] + [(b'end', destination)]
+    sender = CountingSocket()
+    if enable_gso(sender):
+        print('testing a burst is sent with one call')
+        assert send_datagrams(sender, datagrams, True)
+        assert sender.calls == 1
+        assert receive_all(receiver, False) == [data for data, _ in datagrams]
+    else:
+        print('gso not supported, skipped')
+    print('testing a run that cannot be split is sent individually, without trying gso again for each datagram')
+    sender.gso_too_large = True
+    sender.calls = 0
+    assert send_datagrams(sender, datagrams, True)
+    assert sender.calls == 1 + len(datagrams)
+    assert receive_all(receiver, False) == [data for data, _ in datagrams]
+    sender.gso_too_large = False
+    print('testing sending falls back when the kernel does not support gso')
+    sender.gso_supported = False
+    sender.calls = 0
+    assert not send_datagrams(sender, datagrams, True)
+    assert sender.calls == 1 + len(datagrams)
+    assert receive_all(receiver, False) == [data for data, _ in datagrams]
+    sender.calls = 0
+    assert not send_datagrams(sender, datagrams, False)
+    assert sender.calls == len(datagrams)
+    assert receive_all(receiver, False) == [data for data, _ in datagrams]
+    sender.close()
+    if enable_gro(receiver):
+        print('testing coalesced receives are split')
+        sender = CountingSocket()
+        send_datagrams(sender, datagrams, enable_gso(sender))
+        assert receive_all(receiver, True) == [data for data, _ in datagrams]
+        sender.close()
+    else:
+        print('gro not supported, skipped')
+    receiver.close()
+    print("-completed testing udp offload")
+
+def test_reusable_ports():
+    print("-testing reusable ports")
+    print('testing sockets on kernel chosen ports are not reusable, so they never share a port')
+    sockets = [create_ordinary_udp_socket(0, AF_INET) for _ in range(500)]
+    assert len(set(udp_socket.getsockname()[1] for udp_socket in sockets)) == len(sockets)
+    assert all(udp_socket.getsockopt(SOL_SOCKET, SO_REUSEADDR) == 0 for udp_socket in sockets)
+    for udp_socket in sockets:
+        udp_socket.close()
+    print('testing sockets on a fixed port are reusable')
+    first = create_ordinary_udp_socket(0, AF_INET, reusable=True)
+    port = first.getsockname()[1]
+    second = create_ordinary_udp_socket(port, AF_INET)
+    assert second.getsockopt(SOL_SOCKET, SO_REUSEADDR) != 0
+    print('testing the loopback endpoint is found while the port is in use')
+    assert get_loopback_endpoint(AF_INET, ('127.0.0.1', port)) == ('127.0.0.1', port)
+    first.close()
+    second.close()
+    print("-completed testing reusable ports")
+
+def test_buffer_sizes():
+    print("-testing buffer sizes")
+    print('testing the sizes are read back from the socket')
+    for size in (16384, 65536):
+        udp_socket = create_ordinary_udp_socket(0, AF_INET, receive_buffer_size=size, send_buffer_size=size // 2)
+        expected = 2 * size if socketcommon.LINUX else size # linux doubles the size for its bookkeeping
+        assert udp_socket.getsockopt(SOL_SOCKET, SO_RCVBUF) == expected
+        assert udp_socket.getsockopt(SOL_SOCKET, SO_SNDBUF) == expected // 2
+        udp_socket.close()
+    print('testing no sizes keep the system defaults')
+    default_socket = socket(AF_INET, SOCK_DGRAM)
+    udp_socket = create_ordinary_udp_socket(0, AF_INET)
+    assert udp_socket.getsockopt(SOL_SOCKET, SO_RCVBUF) == default_socket.getsockopt(SOL_SOCKET, SO_RCVBUF)
+    assert udp_socket.getsockopt(SOL_SOCKET, SO_SNDBUF) == default_socket.getsockopt(SOL_SOCKET, SO_SNDBUF)
+    set_buffer_sizes(udp_socket, 16384, None)
+    assert udp_socket.getsockopt(SOL_SOCKET, SO_SNDBUF) == default_socket.getsockopt(SOL_SOCKET, SO_SNDBUF)
+    udp_socket.close()
+    default_socket.close()
+    print("-completed testing buffer sizes")
+
+def test_drop_counter():
+    print("-testing the drop counter")
+    print('testing the drop count is read from the ancillary data')
+    udp_socket = DropReportingSocket([(b'first', 0), (b'second', 3), (b'third', 7)])
+    buffer_pool = BufferPool(2000)
+    received: list[tuple[bytes, int]] = []
+    for data, _ in buffer_pool.receive_datagrams(udp_socket, None, count_drops=True):
+        received.append((bytes(data), buffer_pool.kernel_drops))
+    assert received == [(b'first', 0), (b'second', 3), (b'third', 7)]
+    print('testing the count is kept until the next datagram reports one')
+    assert list(buffer_pool.receive_datagrams(udp_socket, None, count_drops=True)) == []
+    assert buffer_pool.kernel_drops == 7
+    assert buffer_pool.get_buffers_in_use() == 0
+    udp_socket.close()
+    print("-completed testing the drop counter")
+
+def test_linux_only_options():
+    print("-testing linux only options")
+    print('testing the options are not set on other systems')
+    linux = socketcommon.LINUX
+    socketcommon.LINUX = False
+    try:
+        udp_socket = create_ordinary_udp_socket(0, AF_INET)
+        assert not enable_gso(udp_socket)
+        assert not enable_gro(udp_socket)
+        assert not enable_drop_counter(udp_socket)
+        assert not attach_source_hash(udp_socket, 2)
+        if linux:
+            assert udp_socket.getsockopt(SOL_UDP, UDP_GRO) == 0
+            assert udp_socket.getsockopt(SOL_SOCKET, SO_RXQ_OVFL) == 0
+        udp_socket.close()
+    finally:
+        socketcommon.LINUX = linux
+    if linux:
+        print('testing the options are set on linux')
+        udp_socket = create_ordinary_udp_socket(0, AF_INET)
+        assert enable_drop_counter(udp_socket)
+        assert udp_socket.getsockopt(SOL_SOCKET, SO_RXQ_OVFL) == 1
+        udp_socket.close()
+    print("-completed testing linux only options")
+
+def main():
+    print("---------testing socket common")
+    test_gso_runs()
+    test_offload()
+    test_reusable_ports()
+    test_buffer_sizes()
+    test_drop_counter()
+    test_linux_only_options()
+    print("---------completed testing socket common")
+
+if __name__ == "__main__":
+    main()